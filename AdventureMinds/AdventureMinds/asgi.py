@@ -12,14 +12,17 @@ from django.core.asgi import get_asgi_application
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "AdventureMinds.settings")
+# set Django up before importing anything that uses models
+django_application = get_asgi_application()
+
 from mainapp import routing
+from mainapp.fileserver import serve_files
 from mainapp.routing import websocket_urlpatterns
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "AdventureMinds.settings")
-
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": serve_files(django_application),
     "websocket": AuthMiddlewareStack(
         # URLRouter(routing.websocket_url_patterns)
         URLRouter(routing.websocket_urlpatterns)
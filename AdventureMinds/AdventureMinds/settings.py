@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -24,7 +25,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = "django-insecure-z)p!^5#lfet3hqq!d1m&+2_^%(45ytg@mi-ry6u6^s3+m8fmgx"
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.environ.get('DJANGO_DEBUG', '1') == '1'
 
 ALLOWED_HOSTS = []
 
@@ -45,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "mainapp.metrics.RequestMetricsMiddleware",
+    "mainapp.routers.PrimaryPinningMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -81,11 +84,37 @@ WSGI_APPLICATION = "AdventureMinds.wsgi.application"
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
+        # SQLite in WAL mode (set by migration 0011), waiting for the write lock
+        # instead of failing and taking it when a transaction begins (see
+        # mainapp/backends/sqlite3/base.py)
+        "ENGINE": "mainapp.backends.sqlite3",
         "NAME":  "db.sqlite3",
+        # keep each thread's connection open between requests and chat
+        # messages instead of reconnecting, and PRAGMAs, every time
+        "CONN_MAX_AGE": int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+        "CONN_HEALTH_CHECKS": True,
+        # the test database is a file too: threads sharing an in-memory one
+        # fail with "database table is locked" instead of waiting their turn
+        "TEST": {"NAME": "test_db.sqlite3"},
     }
 }
 
+# Read replicas: set DATABASE_REPLICAS to comma separated SQLite files that
+# something (e.g. Litestream or LiteFS) keeps in sync with the primary.
+# Listing, search, calendar, blog and profile views read from them; writes,
+# and reads after a write by the same visitor, go to the primary
+# (see mainapp/routers.py).
+READ_REPLICAS = []
+for number, name in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), start=1):
+    # nothing is written to a replica, so its transactions need not take the write lock
+    DATABASES[f'replica{number}'] = {**DATABASES['default'], 'NAME': name, 'OPTIONS': {'transaction_mode': 'DEFERRED'},
+                                     'TEST': {'MIRROR': 'default'}}
+    READ_REPLICAS.append(f'replica{number}')
+DATABASE_ROUTERS = ['mainapp.routers.PrimaryReplicaRouter']
+# how long a visitor reads from the primary after writing, i.e. the most the
+# replicas are expected to lag behind
+REPLICA_PIN_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -123,8 +152,31 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 STATICFILES_DIRS = [BASE_DIR / "mainapp/static"]
+STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'mainapp/media')
+# Uploads are stored once per distinct content (see mainapp/storage.py);
+# `manage.py collect_media` deletes the ones no longer used.
+STORAGES = {
+    "default": {
+        "BACKEND": "mainapp.storage.ContentAddressedStorage",
+    },
+    # collectstatic adds a content hash to every name outside of DEBUG, so the
+    # files can be cached forever
+    "staticfiles": {
+        "BACKEND": ("django.contrib.staticfiles.storage.StaticFilesStorage" if DEBUG
+                    else "django.contrib.staticfiles.storage.ManifestStaticFilesStorage"),
+    },
+}
+# Serve STATIC_ROOT and MEDIA_ROOT from the ASGI application, ahead of Django,
+# with range requests and long-lived caching (see mainapp/fileserver.py).
+# Turn it off when a web server in front already serves them.
+SERVE_FILES = os.environ.get('SERVE_FILES', '1') == '1'
+# unused stored files younger than this are kept, they may be about to be used
+MEDIA_COLLECT_GRACE_PERIOD = 60 * 60 * 24
+# Photos named in bulk imports (see mainapp/imports.py) are read from under
+# this directory, e.g. where a partner's photo batch was unpacked.
+IMPORT_PHOTO_ROOT = os.environ.get('IMPORT_PHOTO_ROOT', BASE_DIR / 'imports')
 LOGIN_REDIRECT_URL = 'mainapp:homepage'
 
 
@@ -135,11 +187,80 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
 ASGI_APPLICATION = "AdventureMinds.asgi.application"
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-        # "CONFIG": {
-        #     'hosts': [('127.0.0.1', 8001)],
-        # }
+
+# Set CACHE_URL to pick the cache backend:
+#   redis://127.0.0.1:6379/1      Redis, or any server speaking its protocol
+#                                  (fakeredis' TcpFakeServer works for local runs)
+#   file:///var/tmp/adventureminds shared by every worker on one machine
+# Without it each process keeps its own local-memory cache.
+CACHE_URL = os.environ.get('CACHE_URL')
+if CACHE_URL and CACHE_URL.startswith(('redis://', 'rediss://', 'unix://')):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        }
     }
-}
\ No newline at end of file
+elif CACHE_URL and CACHE_URL.startswith('file://'):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": CACHE_URL[len('file://'):],
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# How long public pages are served from the cache for anonymous visitors
+# (see mainapp/caching.py); changes to what they show take effect at once.
+PAGE_CACHE_TIMEOUT = 60 * 10
+# trip pages are cached briefly: they show a random sample of reviews
+TRIP_DETAIL_CACHE_TIMEOUT = 60
+
+# Set CHANNEL_LAYER_URL (e.g. redis://127.0.0.1:6379/0) to share the chat channel
+# layer between several ASGI workers. Without it the in-memory layer is used, which
+# only delivers messages inside a single process.
+# For local runs without a Redis server, fakeredis speaks the same protocol:
+#   python -c "from fakeredis import TcpFakeServer; TcpFakeServer(('127.0.0.1', 6379)).serve_forever()"
+CHANNEL_LAYER_URL = os.environ.get('CHANNEL_LAYER_URL')
+if CHANNEL_LAYER_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [CHANNEL_LAYER_URL],
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        }
+    }
+
+# Resized renditions of uploaded photos (see mainapp/images.py) are rendered by
+# this many worker processes after the upload is committed; 0 renders them in
+# the committing thread instead, which is simpler to debug.
+IMAGE_PIPELINE_WORKERS = int(os.environ.get('IMAGE_PIPELINE_WORKERS', 2))
+
+# Write-behind chat persistence: messages are broadcast immediately and stored
+# in batches by a background task (see mainapp/chat_writer.py). Messages still
+# buffered when a worker is killed outright are lost, so it is opt-in.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND') == '1'
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_INTERVAL = 0.05  # seconds
+# a message that fails to store this many times is logged and dropped
+CHAT_WRITE_BEHIND_MAX_ATTEMPTS = 5
+
+# Per-request query count, SQL, template and total time (see mainapp/metrics.py).
+# They are always logged on the mainapp.metrics logger; these add the
+# X-Query-Count and Server-Timing response headers and peak memory tracing.
+REQUEST_METRICS_HEADERS = DEBUG
+REQUEST_METRICS_TRACE_MEMORY = os.environ.get('REQUEST_METRICS_TRACE_MEMORY') == '1'
+# a request over its query budget fails the test that made it, rather than only logging a warning
+REQUEST_METRICS_ENFORCE_BUDGETS = sys.argv[1:2] == ['test']
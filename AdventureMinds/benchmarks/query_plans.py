@@ -0,0 +1,217 @@
+"""
+EXPLAIN QUERY PLAN and timings of the hot view queries, before and after
+the indexes added in mainapp/migrations/0004_hot_path_indexes.py.
+
+Seeds a throwaway SQLite database (never the configured one), drops the
+indexes that migration added, measures every query, creates them again and
+measures again.
+
+    python benchmarks/query_plans.py [--scale 1.0] [--repeat 20] [--plans]
+"""
+import argparse
+import importlib
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AdventureMinds.settings')
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+INDEX_MIGRATION = '0004_hot_path_indexes'
+
+# rows per table at --scale 1
+SIZES = {
+    'users': 2000,
+    'places': 500,
+    'trips': 20000,
+    'participants_per_trip': 5,
+    'join_requests': 40000,
+    'ratings': 30000,
+    'wishlist': 20000,
+    'blog_posts': 5000,
+    'chats': 2000,
+    'messages': 200000,
+}
+
+
+def seed(scale):
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+    from mainapp.models import (BlogPost, ChatMessage, JoinRequest, Place, Rating, Trip, UserChat, UserProfile,
+                                Wishlist)
+
+    rng = random.Random(1)
+    sizes = {name: max(1, int(count * scale)) for name, count in SIZES.items()}
+    sizes['participants_per_trip'] = SIZES['participants_per_trip']
+    now = timezone.now()
+    today = date.today()
+
+    users = User.objects.bulk_create(User(username=f'user{i}', password='!') for i in range(sizes['users']))
+    profiles = UserProfile.objects.bulk_create(UserProfile(user=user) for user in users)
+    places = Place.objects.bulk_create(
+        Place(name=f'Place {i}', address=f'{i} Main Street') for i in range(sizes['places']))
+
+    trips = []
+    for i in range(sizes['trips']):
+        start = today + timedelta(days=rng.randint(-730, 365))
+        trips.append(Trip(uploader=rng.choice(users), title=f'Trip {i}', description='A trip', place=rng.choice(places),
+                          start_date=start, end_date=start + timedelta(days=rng.randint(0, 14)),
+                          created_at=now - timedelta(minutes=i)))
+    trips = Trip.objects.bulk_create(trips, batch_size=2000)
+
+    Participant = Trip.participants.through
+    Participant.objects.bulk_create(
+        (Participant(trip=trip, user=user)
+         for trip in trips for user in rng.sample(users, sizes['participants_per_trip'])),
+        batch_size=5000, ignore_conflicts=True)
+    JoinRequest.objects.bulk_create(
+        (JoinRequest(trip=rng.choice(trips), user=rng.choice(users),
+                     status=rng.choice(['pending', 'pending', 'accepted', 'declined']))
+         for _ in range(sizes['join_requests'])),
+        batch_size=5000, ignore_conflicts=True)
+    Rating.objects.bulk_create(
+        (Rating(user=rng.choice(users), place=rng.choice(places), rating=rng.randint(1, 5))
+         for _ in range(sizes['ratings'])),
+        batch_size=5000, ignore_conflicts=True)
+    Wishlist.objects.bulk_create(
+        (Wishlist(user_id=rng.choice(profiles), trip_id=rng.choice(trips)) for _ in range(sizes['wishlist'])),
+        batch_size=5000, ignore_conflicts=True)
+    BlogPost.objects.bulk_create(
+        (BlogPost(title=f'Post {i}', content='Content', display_content='Content', author=rng.choice(users),
+                  place=rng.choice(places), created_at=now - timedelta(hours=i))
+         for i in range(sizes['blog_posts'])),
+        batch_size=2000)
+
+    chats = UserChat.objects.bulk_create(
+        UserChat(first_person=profiles[i % len(profiles)], second_person=profiles[(i + 1) % len(profiles)])
+        for i in range(sizes['chats']))
+    ChatMessage.objects.bulk_create(
+        (ChatMessage(userchat=chat, user=rng.choice([chat.first_person, chat.second_person]), message='Hello',
+                     timestamp=now - timedelta(seconds=i))
+         for i, chat in enumerate(rng.choice(chats) for _ in range(sizes['messages']))),
+        batch_size=5000)
+    return sizes
+
+
+def view_queries():
+    """(name, queryset) for the queries the views run, against the busiest rows."""
+    from django.db.models import Avg, Count
+    from mainapp.models import BlogPost, ChatMessage, JoinRequest, Rating, Trip, UserProfile, Wishlist
+    from mainapp.utils import month_range
+    from mainapp.views import chat_summaries
+
+    today = date.today()
+    first_day, last_day = month_range(today.year, today.month)
+    user = Trip.participants.through.objects.values('user').annotate(n=Count('id')).order_by('-n')[0]['user']
+    profile = UserProfile.objects.get(pk=user)
+    busy_trip = JoinRequest.objects.values('trip').annotate(n=Count('id')).order_by('-n')[0]['trip']
+    busy_chat = ChatMessage.objects.values('userchat').annotate(n=Count('id')).order_by('-n')[0]['userchat']
+    busy_place = Rating.objects.values('place').annotate(n=Count('id')).order_by('-n')[0]['place']
+    deep_trip = Trip.objects.order_by('-created_at', '-id')[Trip.objects.count() // 2]
+    deep_message = ChatMessage.objects.filter(userchat=busy_chat).order_by('-timestamp', '-id')[30]
+    deep_trip_value, deep_message_value = deep_trip.created_at, deep_message.timestamp
+
+    return [
+        ('calendar month', Trip.objects.filter(start_date__lte=last_day, end_date__gte=first_day)
+         .order_by('start_date', 'id').only('title', 'start_date', 'end_date')),
+        ('trip history, upcoming', Trip.objects.filter(participants=user, start_date__gt=today)),
+        ('trip history, past', Trip.objects.filter(participants=user, end_date__lt=today)),
+        ('trip feed, first page', Trip.objects.order_by('-created_at', '-id')[:13]),
+        ('trip feed, deep page', Trip.objects.filter(created_at__lt=deep_trip_value)
+         .order_by('-created_at', '-id')[:13]),
+        ('join request of user', JoinRequest.objects.filter(trip=busy_trip, user=user)),
+        ('pending join requests', JoinRequest.objects.filter(trip=busy_trip, status='pending').order_by('timestamp')),
+        ('place rating', Rating.objects.filter(place=busy_place).values('place').annotate(Avg('rating'))),
+        ('wishlist', Wishlist.objects.filter(user_id=profile).order_by('-date_added')),
+        ('blog list', BlogPost.objects.order_by('-created_at')[:50]),
+        ('chat history, first page', ChatMessage.objects.filter(userchat=busy_chat)
+         .order_by('-timestamp', '-id')[:31]),
+        ('chat history, older page', ChatMessage.objects.filter(userchat=busy_chat, timestamp__lt=deep_message_value)
+         .order_by('-timestamp', '-id')[:31]),
+        ('chat summaries', chat_summaries(profile).order_by('timestamp')),
+    ]
+
+
+def hot_path_indexes():
+    """(model, index) for each index the migration added that the models still have."""
+    from django.apps import apps
+    from django.db.migrations.operations import AddIndex
+
+    migration = importlib.import_module(f'mainapp.migrations.{INDEX_MIGRATION}').Migration
+    for operation in migration.operations:
+        if isinstance(operation, AddIndex):
+            model = apps.get_model('mainapp', operation.model_name)
+            if any(index.name == operation.index.name for index in model._meta.indexes):
+                yield model, operation.index
+
+
+def measure(queries, repeat):
+    from django.db import connection
+
+    results = {}
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+        for name, queryset in queries:
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = [row[-1] for row in cursor.fetchall()]
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                cursor.execute(sql, params)
+                cursor.fetchall()
+                timings.append(time.perf_counter() - started)
+            results[name] = (statistics.median(timings) * 1000, plan)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the seeded table sizes')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per query, the median is reported')
+    parser.add_argument('--plans', action='store_true', help='print the full query plans')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        settings.DATABASES['default']['NAME'] = os.path.join(tmp, 'benchmark.sqlite3')
+        django.setup()
+        from django.core.management import call_command
+        from django.db import connection
+
+        call_command('migrate', verbosity=0)
+        started = time.perf_counter()
+        sizes = seed(args.scale)
+        print(f'seeded {sizes["trips"]} trips, {sizes["messages"]} messages in {time.perf_counter() - started:.1f}s')
+
+        queries = view_queries()
+        indexes = list(hot_path_indexes())
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                editor.remove_index(model, index)
+        before = measure(queries, args.repeat)
+        with connection.schema_editor() as editor:
+            for model, index in indexes:
+                editor.add_index(model, index)
+        after = measure(queries, args.repeat)
+
+    width = max(len(name) for name, _ in queries)
+    print(f'{"query":<{width}}  {"before ms":>10}  {"after ms":>10}  {"speedup":>8}')
+    for name, _ in queries:
+        before_ms, before_plan = before[name]
+        after_ms, after_plan = after[name]
+        print(f'{name:<{width}}  {before_ms:>10.3f}  {after_ms:>10.3f}  {before_ms / after_ms:>7.1f}x')
+        if args.plans or before_plan != after_plan:
+            for label, plan in (('before', before_plan), ('after', after_plan)):
+                print(f'    {label}: ' + '\n            '.join(plan))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Throughput of concurrent readers and writers on the stock SQLite backend
+against mainapp.backends.sqlite3 (WAL, busy_timeout, BEGIN IMMEDIATE and
+persistent connections).
+
+Each profile gets its own throwaway database (never the configured one).
+For a few seconds, threads then run, as fast as they can:
+- writers insert chat messages the way ChatConsumer.save_message does
+- readers load a page of chat history
+- transactions read a place and then update it in one atomic block, like
+  the rating and review form
+
+After every operation a thread ends its "request" with
+close_old_connections(), which closes the connection unless CONN_MAX_AGE
+keeps it. Operations failing with "database is locked" are counted as
+errors.
+
+    python benchmarks/sqlite_concurrency.py [--seconds 5] [--writers 4] [--readers 4] [--transactions 2]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AdventureMinds.settings')
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+PROFILES = {
+    'stock': {'ENGINE': 'django.db.backends.sqlite3', 'CONN_MAX_AGE': 0},
+    'tuned': {'ENGINE': 'mainapp.backends.sqlite3', 'CONN_MAX_AGE': 600},
+}
+CHATS = 20
+
+
+def seed(alias):
+    from django.contrib.auth.models import User
+    from mainapp.models import ChatMessage, Place, UserChat, UserProfile
+
+    users = User.objects.using(alias).bulk_create(User(username=f'user{i}', password='!') for i in range(CHATS + 1))
+    profiles = UserProfile.objects.using(alias).bulk_create(UserProfile(user=user) for user in users)
+    chats = UserChat.objects.using(alias).bulk_create(
+        UserChat(first_person=profiles[i], second_person=profiles[i + 1]) for i in range(CHATS))
+    ChatMessage.objects.using(alias).bulk_create(
+        ChatMessage(userchat=chat, user=chat.first_person, message='Hello') for chat in chats for _ in range(50))
+    Place.objects.using(alias).bulk_create(Place(name=f'Place {i}', address='Main Street') for i in range(CHATS))
+    return [(chat.pk, chat.first_person_id) for chat in chats], list(
+        Place.objects.using(alias).values_list('pk', flat=True))
+
+
+def operations(alias, chats, places):
+    from django.db import transaction
+    from django.db.models import F
+    from mainapp.models import ChatMessage, Place
+
+    def write(i):
+        chat_id, profile_id = chats[i % len(chats)]
+        ChatMessage.objects.using(alias).create(userchat_id=chat_id, user_id=profile_id, message='Hi')
+
+    def read(i):
+        chat_id, _ = chats[i % len(chats)]
+        list(ChatMessage.objects.using(alias).filter(userchat_id=chat_id).order_by('-timestamp', '-id')[:30])
+
+    def read_then_write(i):
+        with transaction.atomic(using=alias):
+            place = Place.objects.using(alias).get(pk=places[i % len(places)])
+            Place.objects.using(alias).filter(pk=place.pk).update(rating_count=F('rating_count') + 1)
+
+    return {'write': write, 'read': read, 'transaction': read_then_write}
+
+
+def run(alias, workers, seconds):
+    from django.db import OperationalError, close_old_connections, connections
+
+    chats, places = seed(alias)
+    close_old_connections()
+    done, errors = Counter(), Counter()
+    lock = threading.Lock()
+    start = threading.Barrier(sum(workers.values()) + 1)
+    stop = threading.Event()
+
+    def worker(kind, operation, number):
+        count = failed = 0
+        start.wait()
+        i = number
+        while not stop.is_set():
+            try:
+                operation(i)
+                count += 1
+            except OperationalError:
+                failed += 1
+            finally:
+                close_old_connections()
+            i += 1
+        connections.close_all()
+        with lock:
+            done[kind] += count
+            errors[kind] += failed
+
+    ops = operations(alias, chats, places)
+    threads = [threading.Thread(target=worker, args=(kind, ops[kind], number))
+               for kind, count in workers.items() for number in range(count)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return done, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=5.0, help='how long each profile runs')
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--transactions', type=int, default=2)
+    args = parser.parse_args()
+    workers = {'write': args.writers, 'read': args.readers, 'transaction': args.transactions}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for alias, profile in PROFILES.items():
+            settings.DATABASES[alias] = {**settings.DATABASES['default'], 'CONN_HEALTH_CHECKS': False,
+                                         'NAME': os.path.join(tmp, f'{alias}.sqlite3'), **profile}
+        settings.DATABASES['default'] = settings.DATABASES['tuned']
+        django.setup()
+        from django.core.management import call_command
+
+        results = {}
+        for alias in PROFILES:
+            call_command('migrate', database=alias, verbosity=0)
+            results[alias] = run(alias, workers, args.seconds)
+
+    print(f'{args.writers} writers, {args.readers} readers, {args.transactions} transactions, '
+          f'{args.seconds:g}s per profile')
+    print(f'{"profile":<8}' + ''.join(f'  {kind + "/s":>14}  {"errors":>7}' for kind in workers))
+    for alias, (done, errors) in results.items():
+        print(f'{alias:<8}' + ''.join(f'  {done[kind] / args.seconds:>14.0f}  {errors[kind]:>7}' for kind in workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ from django import forms
 from django.core.exceptions import ValidationError
 from django.db.models import Q
 from .models import *
+from . import joins
 
 
 # Register your models here.
@@ -13,7 +14,6 @@ admin.site.register(UserPreferences)
 admin.site.register(PreferenceChoice)
 admin.site.register(PreferenceCategory)
 admin.site.register(ChatGroup)
-admin.site.register(Trip)
 admin.site.register(TripPhoto)
 admin.site.register(TripPreference)
 admin.site.register(JoinRequest)
@@ -23,6 +23,14 @@ admin.site.register(BlogPost)
 admin.site.register(Wishlist)
 
 
+@admin.register(Trip)
+class TripAdmin(admin.ModelAdmin):
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # participants edited here bypass mainapp/joins.py
+        joins.recount(Trip, [form.instance.pk])
+
+
 class ChatMessage(admin.TabularInline):
     model = ChatMessage
 
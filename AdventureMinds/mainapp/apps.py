@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class MainappConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
-    name = "mainapp"
\ No newline at end of file
+    name = "mainapp"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,86 @@
+import asyncio
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.middleware import get_user
+from django.contrib.auth.views import redirect_to_login
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Model
+from django.http import Http404
+from django.utils.functional import SimpleLazyObject
+
+# Helpers for async views. Nothing may touch the database from the event loop,
+# so whatever a view or its templates read lazily (request.user, the user's
+# profile, querysets) has to be loaded up front, with the async ORM methods
+# or in one sync_to_async call.
+
+
+def _load_user(request):
+    user = get_user(request)
+    if user.is_authenticated:
+        try:
+            # base.html shows the profile photo
+            user.userprofile
+        except ObjectDoesNotExist:
+            pass
+    return user
+
+
+async def auser(request):
+    """Load request.user, with its profile, and replace the lazy object with it."""
+    if isinstance(request.user, SimpleLazyObject):
+        request.user = await sync_to_async(_load_user)(request)
+    return request.user
+
+
+def profile_or_404(user):
+    """The profile auser() loaded along with user."""
+    try:
+        return user.userprofile
+    except ObjectDoesNotExist:
+        raise Http404('No UserProfile matches the given query.')
+
+
+def alogin_required(view=None, login_url=None):
+    """login_required for async views."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if (await auser(request)).is_authenticated:
+                return await view(request, *args, **kwargs)
+            return redirect_to_login(request.get_full_path(), login_url)
+        return wrapper
+
+    if view is not None:
+        return decorator(view)
+    return decorator
+
+
+async def alist(queryset):
+    return [item async for item in queryset]
+
+
+async def aget_object_or_404(klass, *args, **kwargs):
+    queryset = klass._default_manager.all() if isinstance(klass, type) and issubclass(klass, Model) else klass
+    try:
+        return await queryset.aget(*args, **kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+
+
+async def gather(*awaitables):
+    """
+    Await independent queries and return their results in order.
+
+    This does not make them concurrent: on Django 4.2 the ORM's async
+    methods go through sync_to_async(thread_sensitive=True), so the queries
+    run one after another on the same thread. Unlike asyncio.gather, every
+    one of them has finished before the first error is raised, so none is
+    still running on the request's connection after the response has been
+    sent.
+    """
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
@@ -0,0 +1,53 @@
+"""
+SQLite backend tuned for a small deployment with concurrent writers.
+
+The database is switched to WAL, so readers no longer block the writer and
+the writer no longer blocks readers. The journal mode is stored in the
+database file, so it is set once, by migration 0011_wal_journal_mode, rather
+than by every connection, which would rewrite the file's header each time a
+manage.py command opens it. Every connection waits busy_timeout for the
+write lock instead of failing with "database is locked". Transactions
+(atomic blocks) start with BEGIN IMMEDIATE: they take the write lock up
+front rather than failing halfway when a read has to be upgraded to a
+write while another connection is writing, which busy_timeout cannot help
+with. Read replicas, which are never written to, are configured with
+DEFERRED instead (see settings.py).
+
+The journal mode can be changed through OPTIONS['journal_mode'] before
+migrating, per-connection PRAGMAs through OPTIONS['init_pragmas'] and the way
+transactions begin through OPTIONS['transaction_mode'] (DEFERRED,
+IMMEDIATE or EXCLUSIVE). All other OPTIONS go to sqlite3.connect() as usual.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+JOURNAL_MODE = 'WAL'
+PRAGMAS = {
+    # with WAL a commit is still atomic and durable up to an OS crash or power loss
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # milliseconds
+    'mmap_size': 128 * 1024 * 1024,
+    'cache_size': -32000,  # KiB, per connection
+    'temp_store': 'MEMORY',
+}
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.journal_mode = kwargs.pop('journal_mode', JOURNAL_MODE)
+        self.init_pragmas = {**PRAGMAS, **kwargs.pop('init_pragmas', {})}
+        self.transaction_mode = kwargs.pop('transaction_mode', 'IMMEDIATE').upper()
+        if self.transaction_mode not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(f"transaction_mode must be one of {', '.join(TRANSACTION_MODES)}.")
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in self.init_pragmas.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {self.transaction_mode}')
@@ -0,0 +1,114 @@
+import hashlib
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+
+from .asyncviews import auser
+
+# Cached pages and fragments are keyed on the current version of every
+# section they show. Changing a BlogPost, Place, Trip, Review or Rating bumps
+# its section (see signals.py), so nothing needs to find and delete the old
+# entries: they stop being looked up and expire on their own.
+SECTIONS = ('blogpost', 'place', 'trip', 'review', 'rating')
+
+
+def version_key(section):
+    return f'mainapp:cache-version:{section}'
+
+
+def versions(*sections):
+    """Current version of each section, joined into one key component."""
+    keys = [version_key(section) for section in sections]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            # start from the clock rather than 0, so a version that was evicted
+            # never comes back with a value old entries were stored under
+            cache.add(key, time.time_ns(), None)
+            found[key] = cache.get(key)
+    return '.'.join(str(found[key]) for key in keys)
+
+
+async def aversions(*sections):
+    keys = [version_key(section) for section in sections]
+    found = await cache.aget_many(keys)
+    for key in keys:
+        if key not in found:
+            await cache.aadd(key, time.time_ns(), None)
+            found[key] = await cache.aget(key)
+    return '.'.join(str(found[key]) for key in keys)
+
+
+def invalidate(*sections):
+    for section in sections:
+        try:
+            cache.incr(version_key(section))
+        except ValueError:
+            cache.add(version_key(section), time.time_ns(), None)
+
+
+def page_cache_key(request, sections, versions):
+    url = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'mainapp:page:{request.method}:{url}:{versions}'
+
+
+def cacheable(request, response):
+    # pages carrying a CSRF token, a new cookie or flash messages are per visitor
+    return (response.status_code == 200 and not response.streaming and not response.cookies
+            and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE'))
+
+
+def cache_public_page(*sections, timeout=None):
+    """
+    Serve anonymous GET requests for a view from the cache.
+
+    The entry is keyed on the full path and the versions of sections, so a
+    change to any of them is visible on the next request. Logged-in users,
+    whose pages show their profile, and visitors with pending flash
+    messages always get a freshly rendered page.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if (request.method not in ('GET', 'HEAD') or (await auser(request)).is_authenticated
+                        or 'messages' in request.COOKIES):
+                    return await view(request, *args, **kwargs)
+
+                key = page_cache_key(request, sections, await aversions(*sections))
+                response = await cache.aget(key)
+                if response is not None:
+                    response['X-Cache'] = 'HIT'
+                    return response
+
+                response = await view(request, *args, **kwargs)
+                if cacheable(request, response):
+                    await cache.aset(key, response, settings.PAGE_CACHE_TIMEOUT if timeout is None else timeout)
+                    response['X-Cache'] = 'MISS'
+                return response
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (request.method not in ('GET', 'HEAD') or request.user.is_authenticated
+                    or 'messages' in request.COOKIES):
+                return view(request, *args, **kwargs)
+
+            key = page_cache_key(request, sections, versions(*sections))
+            response = cache.get(key)
+            if response is not None:
+                response['X-Cache'] = 'HIT'
+                return response
+
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+            if cacheable(request, response):
+                cache.set(key, response, settings.PAGE_CACHE_TIMEOUT if timeout is None else timeout)
+                response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
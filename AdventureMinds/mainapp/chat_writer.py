@@ -0,0 +1,114 @@
+import asyncio
+import atexit
+import logging
+import threading
+from collections import deque
+from itertools import islice
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMessageWriter:
+    """
+    Write-behind buffer for chat messages, used when settings.CHAT_WRITE_BEHIND is on.
+
+    Consumers enqueue unsaved ChatMessage instances (their timestamp is set
+    when they are created) and broadcast right away. A single background
+    task per process stores them with bulk_create once
+    CHAT_WRITE_BEHIND_BATCH_SIZE messages are waiting or
+    CHAT_WRITE_BEHIND_INTERVAL seconds have passed.
+
+    Batches are taken from the head of a FIFO buffer and only removed once
+    they are committed, so rows are written in broadcast order. When a batch
+    fails its rows are stored one at a time, up to the first that fails; that
+    one is retried next round, ahead of everything queued after it, and
+    logged and dropped after CHAT_WRITE_BEHIND_MAX_ATTEMPTS failures so one
+    bad row cannot hold up the rest. Whatever is still buffered is flushed
+    when the process exits.
+    """
+
+    def __init__(self):
+        self.pending = deque()
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+        atexit.register(self.flush_sync)
+
+    @property
+    def batch_size(self):
+        return settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+
+    def enqueue(self, message):
+        with self._pending_lock:
+            self.pending.append(message)
+            pending = len(self.pending)
+        self._ensure_task()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        await database_sync_to_async(self.flush_sync)()
+
+    def flush_sync(self):
+        with self._flush_lock:
+            while True:
+                with self._pending_lock:
+                    batch = list(islice(self.pending, self.batch_size))
+                if not batch:
+                    return
+                try:
+                    ChatMessage.objects.bulk_create(batch)
+                    done = len(batch)
+                except DatabaseError:
+                    logger.warning('Could not store %d chat messages at once, storing them one at a time',
+                                   len(batch), exc_info=True)
+                    done = self._store_one_at_a_time(batch)
+                with self._pending_lock:
+                    for _ in range(done):
+                        self.pending.popleft()
+                if done < len(batch):
+                    return
+
+    def _store_one_at_a_time(self, batch):
+        """Store batch up to the first row that fails. Returns how many rows are done with."""
+        for done, message in enumerate(batch):
+            try:
+                with transaction.atomic():
+                    message.save(force_insert=True)
+            except DatabaseError:
+                message.write_attempts = getattr(message, 'write_attempts', 0) + 1
+                if message.write_attempts < settings.CHAT_WRITE_BEHIND_MAX_ATTEMPTS:
+                    return done
+                logger.exception('Dropped chat message after %d attempts: userchat %s, user %s, sent %s: %r',
+                                 message.write_attempts, message.userchat_id, message.user_id,
+                                 message.timestamp.isoformat(), message.message)
+        return len(batch)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), settings.CHAT_WRITE_BEHIND_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # whatever was not stored stays buffered and is retried next round
+                logger.exception('Could not store chat messages')
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self.run())
+
+
+message_writer = ChatMessageWriter()
@@ -1,12 +1,22 @@
 import json
+from collections import OrderedDict
 from channels.consumer import AsyncConsumer
 from channels.db import database_sync_to_async
-from asgiref.sync import sync_to_async
+from channels.exceptions import StopConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from .chat_writer import message_writer
 from .models import UserChat, ChatMessage, ChatGroup, UserProfile
 
 User = get_user_model()
 
+# UserChats whose metadata a connection keeps in memory
+USERCHAT_CACHE_SIZE = 32
+
+
+def chat_group_room(group_id):
+    return f'chatgroup_{group_id}'
+
 
 class ChatConsumer(AsyncConsumer):
     async def websocket_connect(self, event):
@@ -19,9 +29,21 @@ class ChatConsumer(AsyncConsumer):
                 chat_room,
                 self.channel_name
             )
+            # resolved once per connection instead of once per message
+            self.profile = await self.get_profile(user)
+            self.user_photo = self.profile.profile_photo.url if self.profile and self.profile.profile_photo else None
+            self.userchats = OrderedDict()
+            # one channel layer group per ChatGroup, so a group message is a single group_send
+            self.chat_groups = set(await self.get_chat_group_ids(user))
+            for group_id in self.chat_groups:
+                await self.channel_layer.group_add(chat_group_room(group_id), self.channel_name)
             await self.send({
                 'type': 'websocket.accept'
             })
+        else:
+            await self.send({
+                'type': 'websocket.close'
+            })
 
     async def websocket_receive(self, event):
         received_data = json.loads(event['text'])
@@ -34,85 +56,61 @@ class ChatConsumer(AsyncConsumer):
             print('Error:: Incomplete message data')
             return False
 
-        sender = await self.get_user(user_id)
-        if receiver_id:
-            receiver = await self.get_user(receiver_id)
-        else:
-            receiver = None
-        userchat_obj = await self.get_userchat(userchat_id)
-        if not sender:
+        if str(user_id) != str(self.user.id) or self.profile is None:
             print('Error:: sent by user is incorrect')
-        if not userchat_obj:
+            return False
+
+        userchat = await self.get_userchat(userchat_id)
+        if not userchat:
             print('Error:: UserChat id is incorrect')
+            return False
 
-        message_obj = await self.save_message(sender, message, userchat_obj)
+        group_id = userchat['group_id']
+        if group_id is None:
+            if self.user.id not in (userchat['first_person_id'], userchat['second_person_id']):
+                print('Error:: sender is not part of this conversation')
+                return False
+        elif not await self.join_chat_group(group_id):
+            print('Error:: sender is not a member of this group')
+            return False
 
-        is_group_chat = await self.userchat_has_group(userchat_obj)
-        if not is_group_chat:
+        if settings.CHAT_WRITE_BEHIND:
+            message_obj = ChatMessage(user_id=self.profile.pk, userchat_id=userchat['id'], message=message)
+            message_writer.enqueue(message_obj)
+        else:
+            message_obj = await self.save_message(message, userchat['id'])
+
+        response = {
+            'message': message,
+            'sent_by': str(self.user.id),
+            'userchat_id': userchat_id,
+            'send_time': message_obj.timestamp.strftime('%d %a, %H:%M'),
+            'username': self.user.username,
+            'user_photo': self.user_photo
+        }
+        # serialized once, whatever the number of recipients
+        chat_event = {
+            'type': 'chat_message',
+            'text': json.dumps(response)
+        }
+
+        if group_id is None:
             other_user_chat_room = f'user_chatroom_{receiver_id}'
-            self_user = self.scope['user']
-            response = {
-                'message': message,
-                'sent_by': str(self_user.id),
-                'userchat_id': userchat_id,
-                'send_time': message_obj.timestamp.strftime("%d %a, %H:%M"),
-                'username': await self.get_username(message_obj.user),
-                'user_photo': await self.get_user_photo(message_obj)
-            }
-            print(response)
-            await self.channel_layer.group_send(
-                other_user_chat_room,
-                {
-                    'type': 'chat_message',
-                    'text': json.dumps(response)
-                }
-            )
-
-            await self.channel_layer.group_send(
-                self.chat_room,
-                {
-                    'type': 'chat_message',
-                    'text': json.dumps(response)
-                }
-            )
+            await self.channel_layer.group_send(other_user_chat_room, chat_event)
+            await self.channel_layer.group_send(self.chat_room, chat_event)
         else:
-            group_id = await self.get_group_id(userchat_obj)
-            members = await self.get_group_members(group_id)
-            for user in members:
-                user = await user
-                other_user_chat_room = f'user_chatroom_{user.id}'
-                self_user = self.scope['user']
-                response = {
-                    'message': message,
-                    'sent_by': str(self_user.id),
-                    'userchat_id': userchat_id,
-                    'send_time': message_obj.timestamp.strftime('%d %a, %H:%M'),
-                    'username': self.get_username(message_obj.user),
-                    'user_photo': await self.get_user_photo(message_obj)
-                }
-
-                if user != sender:
-                    await self.channel_layer.group_send(
-                        other_user_chat_room,
-                        {
-                            'type': 'chat_message',
-                            'text': json.dumps(response)
-                        }
-                    )
-                else:
-                    await self.channel_layer.group_send(
-                        self.chat_room,
-                        {
-                            'type': 'chat_message',
-                            'text': json.dumps(response)
-                        }
-                    )
+            await self.channel_layer.group_send(chat_group_room(group_id), chat_event)
 
     async def websocket_disconnect(self, event):
-        await self.channel_layer.group_discard(
-            self.chat_room,
-            self.channel_name
-        )
+        if hasattr(self, 'chat_room'):
+            await self.channel_layer.group_discard(
+                self.chat_room,
+                self.channel_name
+            )
+        for group_id in getattr(self, 'chat_groups', ()):
+            await self.channel_layer.group_discard(chat_group_room(group_id), self.channel_name)
+        # AsyncConsumer keeps running until told to stop, even with the socket closed
+        raise StopConsumer()
 
     async def chat_message(self, event):
         await self.send({
@@ -120,57 +118,55 @@ class ChatConsumer(AsyncConsumer):
             'text': event['text']
         })
 
-    async def send_group_message(self, user_id, message, userchat):
-        # Ensure this operation is performed asynchronously
-        members = await self.get_group_members(userchat.group.id)
-        for member in members:
-            if member.id != user_id:
-                await self.send({
-                    'type': 'websocket.send',
-                    'text': json.dumps({
-                        'message': message,
-                        'sent_by': user_id,
-                        'userchat_id': userchat.id
-                    })
-                })
+    async def chat_join_group(self, event):
+        # sent to user_chatroom_<id> when the user is added to a new ChatGroup
+        await self.join_chat_group(event['group_id'], verified=True)
 
-    @database_sync_to_async
-    def get_userchat(self, userchat_id):
-        return UserChat.objects.filter(id=userchat_id).first()
+    async def join_chat_group(self, group_id, verified=False):
+        if group_id in self.chat_groups:
+            return True
+        if not verified and not await self.is_group_member(group_id):
+            return False
+        self.chat_groups.add(group_id)
+        await self.channel_layer.group_add(chat_group_room(group_id), self.channel_name)
+        return True
+
+    async def get_userchat(self, userchat_id):
+        """UserChat metadata from the connection's LRU, loading it on a miss."""
+        try:
+            userchat_id = int(userchat_id)
+        except (TypeError, ValueError):
+            return None
 
-    @database_sync_to_async
-    def userchat_has_group(self, userchat_obj):
-        return userchat_obj.group is not None
+        userchat = self.userchats.get(userchat_id)
+        if userchat is not None:
+            self.userchats.move_to_end(userchat_id)
+            return userchat
 
-    @database_sync_to_async
-    def get_user(self, user_id):
-        return User.objects.filter(id=user_id).first()
+        userchat = await self.fetch_userchat(userchat_id)
+        if userchat is not None:
+            self.userchats[userchat_id] = userchat
+            if len(self.userchats) > USERCHAT_CACHE_SIZE:
+                self.userchats.popitem(last=False)
+        return userchat
 
     @database_sync_to_async
-    def save_message(self, user, message, userchat):
-        user_profile = UserProfile.objects.get(user=user)
-        return ChatMessage.objects.create(user=user_profile, userchat=userchat, message=message)
+    def fetch_userchat(self, userchat_id):
+        return UserChat.objects.filter(id=userchat_id).values(
+            'id', 'group_id', 'first_person_id', 'second_person_id').first()
 
     @database_sync_to_async
-    def get_group_members(self, group_id):
-        group = ChatGroup.objects.filter(id=group_id).first()
-        if group:
-            members = group.members.all()
-            users = [self.get_user(member.user.id) for member in members]
-            return users
-        return []
+    def get_profile(self, user):
+        return UserProfile.objects.filter(user=user).first()
 
     @database_sync_to_async
-    def get_group_id(self, userchat_obj):
-        return userchat_obj.group.id
+    def save_message(self, message, userchat_id):
+        return ChatMessage.objects.create(user_id=self.profile.pk, userchat_id=userchat_id, message=message)
 
     @database_sync_to_async
-    def get_username(self, user):
-        return user.user.username
+    def get_chat_group_ids(self, user):
+        return list(ChatGroup.objects.filter(members__user=user).values_list('id', flat=True))
 
     @database_sync_to_async
-    def get_user_photo(self, chat):
-        if chat.user.profile_photo is not None:
-            return chat.user.profile_photo.url
-        else:
-            return None
+    def is_group_member(self, group_id):
+        return ChatGroup.objects.filter(id=group_id, members__user=self.user).exists()
@@ -0,0 +1,162 @@
+"""
+CSV and JSON Lines exports of trips, trip rosters and chat transcripts.
+
+Rows are read with .iterator() (.aiterator() in async views) a chunk at a
+time, encoded into buffers of about BUFFER_SIZE bytes and, optionally,
+gzipped as they go, so exporting a chat with a million messages takes as
+little memory as exporting one with ten. Querysets select only the exported
+columns, with .values().
+"""
+import csv
+import io
+import json
+import re
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, OuterRef, Value
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .models import ChatMessage, JoinRequest, Trip
+
+CHUNK_SIZE = 2000
+BUFFER_SIZE = 64 * 1024
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/jsonl; charset=utf-8',
+}
+
+
+class Export:
+    """Named rows with the given fields, read from querysets of .values() one after the other."""
+
+    def __init__(self, name, fields, *querysets):
+        self.name = name
+        self.fields = fields
+        self.querysets = [queryset.values(*fields) for queryset in querysets]
+
+    def using(self, alias):
+        self.querysets = [queryset.using(alias) for queryset in self.querysets]
+        return self
+
+    def rows(self):
+        for queryset in self.querysets:
+            yield from queryset.iterator(chunk_size=CHUNK_SIZE)
+
+    async def arows(self):
+        for queryset in self.querysets:
+            async for row in queryset.aiterator(chunk_size=CHUNK_SIZE):
+                yield row
+
+
+def trips_export(trips):
+    trips = trips.annotate(place_name=F('place__name'), place_address=F('place__address'),
+                           organizer=F('uploader__username')).order_by('start_date', 'id')
+    return Export('trips', ['id', 'title', 'place_name', 'place_address', 'organizer', 'start_date', 'end_date',
+                            'meeting_point', 'cost_per_person', 'max_capacity', 'participant_count'], trips)
+
+
+def roster_export(trip_id):
+    """Who is on the trip, then everyone else who asked to join it."""
+    fields = ['username', 'first_name', 'last_name', 'email', 'status', 'requested_at']
+    own_request = JoinRequest.objects.filter(trip_id=trip_id, user_id=OuterRef('user_id'))
+    participants = Trip.participants.through.objects.filter(trip_id=trip_id).annotate(
+        username=F('user__username'), first_name=F('user__first_name'), last_name=F('user__last_name'),
+        email=F('user__email'), status=Value('participant'), requested_at=own_request.values('timestamp')[:1],
+    ).order_by('user__username')
+    # accepted requests of users who are on the trip are listed with the participants
+    others = JoinRequest.objects.filter(trip_id=trip_id).exclude(status='accepted').annotate(
+        username=F('user__username'), first_name=F('user__first_name'), last_name=F('user__last_name'),
+        email=F('user__email'), requested_at=F('timestamp'),
+    ).order_by('status', 'timestamp', 'id')
+    return Export(f'trip-{trip_id}-roster', fields, participants, others)
+
+
+def transcript_export(userchat_id):
+    messages = ChatMessage.objects.filter(userchat_id=userchat_id).annotate(
+        username=F('user__user__username')).order_by('timestamp', 'id')
+    return Export(f'chat-{userchat_id}', ['id', 'timestamp', 'username', 'message'], messages)
+
+
+def csv_safe(value):
+    # spreadsheets run cells starting with these as formulas
+    if isinstance(value, str) and value.startswith(('=', '+', '-', '@', '\t', '\r')):
+        return "'" + value
+    return value
+
+
+class Encoder:
+    """
+    Turns rows into chunks of bytes in the given format. write() returns
+    a chunk once about BUFFER_SIZE bytes have been buffered, else b''.
+    """
+
+    def __init__(self, fields, format='csv', compress=False):
+        self.fields = fields
+        self.format = format
+        self.rows = 0
+        self.buffer = io.StringIO()
+        self.compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+        if format == 'csv':
+            self.writer = csv.writer(self.buffer)
+            self.writer.writerow(fields)
+
+    def write(self, row):
+        self.rows += 1
+        if self.format == 'csv':
+            self.writer.writerow([csv_safe(row[field]) for field in self.fields])
+        else:
+            self.buffer.write(json.dumps({field: row[field] for field in self.fields}, cls=DjangoJSONEncoder))
+            self.buffer.write('\n')
+        if self.buffer.tell() < BUFFER_SIZE:
+            return b''
+        return self.drain()
+
+    def drain(self):
+        data = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return self.compressor.compress(data) if self.compressor else data
+
+    def close(self):
+        data = self.drain()
+        return data + self.compressor.flush() if self.compressor else data
+
+
+def stream(export, encoder):
+    for row in export.rows():
+        chunk = encoder.write(row)
+        if chunk:
+            yield chunk
+    yield encoder.close()
+
+
+async def astream(export, encoder):
+    async for row in export.arows():
+        chunk = encoder.write(row)
+        if chunk:
+            yield chunk
+    yield encoder.close()
+
+
+def export_response(request, export):
+    """
+    Stream export as an attachment in the ?format= of the request, gzipped
+    if the client accepts it. Meant for async views: under ASGI, Django
+    would read a sync iterator into memory before sending it.
+    """
+    format = request.GET.get('format', 'csv')
+    if format not in FORMATS:
+        return HttpResponseBadRequest('Unknown format')
+    # the body is read after the view has returned, without the request's
+    # routing state, so the querysets keep the database they were routed to
+    export.using(export.querysets[0].db)
+    compress = bool(re.search(r'\bgzip\b', request.headers.get('Accept-Encoding', '')))
+    encoder = Encoder(export.fields, format, compress)
+    response = StreamingHttpResponse(astream(export, encoder), content_type=FORMATS[format])
+    response['Content-Disposition'] = f'attachment; filename="{export.name}.{format}"'
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -0,0 +1,195 @@
+"""
+Serves static files and uploads straight from the ASGI server, in front of
+Django, so photo-heavy pages do not tie up a Django worker per image.
+
+Files are sent with the ASGI zero-copy send extension when the server offers
+it, and otherwise read in chunks off the event loop. Conditional GETs are
+answered from the ETag and Last-Modified headers, and single byte ranges are
+supported. Files whose name changes with their content (hashed static files,
+content-addressed uploads and their renditions) may be cached forever.
+"""
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=3600'
+CHUNK_SIZE = 256 * 1024
+
+# ManifestStaticFilesStorage names: css/base.0123456789ab.css
+HASHED_STATIC = re.compile(r'\.[0-9a-f]{12}\.[^/.]+$')
+# see mainapp/storage.py and mainapp/images.py
+CONTENT_ADDRESSED_MEDIA = re.compile(r'^(renditions/)?cas/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}')
+INCOMING_MEDIA = 'cas/incoming/'
+
+
+def is_hashed_static(name):
+    return bool(HASHED_STATIC.search(name))
+
+
+def is_content_addressed_media(name):
+    return bool(CONTENT_ADDRESSED_MEDIA.match(name)) and not is_incoming_media(name)
+
+
+def is_incoming_media(name):
+    """Uploads still being written, before they are moved to their content address."""
+    return name.startswith(INCOMING_MEDIA)
+
+
+def nothing_hidden(name):
+    return False
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single `bytes=` range, end inclusive; None to send
+    the whole file (no usable range); False when it cannot be satisfied.
+    """
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header or '')
+    if not match or match.group(1) == match.group(2) == '':
+        # several ranges or garbage: sending everything is allowed
+        return None
+    first, last = match.groups()
+    if first == '':
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+class FileServer:
+    """
+    ASGI application answering GET and HEAD requests under each mount's URL
+    prefix from its directory, and passing everything else, including files
+    that do not exist, on to application.
+
+    mounts holds (url prefix, directory, immutable, hidden) tuples, immutable
+    and hidden being functions telling from a file's relative name if it may
+    be cached forever, and if it must not be served at all.
+    """
+
+    def __init__(self, application, mounts):
+        self.application = application
+        self.mounts = [(prefix, os.fspath(root), immutable, hidden)
+                       for prefix, root, immutable, hidden in mounts if prefix and root]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            for prefix, root, immutable, hidden in self.mounts:
+                if scope['path'].startswith(prefix):
+                    name = scope['path'][len(prefix):]
+                    # stat() can block on a slow or network disk
+                    found = await asyncio.get_running_loop().run_in_executor(None, self.find, root, name, hidden)
+                    if found is not None:
+                        return await self.serve(scope, send, *found, immutable(name))
+                    break
+        return await self.application(scope, receive, send)
+
+    def find(self, root, name, hidden):
+        try:
+            path = safe_join(root, name)
+        except (SuspiciousFileOperation, ValueError):
+            return None
+        # checked on the normalized name, so cas//incoming or cas/x/../incoming do not get around it
+        if hidden(os.path.relpath(path, os.path.abspath(root)).replace(os.sep, '/')):
+            return None
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(stat_result.st_mode):
+            return None
+        return path, stat_result
+
+    async def serve(self, scope, send, path, stat_result, immutable):
+        request_headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+        size = stat_result.st_size
+        modified = int(stat_result.st_mtime)
+        etag = quote_etag(f'{stat_result.st_mtime_ns:x}-{size:x}')
+        content_type, encoding = mimetypes.guess_type(path)
+        headers = [
+            (b'content-type', (content_type or 'application/octet-stream').encode()),
+            (b'accept-ranges', b'bytes'),
+            (b'etag', etag.encode()),
+            (b'last-modified', http_date(modified).encode()),
+            (b'cache-control', (IMMUTABLE if immutable else REVALIDATE).encode()),
+            (b'x-content-type-options', b'nosniff'),
+        ]
+        if encoding:
+            headers.append((b'content-encoding', encoding.encode()))
+
+        if self.not_modified(request_headers, etag, modified):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body'})
+            return
+
+        status, start, end = 200, 0, size - 1
+        if 'range' in request_headers and self.if_range_matches(request_headers.get('if-range'), etag, modified):
+            byte_range = parse_range(request_headers['range'], size)
+            if byte_range is False:
+                headers.append((b'content-range', f'bytes */{size}'.encode()))
+                await send({'type': 'http.response.start', 'status': 416, 'headers': headers})
+                await send({'type': 'http.response.body'})
+                return
+            if byte_range is not None:
+                status, (start, end) = 206, byte_range
+                headers.append((b'content-range', f'bytes {start}-{end}/{size}'.encode()))
+        length = end - start + 1 if size else 0
+        headers.append((b'content-length', str(length).encode()))
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if scope['method'] == 'HEAD' or length == 0:
+            await send({'type': 'http.response.body'})
+            return
+        with open(path, 'rb') as file:
+            if 'http.response.zerocopysend' in (scope.get('extensions') or {}):
+                await send({'type': 'http.response.zerocopysend', 'file': file, 'offset': start, 'count': length})
+                return
+            loop = asyncio.get_running_loop()
+            offset, remaining = start, length
+            while remaining:
+                chunk = await loop.run_in_executor(None, os.pread, file.fileno(), min(CHUNK_SIZE, remaining), offset)
+                if not chunk:
+                    # truncated while being sent
+                    break
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': bool(remaining)})
+            if remaining:
+                await send({'type': 'http.response.body'})
+
+    def not_modified(self, request_headers, etag, modified):
+        if 'if-none-match' in request_headers:
+            tags = [tag.strip().removeprefix('W/') for tag in request_headers['if-none-match'].split(',')]
+            return '*' in tags or etag in tags
+        since = parse_http_date_safe(request_headers.get('if-modified-since', ''))
+        return since is not None and modified <= since
+
+    def if_range_matches(self, if_range, etag, modified):
+        if if_range is None:
+            return True
+        if if_range.startswith(('"', 'W/')):
+            return if_range == etag
+        return parse_http_date_safe(if_range) == modified
+
+
+def serve_files(application):
+    """Put a FileServer for STATIC_ROOT and MEDIA_ROOT in front of application if SERVE_FILES is on."""
+    if not settings.SERVE_FILES:
+        return application
+    return FileServer(application, [
+        (settings.STATIC_URL, settings.STATIC_ROOT, is_hashed_static, nothing_hidden),
+        (settings.MEDIA_URL, settings.MEDIA_ROOT, is_content_addressed_media, is_incoming_media),
+    ])
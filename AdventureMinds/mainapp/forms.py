@@ -138,6 +138,50 @@ class AddTripForm(forms.ModelForm):
         return trip
 
 
+class PreloadedChoiceField(forms.ModelChoiceField):
+    """A ModelChoiceField picking from a dict of objects by pk, so validating many forms does not query per form."""
+
+    def __init__(self, objects, **kwargs):
+        self.objects = objects
+        super().__init__(queryset=None, **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.objects[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+
+class TripImportForm(AddTripForm):
+    """
+    AddTripForm's rules for a row of a bulk import. Photos are files on the
+    server, checked by mainapp/imports.py, and the place is one of the
+    places preloaded for the chunk of rows.
+    """
+    photos = None
+
+    class Meta(AddTripForm.Meta):
+        fields = [field for field in AddTripForm.Meta.fields if field != 'photos']
+
+    def __init__(self, *args, places, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['place'] = PreloadedChoiceField(places, label='Place')
+
+    def _get_validation_exclusions(self):
+        # the place was just loaded, model validation would query it again
+        exclusions = super()._get_validation_exclusions()
+        exclusions.add('place')
+        return exclusions
+
+
+class PlaceImportForm(forms.ModelForm):
+    class Meta:
+        model = Place
+        fields = ['name', 'address', 'description']
+
+
 class TripPreferenceForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
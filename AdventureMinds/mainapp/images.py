@@ -0,0 +1,159 @@
+import logging
+import multiprocessing
+import posixpath
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+
+from . import caching, imaging
+
+logger = logging.getLogger(__name__)
+
+# Boxes the renditions are fitted into. Templates pick one with {% picture %}.
+RENDITIONS = {
+    'thumbnail': (160, 160),
+    'card': (640, 480),
+    'full': (1600, 1600),
+}
+
+# Image field of every model that gets renditions. Each of these models also
+# has image_width, image_height and image_renditions fields.
+IMAGE_FIELDS = {
+    'mainapp.TripPhoto': 'photo',
+    'mainapp.UserProfile': 'profile_photo',
+    'mainapp.BlogPost': 'image',
+}
+
+# Cached page sections (see caching.py) showing each model's images.
+CACHE_SECTIONS = {
+    'mainapp.TripPhoto': 'trip',
+    'mainapp.UserProfile': 'trip',
+    'mainapp.BlogPost': 'blogpost',
+}
+
+_dispatcher = None
+_pool = None
+
+
+def image_field(instance):
+    return getattr(instance, IMAGE_FIELDS[instance._meta.label])
+
+
+def needs_processing(instance):
+    image = image_field(instance)
+    return bool(image) and instance.image_renditions.get('source') != image.name
+
+
+def rendition_name(source, name, extension):
+    """renditions/<source path without extension>/<name>.<extension>"""
+    return posixpath.join(rendition_directory(source), f'{name}.{extension}')
+
+
+def rendition_directory(source):
+    return posixpath.join('renditions', posixpath.splitext(source)[0])
+
+
+def delete_renditions(storage, source):
+    directory = rendition_directory(source)
+    if not storage.exists(directory):
+        return
+    for filename in storage.listdir(directory)[1]:
+        storage.delete(posixpath.join(directory, filename))
+
+
+def process_later(instances):
+    """
+    Queue renditions for the images of instances once the current
+    transaction commits, so the request that uploaded them does not wait.
+    """
+    jobs = [(instance._meta.label, instance.pk) for instance in instances if needs_processing(instance)]
+    for label, pk in jobs:
+        transaction.on_commit(partial(_submit, label, pk))
+
+
+def _submit(label, pk):
+    if settings.IMAGE_PIPELINE_WORKERS == 0:
+        process(label, pk)
+        return
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = ThreadPoolExecutor(max_workers=settings.IMAGE_PIPELINE_WORKERS,
+                                         thread_name_prefix='image-pipeline')
+    _dispatcher.submit(_process_in_thread, label, pk)
+
+
+def _process_in_thread(label, pk):
+    try:
+        process(label, pk)
+    except Exception:
+        logger.exception('Could not process the image of %s %s', label, pk)
+    finally:
+        close_old_connections()
+
+
+def _render(data):
+    """Encode the renditions in a worker process, or inline without workers."""
+    global _pool
+    webp = imaging.webp_supported()
+    if settings.IMAGE_PIPELINE_WORKERS == 0:
+        return imaging.render(data, RENDITIONS, webp)
+    if _pool is None:
+        # spawned rather than forked: the parent runs threads and an event loop
+        _pool = ProcessPoolExecutor(max_workers=settings.IMAGE_PIPELINE_WORKERS,
+                                    mp_context=multiprocessing.get_context('spawn'))
+    return _pool.submit(imaging.render, data, RENDITIONS, webp).result()
+
+
+def process(label, pk):
+    """Render, store and record the renditions of one instance's image."""
+    model = apps.get_model(label)
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not needs_processing(instance):
+        return
+    field = IMAGE_FIELDS[label]
+    image = image_field(instance)
+    source = image.name
+    # uploads are stored by content, so the same photo may already be processed
+    done = (model.objects.filter(**{field: source}, image_renditions__source=source)
+            .values('image_width', 'image_height', 'image_renditions').first())
+    if done is not None:
+        model.objects.filter(pk=pk, **{field: source}).update(**done)
+        caching.invalidate(CACHE_SECTIONS[label])
+        return
+
+    with image.storage.open(source, 'rb') as upload:
+        result = _render(upload.read())
+
+    renditions = {'source': source}
+    for name, rendition in result['renditions'].items():
+        files = {}
+        for extension, content in rendition['files'].items():
+            path = rendition_name(source, name, 'jpg' if extension == 'jpeg' else extension)
+            if image.storage.exists(path):
+                image.storage.delete(path)
+            files[extension] = image.storage.save(path, ContentFile(content))
+        renditions[name] = {'width': rendition['width'], 'height': rendition['height'], 'files': files}
+
+    # only if the image was not replaced in the meantime
+    updated = model.objects.filter(pk=pk, **{field: source}).update(
+        image_width=result['width'], image_height=result['height'], image_renditions=renditions)
+    if updated:
+        caching.invalidate(CACHE_SECTIONS[label])
+
+
+def rendition(instance, name):
+    """(url, webp url or None, width, height) of a rendition, or the original while it is processed."""
+    image = image_field(instance)
+    if not image:
+        return None
+    rendition = instance.image_renditions.get(name) if instance.image_renditions.get('source') == image.name else None
+    if rendition is None:
+        return image.url, None, instance.image_width, instance.image_height
+    files = rendition['files']
+    webp = image.storage.url(files['webp']) if 'webp' in files else None
+    return image.storage.url(files['jpeg']), webp, rendition['width'], rendition['height']
+
@@ -0,0 +1,152 @@
+"""
+Pillow side of the image pipeline (see images.py).
+
+Runs in worker processes, so it only depends on Pillow: it gets the
+uploaded bytes and gives back the encoded renditions.
+"""
+import io
+import struct
+
+from PIL import ExifTags, Image, ImageOps, features
+
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+JPEG_SOI = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# JPEG segments an upload keeps: JFIF (APP0), ICC profile (APP2), Adobe
+# colour transform (APP14) and everything that is not an APPn or comment
+JPEG_KEPT_APP_SEGMENTS = {0xe0, 0xe2, 0xee}
+# PNG chunks dropped from an upload: EXIF and text metadata
+PNG_METADATA_CHUNKS = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+
+
+def webp_supported():
+    return features.check('webp')
+
+
+def _flatten(image):
+    """RGB copy of image, with any transparency composited onto white."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _encode(image, image_format, **options):
+    buffer = io.BytesIO()
+    # only pixels are written: no EXIF, GPS, ICC or comment blocks from the upload
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def render(data, sizes, webp=True):
+    """
+    Resize and recompress an uploaded image.
+
+    sizes maps a rendition name to the (width, height) box it must fit in;
+    images are never enlarged. Returns the upright size of the original and,
+    for each rendition, its size and its JPEG (and WebP) encoding.
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        original.seek(0)
+        image = ImageOps.exif_transpose(original)
+        image.load()
+
+    result = {'width': image.width, 'height': image.height, 'renditions': {}}
+    for name, box in sizes.items():
+        resized = image.copy()
+        resized.thumbnail(box, Image.LANCZOS)
+        flat = _flatten(resized)
+        files = {'jpeg': _encode(flat, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)}
+        if webp:
+            if resized.mode not in ('RGB', 'RGBA'):
+                resized = resized.convert('RGBA' if resized.mode in ('LA', 'P') else 'RGB')
+            files['webp'] = _encode(resized, 'WEBP', quality=WEBP_QUALITY, method=4)
+        result['renditions'][name] = {'width': resized.width, 'height': resized.height, 'files': files}
+    return result
+
+
+def strip_metadata(data):
+    """
+    Remove EXIF (GPS position included), XMP, IPTC and comments from an
+    uploaded JPEG or PNG without recompressing it. A JPEG keeps its EXIF
+    orientation, so it is still shown the right way up. Anything else, or
+    anything that does not parse, is returned as it is.
+    """
+    try:
+        if data.startswith(JPEG_SOI):
+            return _strip_jpeg(data)
+        if data.startswith(PNG_SIGNATURE):
+            return _strip_png(data)
+    except (IndexError, ValueError, struct.error):
+        pass
+    return data
+
+
+def _orientation_segment(data):
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            orientation = image.getexif().get(ExifTags.Base.Orientation)
+    except (OSError, SyntaxError, ValueError):
+        return b''
+    if orientation not in range(2, 9):
+        return b''
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = orientation
+    payload = exif.tobytes()
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def _strip_jpeg(data):
+    segments = [JPEG_SOI]
+    position = len(JPEG_SOI)
+    while True:
+        if data[position] != 0xff:
+            raise ValueError('not a JPEG marker')
+        while data[position] == 0xff:  # markers may be padded with fill bytes
+            position += 1
+        marker = data[position]
+        position += 1
+        if marker == 0xda:  # start of scan: the compressed image follows, copied as it is
+            segments.append(b'\xff\xda' + data[position:])
+            break
+        if marker == 0xd9:  # end of image before any scan
+            segments.append(b'\xff\xd9' + data[position:])
+            break
+        if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            segments.append(bytes((0xff, marker)))
+            continue
+        length, = struct.unpack('>H', data[position:position + 2])
+        segment = data[position - 2:position + length]
+        position += length
+        if len(segment) != length + 2:
+            raise ValueError('truncated JPEG segment')
+        if marker == 0xfe or (0xe0 <= marker <= 0xef and marker not in JPEG_KEPT_APP_SEGMENTS):
+            continue
+        if marker == 0xe2 and not segment[4:].startswith(b'ICC_PROFILE'):
+            continue
+        segments.append(segment)
+    # the orientation goes after the JFIF header, which has to come first
+    at = 2 if len(segments) > 1 and segments[1].startswith(b'\xff\xe0') else 1
+    segments.insert(at, _orientation_segment(data))
+    return b''.join(segments)
+
+
+def _strip_png(data):
+    chunks = [PNG_SIGNATURE]
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length, = struct.unpack('>I', data[position:position + 4])
+        chunk_type = data[position + 4:position + 8]
+        end = position + 12 + length
+        if end > len(data):
+            raise ValueError('truncated PNG chunk')
+        if chunk_type not in PNG_METADATA_CHUNKS:
+            chunks.append(data[position:end])
+        position = end
+        if chunk_type == b'IEND':
+            break
+    return b''.join(chunks)
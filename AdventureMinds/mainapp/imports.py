@@ -0,0 +1,358 @@
+"""
+Bulk import of places and trips from CSV or JSON Lines files.
+
+Files are parsed as they are read and imported CHUNK_SIZE rows at a time.
+Each chunk is validated with the rules of the forms people use (AddTripForm
+for trips) in a fixed number of queries, the photos of its valid trips are
+copied into storage by COPY_WORKERS threads, and its records are written
+with a few bulk_create calls in one transaction together with the progress
+of the ImportRun. Importing a file again after a run stopped part way
+carries on with the first chunk that was not committed.
+
+Invalid rows are skipped and reported with their number, 1 being the first
+row after the CSV header, and their errors by field.
+
+Places: name, address, description.
+Trips: title, place (a place id) or place_name (and place_address when
+places share a name), start_date, end_date, description, meeting_point,
+max_capacity, cost_per_person, organizer (a username), preferences
+("category:value" or choice ids) and photos (paths under
+IMPORT_PHOTO_ROOT). In CSV files, list items are separated with "|".
+"""
+import csv
+import hashlib
+import io
+import itertools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django import forms
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils._os import safe_join
+
+from . import caching, images, search
+from .forms import AddTripForm, PlaceImportForm, TripImportForm
+from .models import ImportRun, Place, PreferenceChoice, StoredFile, Trip, TripPhoto, TripPreference
+from .recommendations import trip_index
+from .storage import acquire
+from .utils import invalidate_calendar
+
+CHUNK_SIZE = 500
+COPY_WORKERS = 8
+LIST_SEPARATOR = '|'
+FORMATS = ('csv', 'jsonl')
+
+
+class BulkImportError(Exception):
+    """An import that cannot be run; the message is shown to the user."""
+
+
+def file_format(name, format=None):
+    format = format or os.path.splitext(name)[1].lstrip('.').lower()
+    if format not in FORMATS:
+        raise BulkImportError(f'Cannot tell the format of {name}, it should be one of {", ".join(FORMATS)}.')
+    return format
+
+
+def file_digest(file):
+    digest = hashlib.sha256()
+    for block in iter(partial(file.read, 1024 * 1024), b''):
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def read_rows(file, format):
+    """
+    Yield (number, row) for the rows of a binary file, row being a dict, or
+    a ValueError for a line that is not a JSON object.
+    """
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    try:
+        if format == 'csv':
+            yield from enumerate(csv.DictReader(text), 1)
+            return
+        lines = (line for line in text if line.strip())
+        for number, line in enumerate(lines, 1):
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield number, ValueError(f'Not valid JSON: {error}')
+                continue
+            yield number, row if isinstance(row, dict) else ValueError('Not a JSON object.')
+    finally:
+        # leave the file open for whoever passed it in
+        text.detach()
+
+
+def as_list(value):
+    if value in (None, ''):
+        return []
+    if isinstance(value, list):
+        return [str(item).strip() for item in value]
+    return [item.strip() for item in str(value).split(LIST_SEPARATOR) if item.strip()]
+
+
+def row_error(number, errors):
+    return {'row': number, 'errors': errors}
+
+
+def form_errors(form):
+    return {field: list(messages) for field, messages in form.errors.items()}
+
+
+def describe(error):
+    """One line for one of the errors an import reports."""
+    problems = ' '.join(' '.join(messages) if field == '__all__' else f'{field}: {" ".join(messages)}'
+                         for field, messages in error['errors'].items())
+    return f"Row {error['row']}: {problems}"
+
+
+class PlaceImporter:
+    kind = 'places'
+
+    def prepare(self, rows):
+        """(valid, errors) for a chunk of rows, valid holding unsaved places."""
+        valid, errors, seen = [], [], set()
+        candidates = []
+        for number, row in rows:
+            if isinstance(row, Exception):
+                errors.append(row_error(number, {'__all__': [str(row)]}))
+                continue
+            form = PlaceImportForm(row)
+            if not form.is_valid():
+                errors.append(row_error(number, form_errors(form)))
+                continue
+            candidates.append((number, form.save(commit=False)))
+
+        # places already there, from an earlier file or further up this one
+        existing = set(Place.objects.filter(name__in={place.name for _, place in candidates}).values_list(
+            'name', 'address'))
+        for number, place in candidates:
+            key = (place.name, place.address)
+            if key in existing or key in seen:
+                errors.append(row_error(number, {'__all__': [f'{place.name} at {place.address} already exists.']}))
+                continue
+            seen.add(key)
+            valid.append(place)
+        return valid, errors
+
+    def write(self, places):
+        Place.objects.bulk_create(places)
+        # new places have no trips to reindex
+        transaction.on_commit(partial(caching.invalidate, 'place'))
+
+
+class TripRow:
+    def __init__(self, number, trip, choice_ids, photos):
+        self.number = number
+        self.trip = trip
+        self.choice_ids = choice_ids
+        self.photos = photos  # full paths, then stored names once copied
+
+
+class TripImporter:
+    """Imports trips organized by the row's organizer, or organizer when a row has none."""
+    kind = 'trips'
+
+    def __init__(self, organizer=None, photo_root=None):
+        self.organizer = organizer
+        self.photo_root = os.fspath(photo_root or settings.IMPORT_PHOTO_ROOT)
+        self.photo_field = AddTripForm.base_fields['photos']
+        self.choices = {}
+        for choice in PreferenceChoice.objects.select_related('category'):
+            self.choices[str(choice.pk)] = choice.pk
+            self.choices[f'{choice.category.name}:{choice.value}'.lower()] = choice.pk
+
+    def prepare(self, rows):
+        """(valid, errors) for a chunk of rows, valid holding TripRows with their photos copied."""
+        parsed, errors = [], []
+        for number, row in rows:
+            if isinstance(row, Exception):
+                errors.append(row_error(number, {'__all__': [str(row)]}))
+            else:
+                parsed.append((number, row))
+
+        # what the rows refer to, a query or two for the whole chunk
+        usernames = {row['organizer'] for _, row in parsed if row.get('organizer')}
+        organizers = {user.username: user for user in User.objects.filter(username__in=usernames)}
+        place_ids = {str(row['place']) for _, row in parsed if row.get('place')}
+        places = Place.objects.in_bulk([pk for pk in place_ids if pk.isdigit()])
+        places_by_name = {}
+        for place in Place.objects.filter(name__in={row['place_name'] for _, row in parsed if row.get('place_name')}):
+            places_by_name.setdefault(place.name, []).append(place)
+            places[place.pk] = place
+
+        candidates = []
+        for number, row in parsed:
+            problems = {}
+            organizer = organizers.get(row.get('organizer')) if row.get('organizer') else self.organizer
+            if organizer is None:
+                problems['organizer'] = [f"No user is called {row['organizer']}." if row.get('organizer')
+                                         else 'Name the organizer of the trip.']
+            data = dict(row, place=self.find_place(row, places_by_name, problems))
+            choice_ids = self.find_choices(row, problems)
+            photos = self.find_photos(row, problems)
+            form = TripImportForm(data, user=organizer, places=places)
+            if not form.is_valid():
+                # the messages above say more than the form's "This field is required."
+                problems = {**form_errors(form), **problems}
+            if problems:
+                errors.append(row_error(number, problems))
+            else:
+                candidates.append(TripRow(number, form.save(commit=False), choice_ids, photos))
+
+        valid = []
+        copied = self.copy_photos({path for candidate in candidates for path in candidate.photos})
+        for candidate in candidates:
+            failed = [f'{os.path.relpath(path, self.photo_root)}: {copied[path]}' for path in candidate.photos
+                      if isinstance(copied[path], Exception)]
+            if failed:
+                # photos of the row that were copied are collected by collect_media
+                errors.append(row_error(candidate.number, {'photos': failed}))
+                continue
+            candidate.photos = [copied[path] for path in candidate.photos]
+            valid.append(candidate)
+        return valid, errors
+
+    def find_place(self, row, places_by_name, problems):
+        if row.get('place') or not row.get('place_name'):
+            return row.get('place')
+        matches = [place for place in places_by_name.get(row['place_name'], [])
+                   if not row.get('place_address') or place.address == row['place_address']]
+        if len(matches) == 1:
+            return matches[0].pk
+        problems['place'] = [f"No place is called {row['place_name']}." if not matches else
+                             f"Several places are called {row['place_name']}, give the place_address or place id."]
+        return None
+
+    def find_choices(self, row, problems):
+        choice_ids, unknown = set(), []
+        for choice in as_list(row.get('preferences')):
+            if choice.lower() in self.choices:
+                choice_ids.add(self.choices[choice.lower()])
+            else:
+                unknown.append(choice)
+        if unknown:
+            problems['preferences'] = [f'Unknown preferences: {", ".join(unknown)}.']
+        return choice_ids
+
+    def find_photos(self, row, problems):
+        field = self.photo_field
+        names, paths, messages = as_list(row.get('photos')), [], []
+        if not field.min_num <= len(names) <= field.max_num:
+            messages.append(f'Give between {field.min_num} and {field.max_num} photos.')
+        for name in names:
+            try:
+                path = safe_join(self.photo_root, name)
+                size = os.path.getsize(path)
+            except (SuspiciousFileOperation, ValueError):
+                messages.append(f'{name}: not under the photo directory.')
+                continue
+            except OSError:
+                messages.append(f'{name}: no such file.')
+                continue
+            if size > field.maximum_file_size:
+                messages.append(f'{name}: larger than {field.maximum_file_size // 1024 // 1024} MB.')
+            paths.append(path)
+        if messages:
+            problems['photos'] = messages
+        return paths
+
+    def copy_photos(self, paths):
+        """Copy each file into storage, side by side. Maps paths to stored names, or to the error."""
+        paths = list(paths)
+        with ThreadPoolExecutor(COPY_WORKERS) as executor:
+            return dict(zip(paths, executor.map(self.copy_photo, paths)))
+
+    def copy_photo(self, path):
+        field = TripPhoto._meta.get_field('photo')
+        try:
+            with open(path, 'rb') as file:
+                # the checks of an uploaded image: a format Pillow reads, with a matching extension
+                photo = forms.ImageField().clean(File(file, name=os.path.basename(path)))
+                return field.storage.save(field.generate_filename(None, photo.name), photo,
+                                          max_length=field.max_length)
+        except forms.ValidationError as error:
+            return ValueError(' '.join(error.messages))
+        except OSError as error:
+            return error
+
+    def write(self, rows):
+        preferences = TripPreference.objects.bulk_create([TripPreference() for _ in rows])
+        through = TripPreference.preferences.through
+        through.objects.bulk_create([
+            through(trippreference_id=preference.pk, preferencechoice_id=choice_id)
+            for preference, row in zip(preferences, rows) for choice_id in row.choice_ids])
+        for preference, row in zip(preferences, rows):
+            row.trip.preferences = preference
+        trips = Trip.objects.bulk_create([row.trip for row in rows])
+        photos = TripPhoto.objects.bulk_create([TripPhoto(trip=row.trip, photo=name) for row in rows
+                                                for name in row.photos])
+        # bulk_create sends no signals: count the files, queue the renditions
+        # and update the indexes and caches here
+        acquire(StoredFile, *[photo.photo.name for photo in photos])
+        images.process_later(photos)
+        transaction.on_commit(partial(
+            trip_index.add_trips, {trip.pk: trip.preferences_id for trip in trips},
+            {preference.pk: row.choice_ids for preference, row in zip(preferences, rows)}))
+        if search.is_available():
+            transaction.on_commit(partial(search.index_trips, Trip.objects.filter(pk__in=[trip.pk for trip in trips])))
+        if trips:
+            transaction.on_commit(partial(invalidate_calendar, min(trip.start_date for trip in trips),
+                                          max(trip.end_date for trip in trips)))
+        transaction.on_commit(partial(caching.invalidate, 'trip'))
+
+
+def run_import(importer, file, name, format=None, user=None, restart=False, progress=None):
+    """
+    Import the rows of a binary file with importer, carrying on after the
+    last chunk an earlier run of the same file committed, or from the first
+    row if restart is set. progress, if given, is called with the run after
+    each chunk. Returns the run, whose errors are those of all the rows of
+    the file imported so far.
+    """
+    format = file_format(name, format)
+    run, created = ImportRun.objects.get_or_create(kind=importer.kind, digest=file_digest(file),
+                                                   defaults={'name': name, 'started_by': user})
+    if restart and not created:
+        ImportRun.objects.filter(pk=run.pk).update(rows_done=0, imported=0, errors=[], finished_at=None)
+        run.refresh_from_db()
+    elif run.finished_at:
+        raise BulkImportError(f'{run.name} was imported on {run.finished_at:%Y-%m-%d %H:%M}; '
+                              f'restart the import to add its rows again.')
+
+    reader = read_rows(file, format)
+    rows = itertools.islice(reader, run.rows_done, None)
+    try:
+        while chunk := list(itertools.islice(rows, CHUNK_SIZE)):
+            valid, chunk_errors = importer.prepare(chunk)
+            chunk_errors.sort(key=lambda error: error['row'])
+            with transaction.atomic():
+                # claim the chunk first: two runs of one file cannot both commit it
+                if not ImportRun.objects.filter(pk=run.pk, rows_done=run.rows_done).update(
+                        rows_done=run.rows_done + len(chunk), imported=F('imported') + len(valid),
+                        errors=run.errors + chunk_errors):
+                    raise BulkImportError(f'{run.name} is being imported by someone else.')
+                importer.write(valid)
+            run.rows_done += len(chunk)
+            run.imported += len(valid)
+            run.errors += chunk_errors
+            if progress:
+                progress(run)
+    except (UnicodeDecodeError, csv.Error) as error:
+        raise BulkImportError(f'{name} cannot be read after row {run.rows_done}: {error}')
+    finally:
+        reader.close()
+
+    run.finished_at = timezone.now()
+    ImportRun.objects.filter(pk=run.pk).update(finished_at=run.finished_at)
+    return run
@@ -0,0 +1,106 @@
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import JoinRequest, Trip
+
+# Every step starts by writing, with an UPDATE or DELETE that only matches
+# while the state it expects still holds, so two requests racing for the same
+# request or the last seat cannot both win. On SQLite that first write also
+# takes the database lock for the rest of the transaction; on other databases
+# the conditional UPDATE of the trip row serializes seat changes.
+
+
+class JoinError(Exception):
+    """A join workflow step that cannot be done; the message is shown to the user."""
+
+
+def _take_seat(trip_id):
+    return Trip.objects.filter(pk=trip_id, participant_count__lt=F('max_capacity')).update(
+        participant_count=F('participant_count') + 1) == 1
+
+
+def _free_seat(trip_id):
+    Trip.objects.filter(pk=trip_id, participant_count__gt=0).update(participant_count=F('participant_count') - 1)
+
+
+def request_to_join(trip, user):
+    if trip.uploader_id == user.pk:
+        raise JoinError("You are organizing this trip.")
+    if trip.participants.filter(pk=user.pk).exists():
+        raise JoinError("You are already part of this trip.")
+    try:
+        with transaction.atomic():
+            # a declined user may ask again; their old request goes back to pending
+            if JoinRequest.objects.filter(trip=trip, user=user, status='declined').update(
+                    status='pending', timestamp=timezone.now()):
+                return JoinRequest.objects.get(trip=trip, user=user)
+            return JoinRequest.objects.create(trip=trip, user=user, status='pending')
+    except IntegrityError:
+        # the unique constraint on (trip, user) catches double submissions
+        raise JoinError("You have already requested to join this trip.")
+
+
+def accept(trip_id, request_id):
+    """
+    Accept a pending request. The user joins the trip if it has a free seat
+    and is put on its waitlist otherwise. Returns the request's new status.
+    """
+    with transaction.atomic():
+        if not JoinRequest.objects.filter(pk=request_id, trip_id=trip_id, status='pending').update(status='accepted'):
+            raise JoinError("This request has already been answered.")
+        join_request = JoinRequest.objects.get(pk=request_id)
+        if not _take_seat(trip_id):
+            JoinRequest.objects.filter(pk=request_id).update(status='waitlisted')
+            return 'waitlisted'
+        Trip(pk=trip_id).participants.add(join_request.user_id)
+        return 'accepted'
+
+
+def decline(trip_id, request_id):
+    if not JoinRequest.objects.filter(pk=request_id, trip_id=trip_id, status__in=['pending', 'waitlisted']).update(
+            status='declined'):
+        raise JoinError("This request has already been answered.")
+
+
+def leave(trip_id, user):
+    """Take user off the trip and give their seat to the first user on the waitlist."""
+    with transaction.atomic():
+        # the request goes too, so they can ask to join again later
+        JoinRequest.objects.filter(trip_id=trip_id, user=user).delete()
+        trip = Trip(pk=trip_id)
+        if not trip.participants.filter(pk=user.pk).exists():
+            raise JoinError("You are not part of this trip.")
+        trip.participants.remove(user)
+        _free_seat(trip_id)
+        return promote_waitlist(trip_id)
+
+
+def promote_waitlist(trip_id):
+    """Move waitlisted users onto the trip, first come first served, while it has free seats."""
+    promoted = []
+    with transaction.atomic():
+        waitlist = JoinRequest.objects.filter(trip_id=trip_id, status='waitlisted').order_by('timestamp', 'id')
+        for join_request in waitlist:
+            if not JoinRequest.objects.filter(pk=join_request.pk, status='waitlisted').update(status='accepted'):
+                continue
+            if not _take_seat(trip_id):
+                JoinRequest.objects.filter(pk=join_request.pk).update(status='waitlisted')
+                break
+            Trip(pk=trip_id).participants.add(join_request.user_id)
+            promoted.append(join_request)
+    return promoted
+
+
+def recount(trip_model, trip_ids=None, using=DEFAULT_DB_ALIAS):
+    """
+    Recompute participant_count from the participants, for trips changed
+    outside this module (e.g. in the admin).
+    """
+    trips = trip_model.objects.using(using)
+    if trip_ids is not None:
+        trips = trips.filter(pk__in=trip_ids)
+    counts = (trip_model.participants.through.objects.using(using).filter(trip_id=OuterRef('pk'))
+              .order_by().values('trip_id').annotate(count=Count('*')).values('count'))
+    return trips.update(participant_count=Coalesce(Subquery(counts), 0))
@@ -0,0 +1,63 @@
+import posixpath
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from mainapp import images, storage
+from mainapp.models import StoredFile
+
+
+def walk(directory):
+    """Names of all files under directory in the default storage."""
+    if not default_storage.exists(directory):
+        return
+    directories, files = default_storage.listdir(directory)
+    for name in files:
+        yield posixpath.join(directory, name)
+    for name in directories:
+        yield from walk(posixpath.join(directory, name))
+
+
+class Command(BaseCommand):
+    help = ('Delete stored uploads no image uses any more, with their renditions, '
+            'and uploads that were never saved to an image.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--recount', action='store_true',
+                            help='Recompute the reference counts from the images first.')
+        parser.add_argument('--grace', type=int, default=settings.MEDIA_COLLECT_GRACE_PERIOD,
+                            help='Keep unused files written to in the last GRACE seconds.')
+        parser.add_argument('--dry-run', action='store_true', help='Only list what would be deleted.')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if options['recount']:
+            image_fields = [(apps.get_model(label), field) for label, field in images.IMAGE_FIELDS.items()]
+            used = storage.recount(StoredFile, image_fields, using=using)
+            self.stdout.write(f'{used} stored files are in use.')
+
+        in_use = set(StoredFile.objects.using(using).filter(references__gt=0).values_list('name', flat=True))
+        cutoff = timezone.now() - timedelta(seconds=options['grace'])
+        collected, freed = [], 0
+        for name in walk(storage.PREFIX):
+            if name in in_use or default_storage.get_modified_time(name) > cutoff:
+                continue
+            freed += default_storage.size(name)
+            collected.append(name)
+            if not options['dry_run']:
+                # half-written uploads under incoming/ have no renditions
+                if storage.is_content_addressed(name):
+                    images.delete_renditions(default_storage, name)
+                default_storage.delete(name)
+            self.stdout.write(f'  {name}')
+
+        if not options['dry_run']:
+            StoredFile.objects.using(using).filter(name__in=collected, references=0).delete()
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(collected)} unused files, {freed / 1024 / 1024:.1f} MiB.'))
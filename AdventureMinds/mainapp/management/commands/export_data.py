@@ -0,0 +1,55 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from mainapp import exports
+from mainapp.models import Trip
+
+
+class Command(BaseCommand):
+    help = ('Write all trips, the roster of a trip or the transcript of a chat as CSV or JSON Lines, '
+            'reading and writing a chunk at a time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('what', choices=['trips', 'roster', 'chat'])
+        parser.add_argument('--trip', type=int, help='Trip whose roster to export.')
+        parser.add_argument('--chat', type=int, help='UserChat whose transcript to export.')
+        parser.add_argument('--organizer', help='Only export trips organized by this username.')
+        parser.add_argument('--format', choices=list(exports.FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip.')
+        parser.add_argument('--output', '-o', help='File to write to, standard output by default.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        what = options['what']
+        if what == 'trips':
+            trips = Trip.objects.all()
+            if options['organizer']:
+                if not User.objects.using(options['database']).filter(username=options['organizer']).exists():
+                    raise CommandError(f"No user is called {options['organizer']}.")
+                trips = trips.filter(uploader__username=options['organizer'])
+            export = exports.trips_export(trips)
+        elif what == 'roster':
+            if options['trip'] is None:
+                raise CommandError('Pass the trip whose roster to export with --trip.')
+            export = exports.roster_export(options['trip'])
+        else:
+            if options['chat'] is None:
+                raise CommandError('Pass the chat whose transcript to export with --chat.')
+            export = exports.transcript_export(options['chat'])
+        export.using(options['database'])
+
+        encoder = exports.Encoder(export.fields, options['format'], options['gzip'])
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in exports.stream(export, encoder):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
+            else:
+                output.flush()
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(f"Exported {encoder.rows} rows to {options['output']}."))
@@ -0,0 +1,46 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from mainapp import imports
+
+
+class Command(BaseCommand):
+    help = ('Import places or trips from a CSV or JSON Lines file. Running it again for a file that was '
+            'not imported to the end carries on where it stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['places', 'trips'])
+        parser.add_argument('file')
+        parser.add_argument('--format', choices=imports.FORMATS, help='Taken from the file extension by default.')
+        parser.add_argument('--organizer', help='Username of the organizer of trips whose row names none.')
+        parser.add_argument('--photos', help='Directory photo paths are relative to, IMPORT_PHOTO_ROOT by default.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Import the file from its first row, even if it was imported before.')
+
+    def handle(self, *args, **options):
+        if options['kind'] == 'places':
+            importer = imports.PlaceImporter()
+        else:
+            organizer = None
+            if options['organizer']:
+                organizer = User.objects.filter(username=options['organizer']).first()
+                if organizer is None:
+                    raise CommandError(f"No user is called {options['organizer']}.")
+            importer = imports.TripImporter(organizer, options['photos'])
+
+        try:
+            with open(options['file'], 'rb') as file:
+                run = imports.run_import(importer, file, os.path.basename(options['file']), options['format'],
+                                         restart=options['restart'], progress=self.report)
+        except (OSError, imports.BulkImportError) as error:
+            raise CommandError(error)
+
+        for error in run.errors:
+            self.stderr.write(imports.describe(error))
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {run.imported} of {run.rows_done} rows from {run.name}, {len(run.errors)} with errors.'))
+
+    def report(self, run):
+        self.stdout.write(f'{run.rows_done} rows read, {run.imported} imported.')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from mainapp import ratings
+from mainapp.models import Place, Rating
+
+
+class Command(BaseCommand):
+    help = 'Recompute the rating count, total and histogram stored on every place from its ratings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        count = ratings.recount(Place, Rating, using=options['database'])
+        self.stdout.write(self.style.SUCCESS(f'Recounted ratings of {count} places.'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from mainapp import search
+
+
+class Command(BaseCommand):
+    help = 'Repopulate the SQLite FTS5 trip search table from trips and places.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if not search.is_available(using):
+            raise CommandError('Full-text search requires an SQLite database.')
+        search.rebuild(using)
+        self.stdout.write(self.style.SUCCESS('Rebuilt trip search index.'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mainapp.recommendations import trip_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the trip preference index used for recommendations, or check it against the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Only compare the published index with the database, do not rebuild it.')
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            stale = trip_index.verify()
+            if stale:
+                raise CommandError(f'{len(stale)} trip(s) out of sync: {", ".join(map(str, stale))}')
+            self.stdout.write(self.style.SUCCESS('Trip preference index is consistent.'))
+            return
+
+        trip_index.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt trip preference index: {len(trip_index.trips)} trips, '
+            f'{len(trip_index.preferences)} preference sets.'))
@@ -0,0 +1,204 @@
+import logging
+import time
+import tracemalloc
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import Template
+
+logger = logging.getLogger('mainapp.metrics')
+
+# Most SQL queries a request to each URL name in mainapp/urls.py may run.
+# Going over is logged as a warning at runtime and raises QueryBudgetExceeded
+# under settings.REQUEST_METRICS_ENFORCE_BUDGETS, which is on in the tests.
+QUERY_BUDGETS = {
+    'homepage': 8,
+    'trip_list': 8,
+    'trip_feed': 4,
+    'trip_feed_cards': 4,
+    'trip_detail': 9,
+    'user_trip_history': 5,
+    'wishlist': 4,
+    'calendar': 4,
+    'messages': 6,
+    'message_history': 5,
+    'unread_counts': 4,
+    'getusers': 1,
+    'create_group': 4,
+    'blog_list': 4,
+    'blog_post_detail': 3,
+    'place_detail': 3,
+    'terms_conditions': 2,
+}
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class RequestMetrics:
+    """What one request cost: SQL queries and their time, template rendering and memory."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = []
+        self.query_time = 0.0
+        self.template_time = 0.0
+        self.peak_memory = None
+        self.total_time = 0.0
+
+    @property
+    def query_count(self):
+        return len(self.queries)
+
+    def server_timing(self):
+        return ', '.join([
+            f'db;dur={self.query_time * 1000:.1f};desc="{self.query_count} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'total;dur={self.total_time * 1000:.1f}',
+        ])
+
+    def over_budget(self, url_name, budget):
+        """Describe the request as over its query budget, listing every query it ran."""
+        queries = '\n'.join(f'{number}. {sql}' for number, sql in enumerate(self.queries, start=1))
+        return f'{url_name} ran {self.query_count} queries, its budget is {budget}:\n{queries}'
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.query_time += time.perf_counter() - started
+        metrics.queries.append(sql)
+
+
+def instrument_connection(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def _timed_render(render):
+    def timed_render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return render(self, context, request)
+        started = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - started
+    timed_render.instrumented = True
+    return timed_render
+
+
+def install():
+    """
+    Record queries on every connection and time template rendering.
+
+    The recorders only do anything inside a request the middleware is
+    measuring, which it marks with a context variable. Context variables
+    follow the request into sync_to_async threads, so queries an async view
+    runs are counted as well.
+    """
+    connection_created.connect(instrument_connection, dispatch_uid='mainapp.metrics')
+    for connection in connections.all(initialized_only=True):
+        instrument_connection(connection)
+    if not getattr(Template.render, 'instrumented', False):
+        Template.render = _timed_render(Template.render)
+
+
+class RequestMetricsMiddleware:
+    """
+    Measures each request and reports it in a log line on the
+    mainapp.metrics logger, and as X-Query-Count and Server-Timing headers
+    when settings.REQUEST_METRICS_HEADERS is on.
+
+    Peak memory is only traced with settings.REQUEST_METRICS_TRACE_MEMORY,
+    since tracemalloc slows every allocation down; it is measured process
+    wide, so it is only meaningful for one request at a time.
+
+    With settings.REQUEST_METRICS_ENFORCE_BUDGETS a request that goes over
+    its QUERY_BUDGETS entry raises QueryBudgetExceeded instead of only
+    being logged, so the test that made it fails.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.trace_memory = getattr(settings, 'REQUEST_METRICS_TRACE_MEMORY', False)
+        self.headers = getattr(settings, 'REQUEST_METRICS_HEADERS', settings.DEBUG)
+        self.enforce_budgets = getattr(settings, 'REQUEST_METRICS_ENFORCE_BUDGETS', False)
+        install()
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        metrics, token = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, token = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def start(self):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        metrics = RequestMetrics()
+        return metrics, _current.set(metrics)
+
+    def finish(self, request, response, metrics):
+        metrics.total_time = time.perf_counter() - metrics.started
+        if self.trace_memory:
+            metrics.peak_memory = tracemalloc.get_traced_memory()[1]
+
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        budget = QUERY_BUDGETS.get(url_name)
+        over_budget = budget is not None and metrics.query_count > budget
+        level = logging.WARNING if over_budget else logging.INFO
+        logger.log(level, '%s %s [%s] %s queries in %.1fms, templates %.1fms, total %.1fms%s',
+                   request.method, request.path, url_name, metrics.query_count, metrics.query_time * 1000,
+                   metrics.template_time * 1000, metrics.total_time * 1000,
+                   f', peak memory {metrics.peak_memory / 1024:.0f}KiB' if metrics.peak_memory is not None else '')
+        if over_budget and self.enforce_budgets:
+            raise QueryBudgetExceeded(metrics.over_budget(url_name, budget))
+
+        if self.headers:
+            response['X-Query-Count'] = str(metrics.query_count)
+            response['Server-Timing'] = metrics.server_timing()
+        response.metrics = metrics
+        return response
+
+
+class QueryBudgetMixin:
+    """For TestCases: check a response against QUERY_BUDGETS for its URL name."""
+
+    def assertWithinQueryBudget(self, response, budget=None):
+        url_name = response.resolver_match.url_name
+        if budget is None:
+            self.assertIn(url_name, QUERY_BUDGETS, f'No query budget for {url_name}')
+            budget = QUERY_BUDGETS[url_name]
+        if response.metrics.query_count > budget:
+            self.fail(response.metrics.over_budget(url_name, budget))
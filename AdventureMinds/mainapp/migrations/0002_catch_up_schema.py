@@ -0,0 +1,317 @@
+# Generated by Django 4.2.11 on 2026-10-18 13:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class ForInitialSchema(migrations.SeparateDatabaseAndState):
+    """
+    Operations that bring a database created by 0001_initial up to date with
+    the models. The db.sqlite3 shipped with the project records 0001_initial
+    as applied but already has these tables and columns, so on a database
+    without the initial migration's mainapp_thread table only the migration
+    state changes.
+    """
+
+    def __init__(self, operations):
+        super().__init__(database_operations=operations, state_operations=operations)
+
+    def deconstruct(self):
+        return self.__class__.__name__, [self.database_operations], {}
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if 'mainapp_thread' in schema_editor.connection.introspection.table_names():
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def describe(self):
+        return 'Bring the tables of 0001_initial up to date'
+
+
+def rebuild_table(schema_editor, model, columns, select):
+    """Recreate model's table as the model describes it, filled with the rows of select."""
+    quote = schema_editor.quote_name
+    table = model._meta.db_table
+    columns = ', '.join(quote(column) for column in columns)
+    schema_editor.execute(f'CREATE TEMP TABLE "rebuild_rows" AS {select}')
+    schema_editor.execute(f'DROP TABLE {quote(table)}')
+    schema_editor.create_model(model)
+    schema_editor.execute(f'INSERT INTO {quote(table)} ({columns}) SELECT {columns} FROM "rebuild_rows"')
+    schema_editor.execute('DROP TABLE "rebuild_rows"')
+
+
+def repair_shipped_tables(apps, schema_editor):
+    """
+    In the shipped db.sqlite3 reviews belong to places instead of trips and
+    ratings have a created_at column the models never had. Each review moves
+    to the first trip to its place; reviews of places without trips go.
+    """
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        review_columns = {column.name for column in connection.introspection.get_table_description(cursor, 'mainapp_review')}
+        rating_columns = {column.name for column in connection.introspection.get_table_description(cursor, 'mainapp_rating')}
+    if 'place_id' in review_columns:
+        rebuild_table(
+            schema_editor, apps.get_model('mainapp', 'Review'), ['id', 'review', 'created_at', 'trip_id', 'user_id'],
+            'SELECT review.id, review.review, review.created_at, first_trip.trip_id, review.user_id '
+            'FROM "mainapp_review" review JOIN (SELECT "place_id", MIN("id") AS trip_id FROM "mainapp_trip" '
+            'GROUP BY "place_id") first_trip ON first_trip.place_id = review.place_id',
+        )
+    if 'created_at' in rating_columns:
+        rebuild_table(
+            schema_editor, apps.get_model('mainapp', 'Rating'), ['id', 'rating', 'place_id', 'user_id'],
+            'SELECT "id", "rating", "place_id", "user_id" FROM "mainapp_rating"',
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mainapp', '0001_initial'),
+    ]
+
+    operations = [
+        ForInitialSchema([
+            migrations.CreateModel(
+                name='ChatGroup',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('name', models.CharField(max_length=100)),
+                ],
+            ),
+            migrations.CreateModel(
+                name='ContactMessage',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('first_name', models.CharField(max_length=100)),
+                    ('last_name', models.CharField(max_length=100)),
+                    ('email', models.EmailField(max_length=254)),
+                    ('message', models.TextField()),
+                    ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ],
+            ),
+            migrations.CreateModel(
+                name='JoinRequest',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('status', models.CharField(choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('declined', 'Declined')], default='pending', max_length=10)),
+                    ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ],
+            ),
+            migrations.CreateModel(
+                name='Rating',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('rating', models.PositiveIntegerField(choices=[(1, '1 star'), (2, '2 star'), (3, '3 star'), (4, '4 star'), (5, '5 star')])),
+                ],
+            ),
+            migrations.CreateModel(
+                name='Review',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('review', models.TextField()),
+                    ('created_at', models.DateTimeField(auto_now_add=True)),
+                ],
+            ),
+            migrations.CreateModel(
+                name='UserChat',
+                fields=[
+                    ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ],
+            ),
+            migrations.RemoveField(
+                model_name='chatmessage',
+                name='thread',
+            ),
+            # the profile's primary key becomes user_id; re-pointed below
+            migrations.RemoveField(
+                model_name='userpreferences',
+                name='user_profile',
+            ),
+            migrations.RemoveField(
+                model_name='userprofile',
+                name='id',
+            ),
+            migrations.AlterField(
+                model_name='userprofile',
+                name='user',
+                field=models.OneToOneField(blank=True, default=None, on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL),
+            ),
+            migrations.AddField(
+                model_name='userpreferences',
+                name='user_profile',
+                field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='user_profile', to='mainapp.userprofile'),
+            ),
+            migrations.RemoveField(
+                model_name='userprofile',
+                name='interested_places',
+            ),
+            migrations.AddField(
+                model_name='chatmessage',
+                name='read',
+                field=models.BooleanField(default=False),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='cost_per_person',
+                field=models.DecimalField(decimal_places=2, default=1000, max_digits=8),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='created_at',
+                field=models.DateTimeField(default=django.utils.timezone.now),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='is_future',
+                field=models.BooleanField(default=True),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='is_past',
+                field=models.BooleanField(default=False),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='max_capacity',
+                field=models.PositiveIntegerField(default=10),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='meeting_point',
+                field=models.CharField(blank=True, max_length=255),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='participants',
+                field=models.ManyToManyField(blank=True, related_name='participating_trips', to=settings.AUTH_USER_MODEL),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='title',
+                field=models.CharField(max_length=100, null=True),
+            ),
+            migrations.AddField(
+                model_name='trip',
+                name='updated_at',
+                field=models.DateTimeField(auto_now=True, null=True),
+            ),
+            migrations.AddField(
+                model_name='userprofile',
+                name='profile_photo',
+                field=models.ImageField(blank=True, null=True, upload_to='profile/'),
+            ),
+            migrations.AlterField(
+                model_name='chatmessage',
+                name='user',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.userprofile'),
+            ),
+            migrations.AlterField(
+                model_name='place',
+                name='description',
+                field=models.TextField(blank=True, max_length=1000),
+            ),
+            migrations.AlterField(
+                model_name='trip',
+                name='uploader',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploaded_trips', to=settings.AUTH_USER_MODEL),
+            ),
+            migrations.AddField(
+                model_name='userchat',
+                name='first_person',
+                field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='userchat_first_person', to='mainapp.userprofile'),
+            ),
+            migrations.AddField(
+                model_name='userchat',
+                name='group',
+                field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='mainapp.chatgroup'),
+            ),
+            migrations.AddField(
+                model_name='userchat',
+                name='second_person',
+                field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='userchat_second_person', to='mainapp.userprofile'),
+            ),
+            migrations.AddField(
+                model_name='review',
+                name='trip',
+                field=models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, to='mainapp.trip'),
+            ),
+            migrations.AddField(
+                model_name='review',
+                name='user',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+            ),
+            migrations.AddField(
+                model_name='rating',
+                name='place',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.place'),
+            ),
+            migrations.AddField(
+                model_name='rating',
+                name='user',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+            ),
+            migrations.AddField(
+                model_name='joinrequest',
+                name='trip',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='join_requests', to='mainapp.trip'),
+            ),
+            migrations.AddField(
+                model_name='joinrequest',
+                name='user',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+            ),
+            migrations.AddField(
+                model_name='chatgroup',
+                name='members',
+                field=models.ManyToManyField(to='mainapp.userprofile'),
+            ),
+            migrations.AddField(
+                model_name='chatmessage',
+                name='userchat',
+                field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='chatmessage_userchat', to='mainapp.userchat'),
+            ),
+            migrations.AlterUniqueTogether(
+                name='userchat',
+                unique_together={('first_person', 'second_person', 'group')},
+            ),
+            migrations.AlterUniqueTogether(
+                name='rating',
+                unique_together={('user', 'place')},
+            ),
+            migrations.DeleteModel(
+                name='Thread',
+            ),
+        ]),
+        migrations.RunPython(repair_shipped_tables, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='BlogPost',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255)),
+                ('content', models.TextField()),
+                ('image', models.ImageField(blank=True, null=True, upload_to='blog_images/')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('display_content', models.TextField()),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('place', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.place')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Wishlist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('notes', models.TextField(blank=True, null=True)),
+                ('priority', models.IntegerField(default=1)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('trip_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='wishlist_items', to='mainapp.trip')),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.userprofile')),
+            ],
+            options={
+                'unique_together': {('user_id', 'trip_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:41
+
+from django.db import migrations, models
+from django.db.models import Max
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def seed_read_cursors(apps, schema_editor):
+    """Start every participant's cursor at the last message others sent that was flagged as read."""
+    UserChat = apps.get_model('mainapp', 'UserChat')
+    ChatMessage = apps.get_model('mainapp', 'ChatMessage')
+    ChatReadCursor = apps.get_model('mainapp', 'ChatReadCursor')
+    db_alias = schema_editor.connection.alias
+
+    cursors = []
+    for userchat in UserChat.objects.using(db_alias).select_related('group'):
+        if userchat.group_id:
+            participants = list(userchat.group.members.values_list('pk', flat=True))
+        else:
+            participants = [pk for pk in (userchat.first_person_id, userchat.second_person_id) if pk]
+        read_messages = ChatMessage.objects.using(db_alias).filter(userchat=userchat, read=True)
+        for participant in participants:
+            last_read = read_messages.exclude(user_id=participant).aggregate(last=Max('id'))['last']
+            if last_read:
+                cursors.append(ChatReadCursor(userchat=userchat, user_id=participant, last_read_message_id=last_read))
+    ChatReadCursor.objects.using(db_alias).bulk_create(cursors)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0002_catch_up_schema'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_cursors', to='mainapp.userprofile')),
+                ('userchat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='mainapp.userchat')),
+            ],
+            options={
+                'unique_together': {('userchat', 'user')},
+            },
+        ),
+        migrations.RunPython(seed_read_cursors, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='chatmessage',
+            name='read',
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0003_chat_read_cursor'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='blogpost',
+            index=models.Index(fields=['created_at'], name='blogpost_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['userchat', 'timestamp', 'id'], name='chatmessage_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='joinrequest',
+            index=models.Index(fields=['trip', 'user'], name='joinrequest_trip_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='joinrequest',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['trip', 'timestamp'], name='joinrequest_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(fields=['place', 'rating'], name='rating_place_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['start_date', 'end_date'], name='trip_dates_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['created_at', 'id'], name='trip_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wishlist',
+            index=models.Index(fields=['user_id', 'date_added'], name='wishlist_user_added_idx'),
+        ),
+    ]
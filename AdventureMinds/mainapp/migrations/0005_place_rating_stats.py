@@ -0,0 +1,67 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:48
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_ratings(apps, schema_editor):
+    using = schema_editor.connection.alias
+    Place = apps.get_model('mainapp', 'Place')
+    Rating = apps.get_model('mainapp', 'Rating')
+
+    def aggregate(function, **filters):
+        ratings = Rating.objects.using(using).filter(place_id=OuterRef('pk'), **filters)
+        return Coalesce(Subquery(ratings.order_by().values('place_id').annotate(value=function).values('value')), 0)
+
+    Place.objects.using(using).update(
+        rating_count=aggregate(Count('*')),
+        rating_total=aggregate(Sum('rating')),
+        **{f'rating_{stars}': aggregate(Count('*'), rating=stars) for stars in range(1, 6)},
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0004_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='place',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='rating_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_ratings, migrations.RunPython.noop),
+    ]
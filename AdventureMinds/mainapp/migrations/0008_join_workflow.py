@@ -0,0 +1,48 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:59
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def prepare_join_requests(apps, schema_editor):
+    using = schema_editor.connection.alias
+    JoinRequest = apps.get_model('mainapp', 'JoinRequest')
+    # keep the latest of duplicate requests, which the new constraint forbids
+    latest = (JoinRequest.objects.using(using).values('trip_id', 'user_id').order_by()
+              .annotate(latest=Max('id')).values('latest'))
+    JoinRequest.objects.using(using).exclude(id__in=list(latest)).delete()
+    # participant_count starts out from the participants already on each trip
+    Trip = apps.get_model('mainapp', 'Trip')
+    counts = (Trip.participants.through.objects.using(using).filter(trip_id=OuterRef('pk'))
+              .order_by().values('trip_id').annotate(count=Count('*')).values('count'))
+    Trip.objects.using(using).update(participant_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0007_stored_file'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='joinrequest',
+            name='joinrequest_trip_user_idx',
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='joinrequest',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('waitlisted', 'Waitlisted'), ('declined', 'Declined')], default='pending', max_length=10),
+        ),
+        migrations.RunPython(prepare_join_requests, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='joinrequest',
+            constraint=models.UniqueConstraint(fields=('trip', 'user'), name='joinrequest_unique_trip_user'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations
+
+# The FTS5 table mainapp/search.py queries: one document per trip (rowid =
+# trip id) with a copy of its place. Databases that had it created by an
+# earlier version of the app get it rebuilt from scratch.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0009_import_run'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                'DROP TABLE IF EXISTS mainapp_trip_search',
+                "CREATE VIRTUAL TABLE mainapp_trip_search USING fts5(title, description, place_name, place_address, "
+                "place_description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4')",
+                'INSERT INTO mainapp_trip_search (rowid, title, description, place_name, place_address, place_description) '
+                'SELECT trip.id, COALESCE(trip.title, \'\'), trip.description, place.name, place.address, place.description '
+                'FROM mainapp_trip trip JOIN mainapp_place place ON place.id = trip.place_id',
+            ],
+            reverse_sql='DROP TABLE mainapp_trip_search',
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def set_journal_mode(apps, schema_editor):
+    # only mainapp.backends.sqlite3 asks for one; SQLite keeps it in the file,
+    # so it holds for every later connection (in-memory databases answer "memory")
+    journal_mode = getattr(schema_editor.connection, 'journal_mode', None)
+    if journal_mode:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA journal_mode = {journal_mode}')
+
+
+class Migration(migrations.Migration):
+    # the journal mode cannot be changed inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('mainapp', '0010_trip_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_journal_mode, migrations.RunPython.noop),
+    ]
@@ -5,18 +5,72 @@ from django.contrib.auth.models import User, AbstractUser
 from django.core.exceptions import ValidationError
 
 
+class LoadedValuesMixin:
+    """
+    Remembers the field values an instance was loaded or last saved with, so
+    the pre_save signal handlers can see what a save changes without first
+    reading the old row back (see signals.py).
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        loaded = getattr(self, '_loaded_values', {}) if update_fields is not None else {}
+        for field in self._meta.concrete_fields:
+            # deferred fields are not in __dict__, and reading them would load them
+            if field.attname in self.__dict__ and (update_fields is None or field.name in update_fields):
+                loaded[field.attname] = field.get_prep_value(field.value_from_object(self))
+        self._loaded_values = loaded
+
+    def previous_values(self, *attnames):
+        """
+        What the given fields held in the database before this save, as a
+        tuple, or None if there is no such row. Only read from the database
+        when the instance was built by hand or loaded without them.
+        """
+        if self.pk is None:
+            return None
+        loaded = getattr(self, '_loaded_values', {})
+        if not self._state.adding and all(attname in loaded for attname in attnames):
+            return tuple(loaded[attname] for attname in attnames)
+        return type(self)._base_manager.filter(pk=self.pk).values_list(*attnames).first()
+
+
 # Create your models here.
 class Place(models.Model):
     name = models.CharField(max_length=100)
     address = models.CharField(max_length=300)
     description = models.TextField(max_length=1000, blank=True)
+    # rating statistics, kept up to date by the Rating signals in signals.py
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_total = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
 
 
     def __str__(self):
         return self.name
 
+    @property
+    def average_rating(self):
+        return round(self.rating_total / self.rating_count, 1) if self.rating_count else None
+
+    @property
+    def rating_histogram(self):
+        """(stars, count) from 5 stars down to 1."""
+        return [(stars, getattr(self, f'rating_{stars}')) for stars in range(5, 0, -1)]
+
 
-class UserProfile(models.Model):
+class UserProfile(LoadedValuesMixin, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, null=False, blank=True, primary_key=True, default=None)
     phone_number = models.CharField(max_length=12, null=True, blank=True)
     address = models.CharField(max_length=200, null=True, blank=True)
@@ -24,6 +78,10 @@ class UserProfile(models.Model):
     profile_photo = models.ImageField(upload_to='profile/', null=True, blank=True)
     # interested_places = models.ManyToManyField(Place, null=True, blank=True)
     preferences = models.ForeignKey('UserPreferences', on_delete=models.SET_NULL, null=True, blank=True)
+    # filled in by the image pipeline, see images.py
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return self.user.username
@@ -60,7 +118,7 @@ class UserPreferences(models.Model):
         return [preference.value for preference in self.preferences.all()]
 
 
-class Trip(models.Model):
+class Trip(LoadedValuesMixin, models.Model):
     uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploaded_trips')
     title = models.CharField(max_length=100, null=True)
     description = models.TextField()
@@ -73,9 +131,28 @@ class Trip(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True, blank=True, null=True)
     participants = models.ManyToManyField(User, related_name='participating_trips', blank=True)
+    # kept by mainapp/joins.py, which only adds participants while it is below max_capacity
+    participant_count = models.PositiveIntegerField(default=0, editable=False)
     is_past = models.BooleanField(default=False)
     is_future = models.BooleanField(default=True)
     preferences = models.ForeignKey(TripPreference, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # date overlap lookups (calendar, trip history)
+            models.Index(fields=['start_date', 'end_date'], name='trip_dates_idx'),
+            # keyset pagination of the trip feed, newest first
+            models.Index(fields=['created_at', 'id'], name='trip_created_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # participant_count is only changed by the conditional UPDATEs in
+        # mainapp/joins.py; saving a trip must not write back a stale count
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name != 'participant_count']
+        super().save(*args, **kwargs)
+
     # Define methods to filter past and future trips
     def get_past_trips(self):
         return Trip.objects.filter(pk=self.pk, is_past=True)
@@ -86,9 +163,13 @@ class Trip(models.Model):
     def _str_(self):
         return self.title
 
-class TripPhoto(models.Model):
+class TripPhoto(LoadedValuesMixin, models.Model):
     trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='trip_photos')
     photo = models.ImageField(upload_to='')
+    # filled in by the image pipeline, see images.py
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         return f"Photo for {self.trip.place}"
@@ -100,11 +181,22 @@ class JoinRequest(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('accepted', 'Accepted'),
+        ('waitlisted', 'Waitlisted'),
         ('declined', 'Declined'),
     ]
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['trip', 'user'], name='joinrequest_unique_trip_user'),
+        ]
+        indexes = [
+            # only pending requests are listed for the organizer
+            models.Index(fields=['trip', 'timestamp'], name='joinrequest_pending_idx',
+                         condition=models.Q(status='pending')),
+        ]
+
     def __str__(self):
         return f"Request to join {self.trip} by {self.user}"
 
@@ -169,8 +261,24 @@ class ChatMessage(models.Model):
                                  related_name='chatmessage_userchat')
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-    read = models.BooleanField(default=False)
+    # set when the message is created rather than when it is inserted, see chat_writer
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # chat history pages, newest first
+            models.Index(fields=['userchat', 'timestamp', 'id'], name='chatmessage_history_idx'),
+        ]
+
+
+class ChatReadCursor(models.Model):
+    # everything up to and including last_read_message_id has been read by user
+    userchat = models.ForeignKey(UserChat, on_delete=models.CASCADE, related_name='read_cursors')
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='chat_read_cursors')
+    last_read_message_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['userchat', 'user']
 
 
 class ContactMessage(models.Model):
@@ -193,7 +301,7 @@ class Review(models.Model):
         return self.user.first_name
 
 
-class Rating(models.Model):
+class Rating(LoadedValuesMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     place = models.ForeignKey(Place, on_delete=models.CASCADE)
     RATING_CHOICES = (
@@ -207,12 +315,16 @@ class Rating(models.Model):
 
     class Meta:
         unique_together = ('user', 'place')
+        indexes = [
+            # covers the per-place aggregate without reading the table
+            models.Index(fields=['place', 'rating'], name='rating_place_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user}'s {self.rating}-star rating for {self.place}"
 
 
-class BlogPost(models.Model):
+class BlogPost(LoadedValuesMixin, models.Model):
     title = models.CharField(max_length=255)
     content = models.TextField()
     author = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -220,6 +332,15 @@ class BlogPost(models.Model):
     image = models.ImageField(upload_to='blog_images/', null=True, blank=True)  # Add this line for image upload
     created_at = models.DateTimeField(default=timezone.now)
     display_content = models.TextField()
+    # filled in by the image pipeline, see images.py
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='blogpost_created_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -237,6 +358,46 @@ class Wishlist(models.Model):
 
     class Meta:
         unique_together = ('user_id', 'trip_id',)
+        indexes = [
+            models.Index(fields=['user_id', 'date_added'], name='wishlist_user_added_idx'),
+        ]
 
     def _str_(self):
-        return f"{self.user_id.user.username}'s Wishlist Item: (Trip: {self.trip_id.description})"
\ No newline at end of file
+        return f"{self.user_id.user.username}'s Wishlist Item: (Trip: {self.trip_id.description})"
+
+
+class StoredFile(models.Model):
+    # an upload kept once by mainapp.storage.ContentAddressedStorage, and how
+    # many TripPhoto, UserProfile and BlogPost images point at it
+    name = models.CharField(max_length=255, unique=True)
+    references = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.name} ({self.references})'
+
+
+class ImportRun(models.Model):
+    # progress of a bulk import of one file (see mainapp/imports.py); running
+    # the same file again carries on after the last row it got to
+    KIND_CHOICES = [
+        ('places', 'Places'),
+        ('trips', 'Trips'),
+    ]
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    digest = models.CharField(max_length=64)  # sha256 of the file
+    name = models.CharField(max_length=255)
+    started_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    imported = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'digest'], name='importrun_unique_kind_digest'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} from {self.name} ({self.rows_done} rows)'
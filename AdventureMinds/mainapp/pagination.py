@@ -0,0 +1,73 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 12
+MAX_PAGE_SIZE = 50
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(obj, field='created_at'):
+    raw = f'{getattr(obj, field).isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeError, binascii.Error):
+        raise InvalidCursor(cursor)
+
+
+def page_size_from(request, default=DEFAULT_PAGE_SIZE):
+    try:
+        page_size = int(request.GET.get('page_size', default))
+    except ValueError:
+        return default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def page_number_from(request):
+    """The 1-based ?page= of listings that cannot be served by keyset (ranked or sorted by something else)."""
+    try:
+        return max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        return 1
+
+
+def keyset_page(queryset, cursor=None, page_size=DEFAULT_PAGE_SIZE, field='created_at'):
+    """
+    Return (items, next_cursor) for the page after cursor, newest first.
+
+    Pages are selected with a (field, id) range instead of OFFSET, so every
+    page costs the same no matter how deep the client has scrolled.
+    next_cursor is None on the last page.
+    """
+    items = list(_page_queryset(queryset, cursor, page_size, field))
+    return _split_page(items, page_size, field)
+
+
+async def akeyset_page(queryset, cursor=None, page_size=DEFAULT_PAGE_SIZE, field='created_at'):
+    """keyset_page for async views."""
+    items = [item async for item in _page_queryset(queryset, cursor, page_size, field)]
+    return _split_page(items, page_size, field)
+
+
+def _page_queryset(queryset, cursor, page_size, field):
+    queryset = queryset.order_by(f'-{field}', '-id')
+    if cursor:
+        value, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk}))
+    # one extra row tells whether there is a next page
+    return queryset[:page_size + 1]
+
+
+def _split_page(items, page_size, field):
+    next_cursor = encode_cursor(items[page_size - 1], field) if len(items) > page_size else None
+    return items[:page_size], next_cursor
@@ -0,0 +1,51 @@
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Case, Count, F, FloatField, When
+from django.db.models.functions import Cast, Round
+
+STAT_FIELDS = ['rating_count', 'rating_total', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5']
+
+
+def rating_average(prefix=''):
+    """Average rating of a place as a query expression, e.g. rating_average('place__') on trips."""
+    return Case(
+        When(**{f'{prefix}rating_count': 0}, then=None),
+        default=Round(Cast(F(f'{prefix}rating_total'), FloatField()) / F(f'{prefix}rating_count'), 1),
+        output_field=FloatField(),
+    )
+
+
+def record_rating(place_model, place_id, stars, sign):
+    """Add (sign=1) or take away (sign=-1) one rating of stars from a place, in a single UPDATE."""
+    place_model.objects.filter(pk=place_id).update(**{
+        'rating_count': F('rating_count') + sign,
+        'rating_total': F('rating_total') + sign * stars,
+        f'rating_{stars}': F(f'rating_{stars}') + sign,
+    })
+
+
+def recount(place_model, rating_model, place_ids=None, using=DEFAULT_DB_ALIAS):
+    """
+    Recompute the statistics of places (all of them by default) from their
+    ratings.
+    """
+    ratings = rating_model.objects.using(using)
+    places = place_model.objects.using(using)
+    if place_ids is not None:
+        ratings = ratings.filter(place_id__in=place_ids)
+        places = places.filter(pk__in=place_ids)
+
+    histograms = defaultdict(dict)
+    for row in ratings.values('place_id', 'rating').annotate(count=Count('id')).order_by():
+        histograms[row['place_id']][row['rating']] = row['count']
+
+    places = list(places.only('pk'))
+    for place in places:
+        histogram = histograms.get(place.pk, {})
+        place.rating_count = sum(histogram.values())
+        place.rating_total = sum(stars * count for stars, count in histogram.items())
+        for stars in range(1, 6):
+            setattr(place, f'rating_{stars}', histogram.get(stars, 0))
+    place_model.objects.db_manager(using).bulk_update(places, STAT_FIELDS, batch_size=500)
+    return len(places)
@@ -0,0 +1,308 @@
+import heapq
+import threading
+import time
+
+from django.core.cache import cache
+
+from .models import Trip, TripPreference, UserPreferences
+
+
+class PreferenceMatrix:
+    """
+    Trip preferences packed as integer bitsets, one bit per PreferenceChoice.
+
+    Scoring a user against every trip is then a Jaccard pass made of
+    bitwise AND and popcounts, with no per-trip database access.
+    """
+
+    def __init__(self):
+        self.columns = {}  # PreferenceChoice id -> bit position
+        self.rows = {}  # Trip id -> bitset of its preference choices
+
+    @classmethod
+    def from_trips(cls, trips=None):
+        """Build the matrix for a Trip queryset in a single query."""
+        if trips is None:
+            trips = Trip.objects.all()
+        matrix = cls()
+        for trip_id, choice_id in trips.values_list('id', 'preferences__preferences'):
+            matrix.rows.setdefault(trip_id, 0)
+            if choice_id is not None:
+                matrix.rows[trip_id] |= matrix.bit(choice_id)
+        return matrix
+
+    def add_row(self, trip_id, choice_ids):
+        mask = 0
+        for choice_id in choice_ids:
+            mask |= self.bit(choice_id)
+        self.rows[trip_id] = mask
+
+    def bit(self, choice_id):
+        position = self.columns.get(choice_id)
+        if position is None:
+            position = self.columns[choice_id] = len(self.columns)
+        return 1 << position
+
+    def mask(self, choice_ids):
+        """
+        Return (bitset, count) for a set of choices. Choices no trip uses
+        still count towards the union but get no column.
+        """
+        mask = 0
+        choice_ids = set(choice_ids)
+        for choice_id in choice_ids:
+            position = self.columns.get(choice_id)
+            if position is not None:
+                mask |= 1 << position
+        return mask, len(choice_ids)
+
+    def scores(self, choice_ids, trip_ids=None):
+        """Jaccard similarity of the given choices against every trip, or only the trips in trip_ids."""
+        user_mask, user_count = self.mask(choice_ids)
+        rows = self.rows.items() if trip_ids is None else (
+            (trip_id, self.rows[trip_id]) for trip_id in trip_ids if trip_id in self.rows)
+        scores = {}
+        for trip_id, trip_mask in rows:
+            intersection = (user_mask & trip_mask).bit_count()
+            union = user_count + trip_mask.bit_count() - intersection
+            scores[trip_id] = intersection / union if union else 0.0
+        return scores
+
+    def top_k(self, choice_ids, k, trip_ids=None):
+        """
+        The k best matching (trip_id, score) pairs without a full sort.
+        Equal scores go to the older trip first, so consecutive pages
+        never overlap.
+        """
+        scores = self.scores(choice_ids, trip_ids)
+        return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+
+
+class TripPreferenceIndex:
+    """
+    Trip preference vectors kept up to date by the signals in mainapp.signals.
+
+    The raw state (trip -> TripPreference, TripPreference -> choices) is
+    published to the cache, one entry per version, and version_key points
+    at the latest. Every worker keeps its own PreferenceMatrix and only
+    rebuilds it when another worker has published a newer version, so with a
+    shared cache backend a warm index survives worker restarts and is never
+    reloaded from the database per request.
+
+    A change is published as the next version with cache.add, which only one
+    worker can do for a given version. A worker that loses the race loads the
+    winner's state and applies its change again on top, so concurrent changes
+    from different workers are never lost.
+    """
+    cache_key = 'mainapp:trip-preference-index'
+    version_key = 'mainapp:trip-preference-index:version'
+    # states are kept long after they are superseded: while one is in the
+    # cache no other worker can publish a different state as that version
+    state_timeout = 60 * 60 * 24
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._matrix = None
+        self.version = None
+        self.trips = {}  # Trip id -> TripPreference id (or None)
+        self.preferences = {}  # TripPreference id -> set of PreferenceChoice ids
+
+    @staticmethod
+    def load_state():
+        """Read the current trip preference state from the database (two queries)."""
+        trips = dict(Trip.objects.values_list('id', 'preferences_id'))
+        preferences = {}
+        through = TripPreference.preferences.through.objects
+        for preference_id, choice_id in through.values_list('trippreference_id', 'preferencechoice_id'):
+            preferences.setdefault(preference_id, set()).add(choice_id)
+        return trips, preferences
+
+    def rebuild(self):
+        loaded_trips, loaded_preferences = self.load_state()
+
+        def replace(trips, preferences):
+            trips.clear()
+            trips.update(loaded_trips)
+            preferences.clear()
+            preferences.update(loaded_preferences)
+        self._update(replace)
+
+    def matrix(self):
+        with self._lock:
+            self._sync()
+            if self._matrix is None:
+                matrix = PreferenceMatrix()
+                for trip_id, preference_id in self.trips.items():
+                    matrix.add_row(trip_id, self.preferences.get(preference_id, ()))
+                self._matrix = matrix
+            return self._matrix
+
+    def scores(self, choice_ids):
+        return self.matrix().scores(choice_ids)
+
+    def top_k(self, choice_ids, k, trip_ids=None):
+        return self.matrix().top_k(choice_ids, k, trip_ids)
+
+    def snapshot(self):
+        """Trip id -> frozenset of choice ids, independent of bit positions."""
+        with self._lock:
+            self._sync()
+            return {trip_id: frozenset(self.preferences.get(preference_id, ()))
+                    for trip_id, preference_id in self.trips.items()}
+
+    def verify(self):
+        """Return the ids of trips whose indexed preferences differ from the database."""
+        indexed = self.snapshot()
+        trips, preferences = self.load_state()
+        expected = {trip_id: frozenset(preferences.get(preference_id, ()))
+                    for trip_id, preference_id in trips.items()}
+        return sorted(trip_id for trip_id in indexed.keys() | expected.keys()
+                      if indexed.get(trip_id) != expected.get(trip_id))
+
+    # Incremental updates, called from signal handlers after commit. Each
+    # passes _update a change to apply to the trips and preferences dicts,
+    # which returns False when there is nothing to change.
+
+    def set_trip(self, trip_id, preference_id):
+        def change(trips, preferences):
+            if trip_id in trips and trips[trip_id] == preference_id:
+                return False
+            trips[trip_id] = preference_id
+        self._update(change)
+
+    def add_trips(self, new_trips, choices):
+        """
+        Index several new trips at once, new_trips mapping trip ids to
+        TripPreference ids and choices TripPreference ids to choice ids,
+        publishing once instead of once per trip.
+        """
+        def change(trips, preferences):
+            trips.update(new_trips)
+            for preference_id, choice_ids in choices.items():
+                preferences.setdefault(preference_id, set()).update(choice_ids)
+        self._update(change)
+
+    def remove_trip(self, trip_id):
+        def change(trips, preferences):
+            if trips.pop(trip_id, False) is False:
+                return False
+        self._update(change)
+
+    def add_choices(self, preference_id, choice_ids):
+        def change(trips, preferences):
+            preferences.setdefault(preference_id, set()).update(choice_ids)
+        self._update(change)
+
+    def remove_choices(self, preference_id, choice_ids=None):
+        """Remove some choices from a TripPreference, or all of them when choice_ids is None."""
+        def change(trips, preferences):
+            if choice_ids is None:
+                preferences.pop(preference_id, None)
+            else:
+                preferences.get(preference_id, set()).difference_update(choice_ids)
+        self._update(change)
+
+    def remove_preference(self, preference_id):
+        def change(trips, preferences):
+            preferences.pop(preference_id, None)
+            for trip_id, trip_preference_id in trips.items():
+                if trip_preference_id == preference_id:
+                    trips[trip_id] = None
+        self._update(change)
+
+    def remove_choice(self, choice_id):
+        def change(trips, preferences):
+            for choice_ids in preferences.values():
+                choice_ids.discard(choice_id)
+        self._update(change)
+
+    def state_key(self, version):
+        return f'{self.cache_key}:{version}'
+
+    def _sync(self):
+        # Only the small version key is read on the hot path; the full state
+        # is fetched when another worker has published a change.
+        version = cache.get(self.version_key)
+        if version is None:
+            # first use, or the version was evicted: start from the clock so
+            # the new versions never meet states stored under the old ones
+            cache.add(self.version_key, time.time_ns(), None)
+            version = cache.get(self.version_key)
+        if version != self.version:
+            self._load(version)
+
+    def _load(self, version):
+        state = cache.get(self.state_key(version))
+        if state is None:
+            # nothing published under this version yet, or it was evicted:
+            # every change is committed before it is published, so the
+            # database has them all
+            self.trips, self.preferences = self.load_state()
+        else:
+            self.trips, self.preferences = state['trips'], state['preferences']
+        self.version = version
+        self._matrix = None
+
+    def _update(self, change):
+        with self._lock:
+            self._sync()
+            while True:
+                if change(self.trips, self.preferences) is False:
+                    return
+                version = self.version + 1
+                state = {'trips': self.trips, 'preferences': self.preferences}
+                if cache.add(self.state_key(version), state, self.state_timeout):
+                    break
+                # another worker published this version first: apply the change to theirs
+                self._load(version)
+            self.version = version
+            self._matrix = None
+            # a worker that published a later version may have moved
+            # version_key past ours already: move it on to the latest again
+            cache.set(self.version_key, version, None)
+            while cache.get(self.state_key(version + 1)) is not None:
+                version += 1
+                cache.set(self.version_key, version, None)
+
+
+trip_index = TripPreferenceIndex()
+
+
+def user_choice_ids(user_profile):
+    if not user_profile.preferences_id:
+        return []
+    # read through the m2m table so the UserPreferences row itself is never loaded
+    through = UserPreferences.preferences.through.objects
+    return list(through.filter(userpreferences_id=user_profile.preferences_id)
+                .values_list('preferencechoice_id', flat=True))
+
+
+def recommendation_scores(user_profile, trip_ids=None):
+    """
+    Similarity of each indexed trip to the user's preferences, by trip id.
+    A handful of trip_ids, such as one page of search results, are scored
+    straight from the database in one query, so a cold index is not loaded
+    just for them.
+    """
+    choice_ids = user_choice_ids(user_profile)
+    if trip_ids is None:
+        return trip_index.scores(choice_ids)
+    return PreferenceMatrix.from_trips(Trip.objects.filter(id__in=trip_ids)).scores(choice_ids)
+
+
+def recommended_trip_ids(user_profile, limit, trip_ids=None):
+    """Ids of the limit trips best matching the user's preferences, best first, optionally only among trip_ids."""
+    return [trip_id for trip_id, score in trip_index.top_k(user_choice_ids(user_profile), limit, trip_ids)]
+
+
+def recommend_trips(user_profile, trips=None, scores=None):
+    """
+    Return the trips as a list ordered by similarity to the user's
+    preferences. scores may be passed in when recommendation_scores has
+    already been called for the user.
+    """
+    if trips is None:
+        trips = Trip.objects.all()
+    if scores is None:
+        scores = recommendation_scores(user_profile)
+    return sorted(trips, key=lambda trip: scores.get(trip.id, 0), reverse=True)
@@ -0,0 +1,121 @@
+import random
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Reads go to settings.READ_REPLICAS only inside views decorated with
+# @read_from_replica, and only until something is written: from then on the
+# request, and for REPLICA_PIN_SECONDS the visitor's next requests too, read
+# from the primary so they see their own writes while the replicas catch up.
+# Everything else, chat consumers included, only ever uses the primary.
+
+PIN_COOKIE = 'primary_pin'
+
+
+class RoutingState:
+    def __init__(self, pinned=False):
+        self.replica_reads = False
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state = ContextVar('database_routing', default=None)
+
+
+def replicas():
+    return getattr(settings, 'READ_REPLICAS', [])
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if (state is None or not state.replica_reads or state.pinned or not replicas()
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas())
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = state.pinned = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas are copies of the primary, they get its schema from it
+        return db not in replicas()
+
+
+def read_from_replica(view):
+    """Let the reads of a view go to a replica, unless the request or visitor is pinned to the primary."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            _use_replicas()
+            return await view(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        _use_replicas()
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def _use_replicas():
+    state = _state.get()
+    if state is not None:
+        state.replica_reads = True
+
+
+class PrimaryPinningMiddleware:
+    """
+    Tracks each request's routing state, and pins a visitor to the primary
+    for REPLICA_PIN_SECONDS after a request of theirs wrote, with a cookie.
+    Goes before SessionMiddleware so session writes count too.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        state, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(state, response)
+
+    async def __acall__(self, request):
+        state, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(state, response)
+
+    def start(self, request):
+        pinned_until = request.COOKIES.get(PIN_COOKIE, '')
+        state = RoutingState(pinned=pinned_until.isdigit() and int(pinned_until) > time.time())
+        return state, _state.set(state)
+
+    def finish(self, state, response):
+        if state.wrote and replicas():
+            seconds = settings.REPLICA_PIN_SECONDS
+            response.set_cookie(PIN_COOKIE, str(int(time.time() + seconds)), max_age=seconds, httponly=True,
+                                samesite='Lax')
+        return response
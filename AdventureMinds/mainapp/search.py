@@ -0,0 +1,94 @@
+import re
+from collections import namedtuple
+
+from django.db import connections, router
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import Trip
+
+# One FTS5 document per trip (rowid = trip id), holding the trip's own text
+# and a copy of its place so a single MATCH covers every searchable field.
+# The table is created by migration 0010_trip_search.
+TABLE = 'mainapp_trip_search'
+COLUMNS = ('title', 'description', 'place_name', 'place_address', 'place_description')
+# bm25 weights, in COLUMNS order
+WEIGHTS = (10.0, 1.0, 5.0, 2.0, 1.0)
+# results are returned a page at a time, so a common word never turns into
+# a query for thousands of trip ids
+PAGE_SIZE = 24
+
+# Private-use markers wrapped around matches by snippet(); the snippet is
+# escaped first and only then are these turned into <mark> tags.
+MATCH_START, MATCH_END = '\ue000', '\ue001'
+
+SearchResult = namedtuple('SearchResult', ['trip_id', 'rank', 'snippet'])
+
+
+def is_available(using='default'):
+    return connections[using].vendor == 'sqlite'
+
+
+def rebuild(using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE}")
+    index_trips(Trip.objects.using(using).all(), using)
+
+
+def index_trips(trips, using='default'):
+    rows = [
+        (trip.id, trip.title or '', trip.description, trip.place.name, trip.place.address, trip.place.description)
+        for trip in trips.select_related('place')
+    ]
+    if not rows:
+        return
+    with connections[using].cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+        cursor.executemany(
+            f"INSERT INTO {TABLE} (rowid, {', '.join(COLUMNS)}) VALUES (%s, %s, %s, %s, %s, %s)", rows
+        )
+
+
+def remove_trip(trip_id, using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [trip_id])
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query: every word must match, as a prefix."""
+    words = re.findall(r'\w+', query)
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def search_trips(query, limit=PAGE_SIZE, offset=0):
+    """Return up to limit SearchResults for the query, best match first, skipping the first offset."""
+    expression = match_expression(query)
+    if not expression:
+        return []
+    weights = ', '.join(str(weight) for weight in WEIGHTS)
+    sql = (
+        f"SELECT rowid, bm25({TABLE}, {weights}) AS rank, "
+        f"snippet({TABLE}, -1, %s, %s, '…', 12) "
+        f"FROM {TABLE} WHERE {TABLE} MATCH %s ORDER BY rank, rowid LIMIT %s OFFSET %s"
+    )
+    with connections[router.db_for_read(Trip)].cursor() as cursor:
+        cursor.execute(sql, [MATCH_START, MATCH_END, expression, limit, offset])
+        return [SearchResult(trip_id, rank, highlight(snippet)) for trip_id, rank, snippet in cursor.fetchall()]
+
+
+def highlight(snippet):
+    return mark_safe(escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>'))
+
+
+def with_snippets(trips, results, ranked=True):
+    """
+    Attach search_snippet to each trip and, when ranked is set, return them
+    in search rank order instead of the queryset's order.
+    """
+    results = {result.trip_id: result for result in results}
+    trips = list(trips)
+    for trip in trips:
+        trip.search_snippet = results[trip.id].snippet if trip.id in results else ''
+    if ranked:
+        trips.sort(key=lambda trip: results[trip.id].rank if trip.id in results else 0)
+    return trips
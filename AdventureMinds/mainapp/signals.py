@@ -0,0 +1,199 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import caching, images, joins, ratings, search, storage
+from .models import (BlogPost, Place, PreferenceChoice, Rating, Review, StoredFile, Trip, TripPhoto,
+                     TripPreference, UserProfile)
+from .recommendations import trip_index
+from .utils import invalidate_calendar
+
+
+# Keep the recommendation index in sync. Updates are applied on commit so a
+# rolled back transaction never leaks into the index.
+
+@receiver(post_save, sender=Trip)
+def index_trip(sender, instance, **kwargs):
+    transaction.on_commit(partial(trip_index.set_trip, instance.pk, instance.preferences_id))
+
+
+@receiver(post_delete, sender=Trip)
+def unindex_trip(sender, instance, **kwargs):
+    transaction.on_commit(partial(trip_index.remove_trip, instance.pk))
+
+
+@receiver(m2m_changed, sender=TripPreference.preferences.through)
+def index_trip_preference_choices(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        # instance is a TripPreference, pk_set holds PreferenceChoice ids
+        if action == 'post_add':
+            transaction.on_commit(partial(trip_index.add_choices, instance.pk, set(pk_set)))
+        elif action == 'post_remove':
+            transaction.on_commit(partial(trip_index.remove_choices, instance.pk, set(pk_set)))
+        else:
+            transaction.on_commit(partial(trip_index.remove_choices, instance.pk))
+    elif action == 'post_clear':
+        transaction.on_commit(partial(trip_index.remove_choice, instance.pk))
+    else:
+        # instance is a PreferenceChoice, pk_set holds TripPreference ids
+        update = trip_index.add_choices if action == 'post_add' else trip_index.remove_choices
+        for preference_id in pk_set:
+            transaction.on_commit(partial(update, preference_id, {instance.pk}))
+
+
+@receiver(post_delete, sender=TripPreference)
+def unindex_trip_preference(sender, instance, **kwargs):
+    transaction.on_commit(partial(trip_index.remove_preference, instance.pk))
+
+
+@receiver(post_delete, sender=PreferenceChoice)
+def unindex_preference_choice(sender, instance, **kwargs):
+    transaction.on_commit(partial(trip_index.remove_choice, instance.pk))
+
+
+# Keep the trip full-text search table in sync.
+
+@receiver(post_save, sender=Trip)
+def search_index_trip(sender, instance, **kwargs):
+    if search.is_available():
+        transaction.on_commit(partial(search.index_trips, Trip.objects.filter(pk=instance.pk)))
+
+
+@receiver(post_delete, sender=Trip)
+def search_unindex_trip(sender, instance, **kwargs):
+    if search.is_available():
+        transaction.on_commit(partial(search.remove_trip, instance.pk))
+
+
+@receiver(post_save, sender=Place)
+def search_index_place(sender, instance, created, **kwargs):
+    # a new place has no trips yet
+    if not created and search.is_available():
+        transaction.on_commit(partial(search.index_trips, Trip.objects.filter(place_id=instance.pk)))
+
+
+# What a saved trip held before, for the handlers below.
+
+@receiver(pre_save, sender=Trip)
+def remember_trip(sender, instance, **kwargs):
+    instance._previous_dates = instance._previous_capacity = None
+    previous = instance.previous_values('start_date', 'end_date', 'max_capacity')
+    if previous:
+        instance._previous_dates, instance._previous_capacity = previous[:2], previous[2]
+
+
+# Drop cached calendar months a trip was or is now part of.
+
+
+@receiver(post_save, sender=Trip)
+def invalidate_trip_calendar(sender, instance, **kwargs):
+    transaction.on_commit(partial(invalidate_calendar, instance.start_date, instance.end_date))
+    if instance._previous_dates:
+        transaction.on_commit(partial(invalidate_calendar, *instance._previous_dates))
+
+
+@receiver(post_delete, sender=Trip)
+def invalidate_deleted_trip_calendar(sender, instance, **kwargs):
+    transaction.on_commit(partial(invalidate_calendar, instance.start_date, instance.end_date))
+
+
+# A trip whose capacity was raised takes people off its waitlist.
+
+@receiver(post_save, sender=Trip)
+def fill_trip_from_waitlist(sender, instance, created, **kwargs):
+    raised = instance._previous_capacity is not None and instance.max_capacity > instance._previous_capacity
+    if not created and raised and instance.participant_count < instance.max_capacity:
+        transaction.on_commit(partial(joins.promote_waitlist, instance.pk))
+
+
+# Keep the rating statistics on Place up to date. The UPDATEs run in the
+# transaction that saves or deletes the rating, so they commit or roll back
+# with it, and use F() expressions so concurrent ratings are not lost.
+
+@receiver(pre_save, sender=Rating)
+def remember_rating(sender, instance, **kwargs):
+    instance._previous_rating = instance.previous_values('place_id', 'rating')
+
+
+@receiver(post_save, sender=Rating)
+def count_rating(sender, instance, **kwargs):
+    if instance._previous_rating == (instance.place_id, instance.rating):
+        return
+    if instance._previous_rating:
+        ratings.record_rating(Place, *instance._previous_rating, sign=-1)
+    ratings.record_rating(Place, instance.place_id, instance.rating, sign=1)
+
+
+@receiver(post_delete, sender=Rating)
+def uncount_rating(sender, instance, **kwargs):
+    ratings.record_rating(Place, instance.place_id, instance.rating, sign=-1)
+
+
+# Move cached pages and fragments showing a changed model to a new version.
+
+CACHE_SECTIONS = {
+    BlogPost: 'blogpost',
+    Place: 'place',
+    Trip: 'trip',
+    TripPhoto: 'trip',
+    Review: 'review',
+    Rating: 'rating',
+}
+
+
+def invalidate_cached_pages(sender, **kwargs):
+    transaction.on_commit(partial(caching.invalidate, CACHE_SECTIONS[sender]))
+
+
+for model in CACHE_SECTIONS:
+    post_save.connect(invalidate_cached_pages, sender=model, dispatch_uid=f'cache-{model.__name__}-save')
+    post_delete.connect(invalidate_cached_pages, sender=model, dispatch_uid=f'cache-{model.__name__}-delete')
+
+
+@receiver(m2m_changed, sender=Trip.participants.through)
+def invalidate_cached_trip_participants(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(partial(caching.invalidate, 'trip'))
+
+
+# Render resized copies of uploaded images once the upload is committed.
+
+def process_uploaded_image(sender, instance, **kwargs):
+    images.process_later([instance])
+
+
+for model in (TripPhoto, UserProfile, BlogPost):
+    post_save.connect(process_uploaded_image, sender=model, dispatch_uid=f'images-{model.__name__}')
+
+
+# Count the images using each stored upload, in the transaction saving or
+# deleting them, so unused uploads can be collected (see storage.py).
+
+def remember_stored_file(sender, instance, **kwargs):
+    field = images.IMAGE_FIELDS[sender._meta.label]
+    instance._previous_stored_file = None
+    if not instance._state.adding:
+        previous = instance.previous_values(field)
+        instance._previous_stored_file = previous[0] if previous else None
+
+
+def reference_stored_file(sender, instance, **kwargs):
+    name = images.image_field(instance).name
+    if name != instance._previous_stored_file:
+        storage.acquire(StoredFile, name)
+        storage.release(StoredFile, instance._previous_stored_file)
+
+
+def unreference_stored_file(sender, instance, **kwargs):
+    storage.release(StoredFile, images.image_field(instance).name)
+
+
+for model in (TripPhoto, UserProfile, BlogPost):
+    pre_save.connect(remember_stored_file, sender=model, dispatch_uid=f'storage-{model.__name__}-pre-save')
+    post_save.connect(reference_stored_file, sender=model, dispatch_uid=f'storage-{model.__name__}-save')
+    post_delete.connect(unreference_stored_file, sender=model, dispatch_uid=f'storage-{model.__name__}-delete')
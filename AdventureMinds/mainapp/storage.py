@@ -0,0 +1,129 @@
+import hashlib
+import os
+import posixpath
+import tempfile
+from collections import Counter, defaultdict
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F
+
+from . import imaging
+
+# Uploads are stored as cas/<2 hex>/<2 hex>/<sha256><extension>, after being
+# written to cas/incoming first.
+PREFIX = 'cas'
+INCOMING = posixpath.join(PREFIX, 'incoming')
+# Files made from a stored upload, like image renditions, keep the name they
+# are saved under; they live under the upload's path (see images.py).
+DERIVED_PREFIXES = ('renditions/',)
+# Uploads with these extensions lose their camera metadata before they are stored.
+STRIPPED_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def content_name(digest, extension):
+    return posixpath.join(PREFIX, digest[:2], digest[2:4], digest + extension.lower())
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Keeps each distinct upload once, named after the SHA-256 of its content.
+
+    The upload is hashed while it is streamed to a temporary file next to
+    the store and then moved into place, unless a file with the same content
+    is already there. The name a FileField asked for only contributes its
+    extension. JPEG and PNG uploads are stored without their EXIF, GPS
+    position included (see imaging.strip_metadata), so photos that only
+    differ in it are kept once. How many images use each stored file is
+    counted in StoredFile (see signals.py); manage.py collect_media removes
+    the unused ones, once they have not been written to for a while.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        if name.startswith(DERIVED_PREFIXES):
+            return super().get_available_name(name, max_length)
+        # the final name is only known once the content has been read
+        return name
+
+    def _save(self, name, content):
+        if name.startswith(DERIVED_PREFIXES):
+            return super()._save(name, content)
+
+        if os.path.splitext(name)[1].lower() in STRIPPED_EXTENSIONS:
+            content = ContentFile(imaging.strip_metadata(b''.join(content.chunks())))
+
+        incoming = self.path(INCOMING)
+        os.makedirs(incoming, exist_ok=True)
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=incoming, delete=False) as temporary:
+            try:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temporary.write(chunk)
+            except BaseException:
+                os.unlink(temporary.name)
+                raise
+
+        stored = content_name(digest.hexdigest(), os.path.splitext(name)[1])
+        path = self.path(stored)
+        if os.path.exists(path):
+            os.unlink(temporary.name)
+            # a fresh upload of it: keep it from being collected before it is referenced
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary.name, self.file_permissions_mode)
+            os.replace(temporary.name, path)
+        return stored
+
+
+def is_content_addressed(name):
+    return bool(name) and name.startswith(PREFIX + '/') and not name.startswith(INCOMING + '/')
+
+
+def _change_references(stored_file_model, names, sign, using):
+    counts = Counter(name for name in names if is_content_addressed(name))
+    if not counts:
+        return
+    files = stored_file_model.objects.using(using)
+    if sign > 0:
+        files.bulk_create([stored_file_model(name=name) for name in counts], ignore_conflicts=True)
+    else:
+        files = files.filter(references__gt=0)
+    by_count = defaultdict(list)
+    for name, count in counts.items():
+        by_count[count].append(name)
+    for count, names in by_count.items():
+        files.filter(name__in=names).update(references=F('references') + sign * count)
+
+
+def acquire(stored_file_model, *names, using=DEFAULT_DB_ALIAS):
+    """Count one more image using each of the stored file names, in a couple of queries."""
+    _change_references(stored_file_model, names, 1, using)
+
+
+def release(stored_file_model, *names, using=DEFAULT_DB_ALIAS):
+    """Count one image fewer using each of the stored file names."""
+    _change_references(stored_file_model, names, -1, using)
+
+
+def recount(stored_file_model, image_fields, using=DEFAULT_DB_ALIAS):
+    """
+    Recompute the references of every stored file from the images using it.
+    image_fields holds (model, field name) pairs. Returns how many files are
+    in use.
+    """
+    counts = Counter()
+    for model, field in image_fields:
+        names = model.objects.using(using).exclude(**{f'{field}__isnull': True}).exclude(**{field: ''})
+        counts.update(name for name in names.values_list(field, flat=True).iterator() if is_content_addressed(name))
+
+    files = stored_file_model.objects.using(using)
+    files.bulk_create([stored_file_model(name=name) for name in counts], ignore_conflicts=True)
+    stored = list(files.all())
+    for stored_file in stored:
+        stored_file.references = counts.get(stored_file.name, 0)
+    stored_file_model.objects.db_manager(using).bulk_update(stored, ['references'], batch_size=500)
+    return len(counts)
@@ -0,0 +1,16 @@
+from django import template
+
+from ..caching import versions
+
+register = template.Library()
+
+
+@register.simple_tag
+def cache_version(*sections):
+    """
+    Version of sections to vary a {% cache %} fragment on, e.g.
+
+        {% cache_version 'blogpost' as version %}
+        {% cache 600 blog_cards version %}...{% endcache %}
+    """
+    return versions(*sections)
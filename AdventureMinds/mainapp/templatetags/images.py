@@ -0,0 +1,35 @@
+from django import template
+from django.utils.html import format_html
+
+from .. import images
+
+register = template.Library()
+
+
+@register.simple_tag
+def picture(instance, name, css_class='', alt=''):
+    """
+    <picture> for a rendition of instance's image, offering the WebP encoding
+    to browsers that take it, e.g.
+
+        {% picture photo 'card' 'd-block w-100' 'Trip Photo' %}
+
+    Until the pipeline has processed an upload the original is shown.
+    """
+    found = images.rendition(instance, name)
+    if found is None:
+        return ''
+    url, webp_url, width, height = found
+    size = format_html(' width="{}" height="{}"', width, height) if width and height else ''
+    img = format_html('<img src="{}" class="{}" alt="{}"{} loading="lazy" decoding="async">',
+                      url, css_class, alt, size)
+    if webp_url is None:
+        return img
+    return format_html('<picture><source srcset="{}" type="image/webp">{}</picture>', webp_url, img)
+
+
+@register.simple_tag
+def rendition_url(instance, name):
+    """URL of the JPEG rendition of instance's image, for places a <picture> does not fit."""
+    found = images.rendition(instance, name)
+    return found[0] if found else ''
@@ -1,3 +1,1599 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import csv
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import posixpath
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from collections import OrderedDict
+from datetime import date, timedelta
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, connections, router, transaction
+from django.template import Context, Template
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import ExifTags, Image
+
+from . import caching, consumers, exports, fileserver, images, imports, joins, routers, search, storage, views
+from .chat_writer import ChatMessageWriter
+from .metrics import QUERY_BUDGETS, QueryBudgetExceeded, QueryBudgetMixin
+from .recommendations import PreferenceMatrix, TripPreferenceIndex, recommendation_scores, recommended_trip_ids
+from .utils import Calendar
+from .models import (BlogPost, ChatGroup, ChatMessage, ChatReadCursor, ImportRun, JoinRequest, Place,
+                     PreferenceCategory, PreferenceChoice, Rating, Review, StoredFile, Trip, TripPhoto, TripPreference,
+                     UserChat, UserPreferences, UserProfile, Wishlist)
+
+if importlib.util.find_spec('channels_redis') and importlib.util.find_spec('fakeredis'):
+    from fakeredis import TcpFakeServer
+else:
+    TcpFakeServer = None
+
+
+# Joins a channel layer group the way ChatConsumer does, then prints the
+# first message it is sent. Runs in its own interpreter, i.e. its own worker.
+CHAT_WORKER = '''
+import asyncio, os, sys
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'AdventureMinds.settings')
+django.setup()
+from channels.layers import get_channel_layer
+
+
+async def main():
+    layer = get_channel_layer()
+    channel = await layer.new_channel()
+    await layer.group_add(sys.argv[1], channel)
+    print('ready', flush=True)
+    message = await asyncio.wait_for(layer.receive(channel), 10)
+    print(message['text'], flush=True)
+
+asyncio.run(main())
+'''
+
+
+@unittest.skipIf(TcpFakeServer is None, 'channels_redis and fakeredis are required')
+class ChannelLayerAcrossWorkersTests(SimpleTestCase):
+    def setUp(self):
+        self.server = TcpFakeServer(('127.0.0.1', 0))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.url = f'redis://{host}:{port}/0'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def start_worker(self, group):
+        env = dict(os.environ, CHANNEL_LAYER_URL=self.url)
+        worker = subprocess.Popen([sys.executable, '-c', CHAT_WORKER, group], cwd=settings.BASE_DIR, env=env,
+                                  stdout=subprocess.PIPE, text=True)
+        self.addCleanup(worker.kill)
+        self.assertEqual(worker.stdout.readline().strip(), 'ready')
+        return worker
+
+    def send_from_another_worker(self, group, text):
+        from channels_redis.core import RedisChannelLayer
+
+        layer = RedisChannelLayer(hosts=[self.url])
+        asyncio.run(layer.group_send(group, {'type': 'chat_message', 'text': text}))
+
+    def test_group_message_reaches_other_workers(self):
+        workers = [self.start_worker('chatgroup_1') for _ in range(2)]
+        text = json.dumps({'message': 'hello from another worker', 'userchat_id': 1})
+
+        self.send_from_another_worker('chatgroup_1', text)
+
+        for worker in workers:
+            self.assertEqual(worker.stdout.readline().strip(), text)
+            self.assertEqual(worker.wait(timeout=10), 0)
+
+
+class ChannelLayerSettingsTests(SimpleTestCase):
+    """CHANNEL_LAYER_URL picks the layer backend, whether or not channels_redis is installed here."""
+
+    def channel_layers(self, url=None):
+        """CHANNEL_LAYERS as settings.py sets it up with the given CHANNEL_LAYER_URL, or none."""
+        environ = {key: value for key, value in os.environ.items() if key != 'CHANNEL_LAYER_URL'}
+        if url is not None:
+            environ['CHANNEL_LAYER_URL'] = url
+        spec = importlib.util.spec_from_file_location(
+            'settings_under_test', os.path.join(settings.BASE_DIR, 'AdventureMinds', 'settings.py'))
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(os.environ, environ, clear=True):
+            spec.loader.exec_module(module)
+        return module.CHANNEL_LAYERS
+
+    def test_redis_url_selects_the_redis_layer(self):
+        url = 'redis://redis.internal:6380/2'
+        self.assertEqual(self.channel_layers(url), {
+            'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [url]}},
+        })
+
+    def test_in_memory_layer_without_a_url(self):
+        for url in (None, ''):
+            with self.subTest(url=url):
+                self.assertEqual(self.channel_layers(url),
+                                 {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Every page stays within its QUERY_BUDGETS entry with several rows behind it."""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = [User.objects.create_user(f'user{i}', password='password') for i in range(4)]
+        profiles = [UserProfile.objects.create(user=user) for user in users]
+        profiles[0].preferences = UserPreferences.objects.create(user_profile=profiles[0])
+        profiles[0].save()
+        places = [Place.objects.create(name=f'Place {i}', address=f'{i} Main Street') for i in range(3)]
+
+        today = date.today()
+        for i in range(6):
+            trip = Trip.objects.create(uploader=users[i % 4], title=f'Trip {i}', description='A trip',
+                                       place=places[i % 3], start_date=today + timedelta(days=i - 3),
+                                       end_date=today + timedelta(days=i - 1))
+            trip.participants.add(*users[:3])
+            Review.objects.bulk_create(Review(trip=trip, user=user, review='Great trip') for user in users)
+            TripPhoto.objects.bulk_create(TripPhoto(trip=trip, photo=f'trip{i}_{j}.jpg') for j in range(2))
+            JoinRequest.objects.bulk_create(JoinRequest(trip=trip, user=user) for user in users[1:])
+            Wishlist.objects.create(trip_id=trip, user_id=profiles[0])
+        for user in users:
+            Rating.objects.bulk_create(Rating(user=user, place=place, rating=4) for place in places)
+        BlogPost.objects.bulk_create(
+            BlogPost(title=f'Post {i}', content='Content', display_content='Content', author=users[i % 4],
+                     place=places[0]) for i in range(3))
+
+        cls.chat = UserChat.objects.create(first_person=profiles[0], second_person=profiles[1])
+        group = ChatGroup.objects.create(name='Group')
+        group.members.add(*profiles)
+        UserChat.objects.create(first_person=profiles[0], group=group)
+        ChatMessage.objects.bulk_create(
+            ChatMessage(userchat=cls.chat, user=profiles[i % 2], message=f'Message {i}') for i in range(5))
+        # the search index is filled on commit, which never comes in a TestCase
+        search.rebuild()
+        cls.place = places[0]
+        cls.trip = trip
+
+    def setUp(self):
+        cache.clear()
+        self.client.login(username='user0', password='password')
+
+    def test_pages_stay_within_query_budget(self):
+        urls = [
+            reverse('mainapp:homepage'),
+            reverse('mainapp:trip_list'),
+            reverse('mainapp:trip_list') + '?query=Trip',
+            reverse('mainapp:trip_list') + '?sort_by=recommendation',
+            reverse('mainapp:trip_list') + '?query=Trip&sort_by=recommendation',
+            reverse('mainapp:trip_list') + '?sort_by=alphabetical',
+            reverse('mainapp:trip_feed'),
+            reverse('mainapp:trip_feed_cards'),
+            reverse('mainapp:trip_detail', args=[self.trip.id]),
+            reverse('mainapp:user_trip_history'),
+            reverse('mainapp:wishlist'),
+            reverse('mainapp:calendar'),
+            reverse('mainapp:messages'),
+            reverse('mainapp:message_history', args=[self.chat.id]),
+            reverse('mainapp:unread_counts'),
+            reverse('mainapp:getusers'),
+            reverse('mainapp:create_group'),
+            reverse('mainapp:blog_list'),
+            reverse('mainapp:place_detail', args=[self.place.id]),
+            reverse('mainapp:terms_conditions'),
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertWithinQueryBudget(response)
+
+    @override_settings(REQUEST_METRICS_HEADERS=True)
+    def test_metrics_headers(self):
+        client = Client()
+        response = client.get(reverse('mainapp:blog_list'))
+        self.assertEqual(response['X-Query-Count'], str(response.metrics.query_count))
+        self.assertIn('db;dur=', response['Server-Timing'])
+
+    def test_going_over_budget_fails_the_test(self):
+        self.assertTrue(settings.REQUEST_METRICS_ENFORCE_BUDGETS)
+        with mock.patch.dict(QUERY_BUDGETS, {'blog_list': 0}), self.assertLogs('mainapp.metrics', 'WARNING'):
+            with self.assertRaisesMessage(QueryBudgetExceeded, 'blog_list ran'):
+                self.client.get(reverse('mainapp:blog_list'))
+
+    @override_settings(REQUEST_METRICS_ENFORCE_BUDGETS=False)
+    def test_going_over_budget_is_only_logged_outside_the_tests(self):
+        with mock.patch.dict(QUERY_BUDGETS, {'blog_list': 0}), self.assertLogs('mainapp.metrics', 'WARNING'):
+            response = Client().get(reverse('mainapp:blog_list'))
+        self.assertEqual(response.status_code, 200)
+
+
+class JoinWorkflowConcurrencyTests(TransactionTestCase):
+    """Many users racing for the seats of one trip, each from their own thread and connection."""
+    CAPACITY = 5
+
+    def setUp(self):
+        organizer = User.objects.create_user('organizer')
+        place = Place.objects.create(name='Popular place', address='1 Main Street')
+        today = date.today()
+        self.trip = Trip.objects.create(uploader=organizer, title='Popular tour', description='A trip', place=place,
+                                        start_date=today, end_date=today, max_capacity=self.CAPACITY)
+        self.users = [User.objects.create_user(f'traveller{i}') for i in range(16)]
+
+    def hammer(self, step, items):
+        """Run step on every item at once, one thread each. Returns the JoinErrors raised."""
+        barrier = threading.Barrier(len(items))
+        refused, failures = [], []
+
+        def run(item):
+            try:
+                barrier.wait()
+                step(item)
+            except joins.JoinError as error:
+                refused.append(error)
+            except Exception as error:
+                failures.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(item,)) for item in items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        return refused
+
+    def assertSeatsConsistent(self):
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.participant_count, self.trip.participants.count())
+        self.assertLessEqual(self.trip.participant_count, self.trip.max_capacity)
+
+    def test_capacity_holds_under_a_rush(self):
+        # every user submits the join form twice at the same time
+        refused = self.hammer(lambda user: joins.request_to_join(self.trip, user), self.users * 2)
+        self.assertEqual(len(refused), len(self.users))
+        requests = list(JoinRequest.objects.filter(trip=self.trip))
+        self.assertEqual(len(requests), len(self.users))
+
+        # the organizer accepts every request from two tabs at once
+        refused = self.hammer(lambda join_request: joins.accept(self.trip.pk, join_request.pk), requests * 2)
+        self.assertEqual(len(refused), len(requests))
+        self.assertSeatsConsistent()
+        self.assertEqual(self.trip.participant_count, self.CAPACITY)
+        statuses = JoinRequest.objects.filter(trip=self.trip)
+        self.assertEqual(statuses.filter(status='accepted').count(), self.CAPACITY)
+        self.assertEqual(statuses.filter(status='waitlisted').count(), len(self.users) - self.CAPACITY)
+
+        # seats freed by participants leaving together go to the head of the waitlist
+        waitlist = list(statuses.filter(status='waitlisted').order_by('timestamp', 'id').values_list('user_id', flat=True))
+        leaving = list(self.trip.participants.all()[:3])
+        self.hammer(lambda user: joins.leave(self.trip.pk, user), leaving)
+        self.assertSeatsConsistent()
+        self.assertEqual(self.trip.participant_count, self.CAPACITY)
+        participants = set(self.trip.participants.values_list('pk', flat=True))
+        self.assertTrue(set(waitlist[:3]) <= participants)
+        self.assertFalse(participants & {user.pk for user in leaving})
+
+
+class JoinWorkflowTests(TestCase):
+    def setUp(self):
+        organizer = User.objects.create_user('organizer')
+        place = Place.objects.create(name='Popular place', address='1 Main Street')
+        self.trip = Trip.objects.create(uploader=organizer, title='Popular tour', description='A trip', place=place,
+                                        start_date=date.today(), end_date=date.today(), max_capacity=1)
+        self.user = User.objects.create_user('traveller')
+
+    def test_declined_user_can_ask_again(self):
+        first = joins.request_to_join(self.trip, self.user)
+        joins.decline(self.trip.pk, first.pk)
+
+        again = joins.request_to_join(self.trip, self.user)
+        self.assertEqual((again.pk, again.status), (first.pk, 'pending'))
+        self.assertGreaterEqual(again.timestamp, first.timestamp)
+        with self.assertRaisesMessage(joins.JoinError, 'already requested'):
+            joins.request_to_join(self.trip, self.user)
+        self.assertEqual(joins.accept(self.trip.pk, again.pk), 'accepted')
+        self.assertTrue(self.trip.participants.filter(pk=self.user.pk).exists())
+
+
+@override_settings(READ_REPLICAS=['replica'])
+class ReadReplicaRoutingTests(TransactionTestCase):
+    """
+    The primary and a replica as two SQLite files. sync_replica() stands in
+    for replication, so the replica only has what was there at the last sync.
+    """
+
+    def setUp(self):
+        cache.clear()
+        handle, self.replica_name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        connections.settings['replica'] = {**connections.settings['default'], 'NAME': self.replica_name,
+                                           'OPTIONS': {'transaction_mode': 'DEFERRED'}}
+        self.addCleanup(self.remove_replica)
+
+        self.organizer = User.objects.create_user('organizer', password='password')
+        self.traveller = User.objects.create_user('traveller', password='password')
+        self.place = Place.objects.create(name='Place', address='1 Main Street')
+        self.trip = self.create_trip('Replicated trip')
+        self.sync_replica()
+
+    def remove_replica(self):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.replica_name + suffix):
+                os.unlink(self.replica_name + suffix)
+
+    def sync_replica(self):
+        connections['replica'].close()
+        connections['default'].ensure_connection()
+        replica = sqlite3.connect(self.replica_name)
+        try:
+            connections['default'].connection.backup(replica)
+        finally:
+            replica.close()
+
+    def create_trip(self, title):
+        today = date.today()
+        return Trip.objects.create(uploader=self.organizer, title=title, description='A trip', place=self.place,
+                                   start_date=today, end_date=today)
+
+    def feed_titles(self, client):
+        response = client.get(reverse('mainapp:trip_feed'))
+        self.assertEqual(response.status_code, 200)
+        return {trip['title'] for trip in response.json()['trips']}
+
+    def test_listings_read_from_the_replica(self):
+        new_trip = self.create_trip('New trip')
+        self.assertEqual(self.feed_titles(Client()), {'Replicated trip'})
+        # pages that are not marked for the replica read from the primary
+        response = Client().get(reverse('mainapp:trip_detail', args=[new_trip.id]))
+        self.assertEqual(response.status_code, 200)
+
+        self.sync_replica()
+        self.assertEqual(self.feed_titles(Client()), {'Replicated trip', 'New trip'})
+
+    def test_visitor_reads_from_the_primary_after_writing(self):
+        client = Client()
+        client.login(username='traveller', password='password')
+        self.create_trip('New trip')
+
+        response = client.post(reverse('mainapp:join_trip', args=[self.trip.id]))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('primary_pin', response.cookies)
+        self.assertEqual(self.feed_titles(client), {'Replicated trip', 'New trip'})
+
+        client.cookies['primary_pin'] = str(int(time.time()) - 1)
+        self.assertEqual(self.feed_titles(client), {'Replicated trip'})
+
+    def test_reads_after_a_write_in_the_same_request_go_to_the_primary(self):
+        state = routers.RoutingState()
+        state.replica_reads = True
+        token = routers._state.set(state)
+        try:
+            self.assertEqual(router.db_for_read(Trip), 'replica')
+            self.create_trip('New trip')
+            self.assertEqual(router.db_for_read(Trip), 'default')
+        finally:
+            routers._state.reset(token)
+        self.assertFalse(router.allow_migrate('replica', 'mainapp'))
+
+
+class TripListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('traveller', password='password')
+        profile = UserProfile.objects.create(user=cls.user)
+        profile.preferences = UserPreferences.objects.create(user_profile=profile)
+        profile.save()
+        today = date.today()
+        with cls.captureOnCommitCallbacks(execute=True):
+            for title, place in [('Lakeside lodge', 'Zermatt'), ('Alpine lodge', 'Chamonix'), ('City hotel', 'Paris')]:
+                Trip.objects.create(uploader=cls.user, title=title, description='A trip', start_date=today,
+                                    end_date=today, place=Place.objects.create(name=place, address='Main Street'))
+
+    def setUp(self):
+        cache.clear()
+        self.client.login(username='traveller', password='password')
+
+    def test_search_with_every_sort_order(self):
+        for sort_by in ['', 'recommendation', 'alphabetical']:
+            with self.subTest(sort_by=sort_by):
+                response = self.client.get(reverse('mainapp:trip_list'), {'query': 'lodge', 'sort_by': sort_by})
+                self.assertEqual(response.status_code, 200)
+                titles = [trip.title for trip in response.context['trips']]
+                self.assertCountEqual(titles, ['Lakeside lodge', 'Alpine lodge'])
+                self.assertTrue(all('<mark>' in trip.search_snippet for trip in response.context['trips']))
+                if sort_by == 'alphabetical':
+                    self.assertEqual(titles, ['Alpine lodge', 'Lakeside lodge'])
+
+    def test_search_results_are_paged(self):
+        with mock.patch.object(search, 'PAGE_SIZE', 1):
+            response = self.client.get(reverse('mainapp:trip_list'), {'query': 'lodge'})
+            first = [trip.title for trip in response.context['trips']]
+            self.assertEqual(len(first), 1)
+            next_page_url = response.context['next_page_url']
+            self.assertIn('page=2', next_page_url)
+
+            response = self.client.get(reverse('mainapp:trip_list') + next_page_url)
+            second = [trip.title for trip in response.context['trips']]
+            self.assertIsNone(response.context['next_page_url'])
+        self.assertCountEqual(first + second, ['Lakeside lodge', 'Alpine lodge'])
+
+    def walk(self, **params):
+        """The titles on every page of the listing, and the number of pages."""
+        titles, pages = [], 0
+        url = reverse('mainapp:trip_list') + '?' + urlencode(params)
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.context['trips']), 1)
+            titles += [trip.title for trip in response.context['trips']]
+            pages += 1
+            url = response.context['next_page_url'] and reverse('mainapp:trip_list') + response.context['next_page_url']
+        return titles, pages
+
+    def test_every_sort_order_is_paged(self):
+        everything = ['Lakeside lodge', 'Alpine lodge', 'City hotel']
+        with mock.patch.object(views, 'DEFAULT_PAGE_SIZE', 1):
+            self.assertEqual(self.walk(sort_by='alphabetical'), (['Alpine lodge', 'City hotel', 'Lakeside lodge'], 3))
+            titles, pages = self.walk(sort_by='recommendation')
+            self.assertCountEqual(titles, everything)
+            self.assertEqual(pages, 3)
+            titles, pages = self.walk(sort_by='recommendation', my_trips='')
+            self.assertCountEqual(titles, everything)
+            with mock.patch.object(search, 'is_available', return_value=False):
+                self.assertEqual(self.walk(query='Main Street', sort_by='alphabetical'),
+                                 (['Alpine lodge', 'City hotel', 'Lakeside lodge'], 3))
+                titles, pages = self.walk(query='Main Street')
+                self.assertCountEqual(titles, everything)
+                self.assertEqual(pages, 3)
+
+    def test_anonymous_users_are_sent_to_log_in(self):
+        self.client.logout()
+        response = self.client.get(reverse('mainapp:trip_list'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.LOGIN_URL, response.url)
+
+
+class TripFeedTests(TestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user('organizer', password='password')
+        self.other = User.objects.create_user('other')
+        place = Place.objects.create(name='Lake District', address='Cumbria')
+        now = timezone.now()
+        # two pairs created at the same moment, so pages have to break ties by id
+        created = [now, now, now - timedelta(hours=1), now - timedelta(hours=1), now - timedelta(days=1)]
+        self.trips = [Trip.objects.create(uploader=self.other if i == 4 else self.organizer, title=f'Trip {i}',
+                                          description='A trip', place=place, start_date=date.today(),
+                                          end_date=date.today(), created_at=created_at)
+                      for i, created_at in enumerate(created)]
+        self.newest_first = [trip.id for trip in sorted(self.trips, key=lambda trip: (trip.created_at, trip.id),
+                                                        reverse=True)]
+
+    def walk(self, **params):
+        """The trip ids of every page of the JSON feed, and the number of pages."""
+        ids, pages = [], 0
+        while True:
+            response = self.client.get(reverse('mainapp:trip_feed'), params)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            ids += [trip['id'] for trip in data['trips']]
+            pages += 1
+            if data['next_cursor'] is None:
+                return ids, pages
+            params['cursor'] = data['next_cursor']
+
+    def test_json_feed_pages_through_every_trip_once_newest_first(self):
+        self.assertEqual(self.walk(page_size=2), (self.newest_first, 3))
+        self.assertEqual(self.walk(page_size=5), (self.newest_first, 1))
+        self.assertEqual(self.walk(page_size=1000), (self.newest_first, 1))
+
+        trip = self.client.get(reverse('mainapp:trip_feed'), {'page_size': 1}).json()['trips'][0]
+        self.assertEqual(trip['url'], reverse('mainapp:trip_detail', args=[trip['id']]))
+        self.assertEqual((trip['place']['name'], trip['participant_count'], trip['photos']), ('Lake District', 0, []))
+
+    def test_my_trips(self):
+        self.client.login(username='organizer', password='password')
+        ids, _ = self.walk(page_size=2, my_trips='')
+        self.assertEqual(ids, [trip_id for trip_id in self.newest_first if trip_id != self.trips[4].id])
+
+    def test_card_fragments_carry_the_next_cursor(self):
+        response = self.client.get(reverse('mainapp:trip_feed_cards'), {'page_size': 3})
+        self.assertEqual(response.status_code, 200)
+        cursor = self.client.get(reverse('mainapp:trip_feed'), {'page_size': 3}).json()['next_cursor']
+        self.assertContains(response, f'data-next-cursor="{cursor}"')
+        self.assertContains(response, 'class="card"', count=3)
+
+        response = self.client.get(reverse('mainapp:trip_feed_cards'), {'page_size': 3, 'cursor': cursor})
+        self.assertContains(response, 'class="card"', count=2)
+        self.assertNotContains(response, 'data-next-cursor')
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', 'Zm9vfGJhcg==', '!!!'):
+            self.assertEqual(self.client.get(reverse('mainapp:trip_feed'), {'cursor': cursor}).status_code, 400)
+            self.assertEqual(self.client.get(reverse('mainapp:trip_feed_cards'), {'cursor': cursor}).status_code,
+                             400)
+
+
+@override_settings(CHAT_WRITE_BEHIND_BATCH_SIZE=3, CHAT_WRITE_BEHIND_MAX_ATTEMPTS=3)
+class ChatMessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.profile = UserProfile.objects.create(user=User.objects.create_user('sender'))
+        self.chat = UserChat.objects.create(first_person=self.profile)
+        self.writer = ChatMessageWriter()
+
+    def message(self, text, userchat=None):
+        return ChatMessage(user=self.profile, userchat=userchat or self.chat, message=text)
+
+    def stored(self):
+        return list(ChatMessage.objects.order_by('id').values_list('message', flat=True))
+
+    def test_flush_stores_messages_in_broadcast_order(self):
+        texts = [f'Message {i}' for i in range(7)]
+        self.writer.pending.extend(self.message(text) for text in texts)
+
+        self.writer.flush_sync()
+
+        self.assertEqual(self.stored(), texts)
+        self.assertFalse(self.writer.pending)
+
+    def test_failing_message_is_retried_then_dropped(self):
+        deleted_chat = UserChat.objects.create(first_person=self.profile)
+        UserChat.objects.filter(pk=deleted_chat.pk).delete()
+        self.writer.pending.extend([self.message('First'), self.message('Lost', deleted_chat), self.message('Second'),
+                                    self.message('Third'), self.message('Fourth')])
+
+        with self.assertLogs('mainapp.chat_writer', 'WARNING'):
+            self.writer.flush_sync()
+        # what came before the failing message is stored, it and the rest wait for the next round
+        self.assertEqual(self.stored(), ['First'])
+        self.assertEqual([message.message for message in self.writer.pending], ['Lost', 'Second', 'Third', 'Fourth'])
+
+        with self.assertLogs('mainapp.chat_writer', 'WARNING'):
+            self.writer.flush_sync()
+        self.assertEqual(self.stored(), ['First'])
+
+        with self.assertLogs('mainapp.chat_writer', 'ERROR') as logs:
+            self.writer.flush_sync()
+        self.assertEqual(self.stored(), ['First', 'Second', 'Third', 'Fourth'])
+        self.assertFalse(self.writer.pending)
+        dropped = [record for record in logs.records if record.levelname == 'ERROR']
+        self.assertEqual(len(dropped), 1)
+        self.assertIn("'Lost'", dropped[0].getMessage())
+        self.assertIsNotNone(dropped[0].exc_info)
+
+    def test_run_logs_errors_and_keeps_going(self):
+        async def run_twice():
+            self.writer._wakeup = asyncio.Event()
+            task = asyncio.create_task(self.writer.run())
+            while flush.await_count < 2:
+                await asyncio.sleep(0.01)
+            task.cancel()
+
+        with mock.patch.object(self.writer, 'flush', side_effect=[RuntimeError('database is gone'), None]) as flush:
+            with self.assertLogs('mainapp.chat_writer', 'ERROR') as logs:
+                asyncio.run(run_twice())
+        self.assertIsNotNone(logs.records[0].exc_info)
+
+
+class PreferenceMatrixTests(SimpleTestCase):
+    def test_scores_are_the_jaccard_similarity_of_the_choice_sets(self):
+        trips = {1: {1, 2, 3}, 2: {3}, 3: set(), 4: {4, 5, 6, 7}, 5: set(range(1, 100, 2))}
+        matrix = PreferenceMatrix()
+        for trip_id, choice_ids in trips.items():
+            matrix.add_row(trip_id, choice_ids)
+
+        for user_choices in ({1, 2}, {3, 4, 5}, set(), {98, 99}, {1, 2, 3}, set(range(100))):
+            expected = {trip_id: len(user_choices & choice_ids) / len(user_choices | choice_ids)
+                        if user_choices | choice_ids else 0.0 for trip_id, choice_ids in trips.items()}
+            self.assertEqual(matrix.scores(user_choices), expected, user_choices)
+
+    def test_choices_no_trip_uses_still_count_towards_the_union(self):
+        matrix = PreferenceMatrix()
+        matrix.add_row(1, [1, 2])
+        self.assertEqual(matrix.scores([1, 2, 3, 4]), {1: 0.5})
+        self.assertEqual(matrix.columns, {1: 0, 2: 1})
+
+    def test_top_k(self):
+        matrix = PreferenceMatrix()
+        for trip_id, choice_ids in {1: [1], 2: [1, 2], 3: [3], 4: [1, 2, 3]}.items():
+            matrix.add_row(trip_id, choice_ids)
+        self.assertEqual(matrix.top_k([1, 2], 2), [(2, 1.0), (4, 2 / 3)])
+        self.assertEqual(len(matrix.top_k([1, 2], 10)), 4)
+        self.assertEqual(matrix.top_k([1, 2], 2, trip_ids=[1, 3, 4, 99]), [(4, 2 / 3), (1, 0.5)])
+
+    def test_top_k_breaks_ties_by_trip_id(self):
+        matrix = PreferenceMatrix()
+        for trip_id in (5, 2, 9, 1):
+            matrix.add_row(trip_id, [1])
+        self.assertEqual([trip_id for trip_id, score in matrix.top_k([1], 4)], [1, 2, 5, 9])
+
+
+class TripPreferenceIndexTests(TestCase):
+    """Two TripPreferenceIndex instances sharing the cache stand in for two workers."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_changes_from_two_workers_are_both_kept(self):
+        first, second = TripPreferenceIndex(), TripPreferenceIndex()
+        first.snapshot(), second.snapshot()
+        first.add_choices(10, {1, 2})
+        first.set_trip(1, 10)
+
+        # second changes another trip without having seen what first published,
+        # as if both had changed their trip at the same moment
+        with mock.patch.object(second, '_sync'):
+            second.add_choices(20, {3})
+            second.set_trip(2, 20)
+
+        expected = {1: frozenset({1, 2}), 2: frozenset({3})}
+        self.assertEqual(TripPreferenceIndex().snapshot(), expected)
+        self.assertEqual(first.snapshot(), expected)
+        self.assertEqual(second.snapshot(), expected)
+
+    def test_index_follows_preference_changes_through_signals(self):
+        category = PreferenceCategory.objects.create(name='Activity')
+        hiking, kayaking, cycling = (PreferenceChoice.objects.create(category=category, value=value)
+                                     for value in ('Hiking', 'Kayaking', 'Cycling'))
+        organizer = User.objects.create_user('organizer')
+        place = Place.objects.create(name='Lake District', address='Cumbria')
+        index = TripPreferenceIndex()
+        with mock.patch('mainapp.signals.trip_index', index), self.captureOnCommitCallbacks(execute=True):
+            preference = TripPreference.objects.create()
+            preference.preferences.add(hiking, kayaking)
+            trip = Trip.objects.create(uploader=organizer, title='Kayak tour', description='A trip', place=place,
+                                       start_date=date.today(), end_date=date.today(), preferences=preference)
+            empty = Trip.objects.create(uploader=organizer, title='Walk', description='A trip', place=place,
+                                        start_date=date.today(), end_date=date.today())
+        self.assertEqual(index.scores([hiking.pk, cycling.pk]), {trip.pk: 1 / 3, empty.pk: 0.0})
+        self.assertEqual(index.scores([hiking.pk, cycling.pk]),
+                         PreferenceMatrix.from_trips().scores([hiking.pk, cycling.pk]))
+        user_preferences = UserPreferences.objects.create()
+        user_preferences.preferences.add(hiking, cycling)
+        user_profile = UserProfile(user=organizer, preferences=user_preferences)
+        with mock.patch('mainapp.recommendations.trip_index', index):
+            self.assertEqual(recommendation_scores(user_profile, [trip.pk]), {trip.pk: 1 / 3})
+            self.assertEqual(recommended_trip_ids(user_profile, 1), [trip.pk])
+
+        with mock.patch('mainapp.signals.trip_index', index), self.captureOnCommitCallbacks(execute=True):
+            preference.preferences.remove(kayaking)
+            cycling.delete()
+        self.assertEqual(index.verify(), [])
+        self.assertEqual(index.scores([hiking.pk]), {trip.pk: 1.0, empty.pk: 0.0})
+
+    def test_evicted_state_is_reloaded_from_the_database(self):
+        index = TripPreferenceIndex()
+        index.snapshot()
+        cache.delete(index.state_key(index.version))
+        cache.delete(index.version_key)
+        self.assertEqual(TripPreferenceIndex().snapshot(), {})
+
+
+class CalendarCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.organizer = User.objects.create_user('organizer')
+        self.place = Place.objects.create(name='Place', address='1 Main Street')
+
+    def create_trip(self, title, day):
+        with self.captureOnCommitCallbacks(execute=True):
+            Trip.objects.create(uploader=self.organizer, title=title, description='A trip', place=self.place,
+                                start_date=day, end_date=day)
+
+    def test_month_is_cached_until_a_trip_in_it_changes(self):
+        self.create_trip('First trip', date(2030, 5, 10))
+        self.assertIn('First trip', Calendar(2030, 5).formatmonth())
+
+        with self.assertNumQueries(0):
+            Calendar(2030, 5).formatmonth()
+        self.create_trip('Second trip', date(2030, 5, 20))
+        self.assertIn('Second trip', Calendar(2030, 5).formatmonth())
+
+    def test_trip_saved_while_month_renders_shows_on_next_render(self):
+        trips_by_day = Calendar.trips_by_day
+
+        def save_trip_after_reading(calendar):
+            days = trips_by_day(calendar)
+            self.create_trip('Late trip', date(2030, 5, 12))
+            return days
+
+        with mock.patch.object(Calendar, 'trips_by_day', save_trip_after_reading):
+            self.assertNotIn('Late trip', Calendar(2030, 5).formatmonth())
+        self.assertIn('Late trip', Calendar(2030, 5).formatmonth())
+
+
+class TripSearchTests(TestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user('organizer')
+        self.place = Place.objects.create(name='Lake District', address='Cumbria')
+
+    def create_trip(self, title, description='A trip', place=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Trip.objects.create(uploader=self.organizer, title=title, description=description,
+                                       place=place or self.place, start_date=date.today(), end_date=date.today())
+
+    def found(self, query, **kwargs):
+        return [result.trip_id for result in search.search_trips(query, **kwargs)]
+
+    def test_title_matches_rank_above_description_matches(self):
+        in_description = self.create_trip('Weekend away', 'Two nights in a kayak friendly cabin')
+        in_title = self.create_trip('Kayak tour')
+        self.assertEqual(self.found('kayak'), [in_title.id, in_description.id])
+
+    def test_words_match_as_prefixes_and_all_have_to_match(self):
+        trip = self.create_trip('Mountaineering weekend')
+        self.create_trip('Mountain biking')
+        self.assertEqual(self.found('mountaineer week'), [trip.id])
+        self.assertEqual(len(self.found('mount')), 2)
+        self.assertEqual(self.found('lake mountaineering'), [trip.id])
+        self.assertEqual(self.found('?!'), [])
+
+    def test_snippets_are_escaped_and_highlighted(self):
+        self.create_trip('Kayak <b>tour</b>')
+        [result] = search.search_trips('kayak')
+        self.assertIn('<mark>Kayak</mark> &lt;b&gt;tour&lt;/b&gt;', result.snippet)
+
+    def test_results_are_returned_a_page_at_a_time(self):
+        trips = [self.create_trip(f'Kayak tour {i}') for i in range(5)]
+        pages = [self.found('kayak', limit=2, offset=offset) for offset in (0, 2, 4)]
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertCountEqual(sum(pages, []), [trip.id for trip in trips])
+
+    def test_index_follows_trip_and_place_changes(self):
+        trip = self.create_trip('Kayak tour')
+        with self.captureOnCommitCallbacks(execute=True):
+            trip.title = 'Canoe tour'
+            trip.save()
+        self.assertEqual(self.found('kayak'), [])
+        self.assertEqual(self.found('canoe'), [trip.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.place.name = 'Snowdonia'
+            self.place.save()
+        self.assertEqual(self.found('snowdonia canoe'), [trip.id])
+        self.assertEqual(self.found('district'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            trip.delete()
+        self.assertEqual(self.found('canoe'), [])
+
+
+class FileServerTests(SimpleTestCase):
+    CONTENT = bytes(range(256)) * 4
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'cas', 'incoming'))
+        for name in ('photo.jpg', 'cas/incoming/upload.jpg'):
+            with open(os.path.join(self.root, name), 'wb') as file:
+                file.write(self.CONTENT)
+        self.server = fileserver.FileServer(self.not_found, [
+            ('/media/', self.root, fileserver.is_content_addressed_media, fileserver.is_incoming_media)])
+
+    async def not_found(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'Not found'})
+
+    def get(self, path, method='GET', **headers):
+        """(status, headers, body) of the server's response."""
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'headers': [(key.replace('_', '-').encode(), value.encode()) for key, value in headers.items()]}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.server(scope, receive, send))
+        start, *body = messages
+        return (start['status'], {key.decode(): value.decode() for key, value in start['headers']},
+                b''.join(message.get('body', b'') for message in body))
+
+    def test_serves_files_and_passes_on_the_rest(self):
+        status, headers, body = self.get('/media/photo.jpg')
+        self.assertEqual((status, body), (200, self.CONTENT))
+        self.assertEqual(headers['content-type'], 'image/jpeg')
+        self.assertEqual(headers['cache-control'], fileserver.REVALIDATE)
+        for path in ('/media/missing.jpg', '/media/../tests.py', '/media/cas'):
+            self.assertEqual(self.get(path)[0], 404, path)
+
+    def test_uploads_being_written_are_not_served(self):
+        for path in ('/media/cas/incoming/upload.jpg', '/media/cas//incoming/upload.jpg',
+                     '/media/cas/./incoming/upload.jpg', '/media/cas/xx/../incoming/upload.jpg'):
+            self.assertEqual(self.get(path), (404, {}, b'Not found'), path)
+
+    def test_conditional_requests(self):
+        status, headers, _ = self.get('/media/photo.jpg')
+        etag, last_modified = headers['etag'], headers['last-modified']
+        for conditions in ({'if_none_match': etag}, {'if_none_match': f'"other", W/{etag}'}, {'if_none_match': '*'},
+                           {'if_modified_since': last_modified}):
+            status, headers, body = self.get('/media/photo.jpg', **conditions)
+            self.assertEqual((status, body), (304, b''), conditions)
+            self.assertEqual(headers['etag'], etag)
+        # If-None-Match wins over If-Modified-Since
+        status, _, body = self.get('/media/photo.jpg', if_none_match='"other"', if_modified_since=last_modified)
+        self.assertEqual((status, body), (200, self.CONTENT))
+
+        os.utime(os.path.join(self.root, 'photo.jpg'), (0, 0))
+        self.assertEqual(self.get('/media/photo.jpg', if_none_match=etag)[0], 200)
+
+    def test_ranges(self):
+        for header, (start, end) in (('bytes=0-9', (0, 9)), ('bytes=1000-', (1000, 1023)),
+                                     ('bytes=-24', (1000, 1023)), ('bytes=1020-5000', (1020, 1023))):
+            status, headers, body = self.get('/media/photo.jpg', range=header)
+            self.assertEqual(status, 206, header)
+            self.assertEqual(body, self.CONTENT[start:end + 1])
+            self.assertEqual(headers['content-range'], f'bytes {start}-{end}/1024')
+            self.assertEqual(headers['content-length'], str(end - start + 1))
+
+        for header in ('bytes=0-1,5-6', 'lines=1-2', 'bytes=-'):
+            status, headers, body = self.get('/media/photo.jpg', range=header)
+            self.assertEqual((status, body), (200, self.CONTENT), header)
+            self.assertNotIn('content-range', headers)
+        for header in ('bytes=1024-', 'bytes=-0', 'bytes=9-1'):
+            status, headers, body = self.get('/media/photo.jpg', range=header)
+            self.assertEqual((status, headers['content-range'], body), (416, 'bytes */1024', b''), header)
+
+        etag = self.get('/media/photo.jpg', method='HEAD')[1]['etag']
+        self.assertEqual(self.get('/media/photo.jpg', range='bytes=0-9', if_range=etag)[0], 206)
+        self.assertEqual(self.get('/media/photo.jpg', range='bytes=0-9', if_range='"stale"')[0], 200)
+
+    def test_head_and_zero_copy_send(self):
+        status, headers, body = self.get('/media/photo.jpg', method='HEAD')
+        self.assertEqual((status, headers['content-length'], body), (200, '1024', b''))
+
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/media/photo.jpg', 'headers': [(b'range', b'bytes=10-19')],
+                 'extensions': {'http.response.zerocopysend': {}}}
+        asyncio.run(self.server(scope, None, send))
+        self.assertEqual(messages[0]['status'], 206)
+        self.assertEqual((messages[1]['type'], messages[1]['offset'], messages[1]['count']),
+                         ('http.response.zerocopysend', 10, 10))
+
+    def test_content_addressed_media_is_immutable(self):
+        name = storage.content_name('ab' * 32, '.jpg')
+        os.makedirs(os.path.join(self.root, posixpath.dirname(name)))
+        with open(os.path.join(self.root, name), 'wb') as file:
+            file.write(self.CONTENT)
+        self.assertEqual(self.get(f'/media/{name}')[1]['cache-control'], fileserver.IMMUTABLE)
+
+    def test_files_are_looked_up_off_the_event_loop(self):
+        threads = []
+        find = self.server.find
+
+        def record_thread(*args):
+            threads.append(threading.current_thread())
+            return find(*args)
+
+        with mock.patch.object(self.server, 'find', record_thread):
+            self.assertEqual(self.get('/media/photo.jpg')[0], 200)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+
+class MessageHistoryTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = (
+            UserProfile.objects.create(user=User.objects.create_user(name))
+            for name in ('alice', 'bob', 'carol'))
+        self.chat = UserChat.objects.create(first_person=self.alice, second_person=self.bob)
+        start = timezone.now() - timedelta(hours=1)
+        # pairs of messages sent at the same moment, so pages have to break ties by id
+        self.history = ChatMessage.objects.bulk_create(
+            ChatMessage(userchat=self.chat, user=self.alice if i % 3 else self.bob, message=f'Message {i}',
+                        timestamp=start + timedelta(seconds=i // 2))
+            for i in range(views.CHAT_HISTORY_PAGE_SIZE + 5))
+        self.client.force_login(self.alice.user)
+
+    def history_page(self, chat, **params):
+        return self.client.get(reverse('mainapp:message_history', args=[chat.pk]), params)
+
+    def test_history_pages_back_from_the_latest_message(self):
+        texts = [message.message for message in self.history]
+        latest = self.history_page(self.chat).json()
+        self.assertEqual([message['message'] for message in latest['messages']],
+                         texts[-views.CHAT_HISTORY_PAGE_SIZE:])
+        self.assertEqual(latest['messages'][-1]['username'], 'alice')
+        self.assertIn('Message 34', latest['html'])
+
+        older = self.history_page(self.chat, cursor=latest['next_cursor']).json()
+        self.assertEqual([message['message'] for message in older['messages']], texts[:5])
+        self.assertIsNone(older['next_cursor'])
+
+    def test_history_of_other_peoples_chats_is_not_served(self):
+        private = UserChat.objects.create(first_person=self.bob, second_person=self.carol)
+        ChatMessage.objects.create(userchat=private, user=self.bob, message='Private')
+        self.assertEqual(self.history_page(private).status_code, 404)
+
+        group = ChatGroup.objects.create(name='Hikers')
+        group.members.add(self.alice, self.bob)
+        group_chat = UserChat.objects.create(group=group)
+        self.assertEqual(self.history_page(group_chat).json()['messages'], [])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.history_page(self.chat, cursor='garbage').status_code, 400)
+
+    def test_summaries_count_messages_and_unread_ones(self):
+        ChatReadCursor.objects.create(userchat=self.chat, user=self.alice, last_read_message_id=self.history[9].pk)
+        group = ChatGroup.objects.create(name='Hikers')
+        group.members.add(self.alice, self.bob, self.carol)
+        group_chat = UserChat.objects.create(group=group)
+        ChatMessage.objects.create(userchat=group_chat, user=self.carol, message='Hello')
+        UserChat.objects.create(first_person=self.bob, second_person=self.carol)
+
+        with self.assertNumQueries(1):
+            summaries = {chat.pk: chat for chat in views.chat_summaries(self.alice)}
+        self.assertEqual(summaries.keys(), {self.chat.pk, group_chat.pk})
+        chat = summaries[self.chat.pk]
+        # bob sent every third message; those after the read cursor are unread
+        self.assertEqual((chat.message_count, chat.unread_count), (35, len(range(12, 35, 3))))
+        self.assertEqual((chat.last_message_id, chat.last_message), (self.history[-1].pk, 'Message 34'))
+        group_chat = summaries[group_chat.pk]
+        self.assertEqual((group_chat.message_count, group_chat.unread_count, group_chat.last_message), (1, 1, 'Hello'))
+
+    def test_messages_page_renders_only_the_first_chat(self):
+        response = self.client.get(reverse('mainapp:messages'))
+        self.assertEqual(response.status_code, 200)
+        [chat] = response.context['userchats']
+        self.assertEqual(len(chat.recent_messages), views.CHAT_HISTORY_PAGE_SIZE)
+        self.assertIsNotNone(chat.history_cursor)
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.organizer = User.objects.create_user('organizer')
+        self.place = Place.objects.create(name='Lake District', address='Cumbria')
+        self.trip = Trip.objects.create(uploader=self.organizer, title='Kayak tour', description='A trip',
+                                        place=self.place, start_date=date.today(), end_date=date.today())
+        self.url = reverse('mainapp:trip_detail', args=[self.trip.pk])
+
+    def test_page_is_served_from_the_cache_until_what_it_shows_changes(self):
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'HIT')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trip.title = 'Canoe tour'
+            self.trip.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertContains(response, 'Canoe tour')
+
+        # a section the page does not show leaves it cached
+        caching.invalidate('blogpost')
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.place.name = 'Snowdonia'
+            self.place.save()
+        self.assertContains(self.client.get(self.url), 'Snowdonia')
+
+    def test_evicted_version_does_not_bring_back_old_pages(self):
+        self.client.get(self.url)
+        cache.delete(caching.version_key('trip'))
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(self.url)['X-Cache'], 'HIT')
+
+    def test_logged_in_users_get_fresh_pages(self):
+        self.client.get(self.url)
+        self.client.force_login(self.organizer)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Cache', response)
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        organizer = User.objects.create_user('organizer')
+        place = Place.objects.create(name='Lake District', address='Cumbria')
+        self.trip = Trip.objects.create(uploader=organizer, title='Kayak tour', description='A trip', place=place,
+                                        start_date=date.today(), end_date=date.today())
+
+    def photo(self, content, name='photo.JPG'):
+        return TripPhoto.objects.create(trip=self.trip, photo=ContentFile(content, name=name))
+
+    def references(self):
+        return dict(StoredFile.objects.values_list('name', 'references'))
+
+    def age(self, name, seconds=settings.MEDIA_COLLECT_GRACE_PERIOD + 60):
+        then = time.time() - seconds
+        os.utime(default_storage.path(name), (then, then))
+
+    def collect(self, *args):
+        out = io.StringIO()
+        call_command('collect_media', *args, stdout=out)
+        return out.getvalue()
+
+    def test_uploads_are_stored_once_and_counted(self):
+        first, second = self.photo(b'same'), self.photo(b'same', name='copy.jpg')
+        name = storage.content_name(hashlib.sha256(b'same').hexdigest(), '.jpg')
+        self.assertEqual((first.photo.name, second.photo.name), (name, name))
+        self.assertEqual(self.references(), {name: 2})
+        self.assertEqual(default_storage.listdir(storage.INCOMING), ([], []))
+
+        second.photo = ContentFile(b'other', name='other.jpg')
+        second.save()
+        other = second.photo.name
+        self.assertEqual(self.references(), {name: 1, other: 1})
+        first.delete()
+        self.assertEqual(self.references(), {name: 0, other: 1})
+
+        StoredFile.objects.update(references=7)
+        self.collect('--recount', '--dry-run')
+        self.assertEqual(self.references(), {name: 0, other: 1})
+
+    def test_collect_media_deletes_old_unused_files_and_their_renditions(self):
+        used = self.photo(b'used').photo.name
+        unused_photo = self.photo(b'unused')
+        unused = unused_photo.photo.name
+        unused_photo.delete()
+        fresh_photo = self.photo(b'fresh')
+        fresh = fresh_photo.photo.name
+        fresh_photo.delete()
+        rendition = default_storage.save(images.rendition_name(unused, 'card', 'webp'), ContentFile(b'card'))
+        half_written = default_storage.save(posixpath.join(storage.INCOMING, 'tmp1234'), ContentFile(b'half'))
+        for name in (used, unused, half_written):
+            self.age(name)
+
+        output = self.collect('--dry-run')
+        self.assertIn('Would delete 2 unused files', output)
+        self.assertTrue(default_storage.exists(unused))
+
+        output = self.collect()
+        self.assertIn('Deleted 2 unused files', output)
+        for name in (unused, rendition, half_written):
+            self.assertFalse(default_storage.exists(name), name)
+        for name in (used, fresh):
+            self.assertTrue(default_storage.exists(name), name)
+        self.assertEqual(self.references(), {used: 1, fresh: 0})
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = (UserProfile.objects.create(user=User.objects.create_user(name))
+                                for name in ('alice', 'bob'))
+        self.chat = UserChat.objects.create(first_person=self.alice, second_person=self.bob)
+        self.texts = ['=HYPERLINK("http://example.com")', 'Hello, "world"', '-1', '@everyone', 'Line\nbreak']
+        ChatMessage.objects.bulk_create(ChatMessage(userchat=self.chat, user=self.alice, message=text)
+                                        for text in self.texts)
+
+    def test_csv_safe(self):
+        for value in ('=1+1', '+1', '-1', '@SUM(A1)', '\tx', '\rx'):
+            self.assertEqual(exports.csv_safe(value), "'" + value)
+        for value in ('plain', 'a=b', '', -1, None, date.today()):
+            self.assertEqual(exports.csv_safe(value), value)
+
+    def test_gzipped_chunks_make_one_stream(self):
+        fields = ['id', 'message']
+        rows = [{'id': i, 'message': f'Message {i} ' * 10} for i in range(500)]
+        for format in exports.FORMATS:
+            with mock.patch.object(exports, 'BUFFER_SIZE', 1024):
+                plain = list(exports.stream(mock.Mock(rows=lambda: iter(rows)), exports.Encoder(fields, format)))
+                zipped = list(exports.stream(mock.Mock(rows=lambda: iter(rows)),
+                                             exports.Encoder(fields, format, compress=True)))
+            self.assertGreater(len([chunk for chunk in zipped if chunk]), 1)
+            decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+            self.assertEqual(decompressor.decompress(b''.join(zipped)), b''.join(plain))
+            self.assertTrue(decompressor.eof)
+            self.assertEqual(decompressor.unused_data, b'')
+
+    @async_to_sync
+    async def get_export(self, userchat_id, **params):
+        """The response and its body, read the way the ASGI handler streams it."""
+        headers = {'ACCEPT_ENCODING': params.pop('accept_encoding', '')}
+        response = await self.async_client.get(reverse('mainapp:export_chat', args=[userchat_id]), params,
+                                               **headers)
+        if not response.streaming:
+            return response, None
+        return response, b''.join([chunk async for chunk in response.streaming_content])
+
+    def test_chat_transcript(self):
+        self.async_client.force_login(self.alice.user)
+        response, body = self.get_export(self.chat.pk)
+        self.assertEqual(response['Content-Type'], exports.FORMATS['csv'])
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="chat-{self.chat.pk}.csv"')
+        header, *rows = csv.reader(io.StringIO(body.decode()))
+        self.assertEqual(header, ['id', 'timestamp', 'username', 'message'])
+        self.assertEqual([row[3] for row in rows], ["'" + self.texts[0], self.texts[1], "'-1", "'@everyone",
+                                                   self.texts[4]])
+
+        response, body = self.get_export(self.chat.pk, format='jsonl', accept_encoding='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        lines = gzip.decompress(body).decode().splitlines()
+        self.assertEqual([json.loads(line)['message'] for line in lines], self.texts)
+
+        response, _ = self.get_export(self.chat.pk, format='xlsx')
+        self.assertEqual(response.status_code, 400)
+
+    def test_only_members_can_export_a_chat(self):
+        self.async_client.force_login(UserProfile.objects.create(user=User.objects.create_user('carol')).user)
+        response, _ = self.get_export(self.chat.pk)
+        self.assertEqual(response.status_code, 404)
+
+
+class BulkImportTests(TestCase):
+    def setUp(self):
+        media_root, self.photo_root = tempfile.mkdtemp(), tempfile.mkdtemp()
+        for directory in (media_root, self.photo_root):
+            self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.organizer = User.objects.create_user('organizer')
+
+    def csv_file(self, fields, rows):
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(fields)
+        writer.writerows(rows)
+        return io.BytesIO(text.getvalue().encode())
+
+    def import_places(self, file, **kwargs):
+        return imports.run_import(imports.PlaceImporter(), file, 'places.csv', **kwargs)
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        file = self.csv_file(['name', 'address', 'description'], [
+            ['Lake District', 'Cumbria', ''], ['', 'Nowhere', ''], ['Lake District', 'Cumbria', 'Again'],
+            ['Snowdonia', 'Gwynedd', 'Mountains']])
+        run = self.import_places(file)
+        self.assertEqual((run.rows_done, run.imported), (4, 2))
+        self.assertEqual([error['row'] for error in run.errors], [2, 3])
+        self.assertIn('name', run.errors[0]['errors'])
+        self.assertEqual(imports.describe(run.errors[1]), 'Row 3: Lake District at Cumbria already exists.')
+        self.assertEqual(sorted(Place.objects.values_list('name', flat=True)), ['Lake District', 'Snowdonia'])
+
+        lines = b'{"name": "Peak District", "address": "Derbyshire"}\n[1, 2]\nnot json\n'
+        run = imports.run_import(imports.PlaceImporter(), io.BytesIO(lines), 'places.jsonl')
+        self.assertEqual((run.imported, [error['row'] for error in run.errors]), (1, [2, 3]))
+
+    def test_import_carries_on_after_the_last_committed_chunk(self):
+        file = self.csv_file(['name', 'address'], [[f'Place {i}', 'Somewhere'] for i in range(5)])
+        write = imports.PlaceImporter.write
+        calls = []
+
+        def write_then_fail(importer, places):
+            calls.append(places)
+            if len(calls) == 2:
+                raise RuntimeError('worker killed')
+            write(importer, places)
+
+        with mock.patch.object(imports, 'CHUNK_SIZE', 2):
+            with mock.patch.object(imports.PlaceImporter, 'write', write_then_fail):
+                with self.assertRaises(RuntimeError):
+                    self.import_places(file)
+            self.assertEqual(ImportRun.objects.get().rows_done, 2)
+            self.assertEqual(Place.objects.count(), 2)
+
+            file.seek(0)
+            run = self.import_places(file)
+        self.assertEqual((run.rows_done, run.imported, run.errors), (5, 5, []))
+        self.assertEqual(Place.objects.count(), 5)
+
+        file.seek(0)
+        with self.assertRaisesMessage(imports.BulkImportError, 'was imported on'):
+            self.import_places(file)
+        file.seek(0)
+        run = self.import_places(file, restart=True)
+        self.assertEqual((run.rows_done, run.imported, len(run.errors)), (5, 0, 5))
+
+    def test_trip_photos_are_read_from_under_the_photo_root_only(self):
+        Place.objects.create(name='Lake District', address='Cumbria')
+        Image.new('RGB', (4, 4), 'red').save(os.path.join(self.photo_root, 'lake.jpg'))
+        with open(os.path.join(self.photo_root, 'notes.jpg'), 'w') as file:
+            file.write('not an image')
+        outside = tempfile.NamedTemporaryFile(suffix='.jpg')
+        self.addCleanup(outside.close)
+        Image.new('RGB', (4, 4), 'blue').save(outside.name)
+
+        photos = ['lake.jpg', '../' + os.path.basename(outside.name), outside.name, 'missing.jpg', 'notes.jpg']
+        fields = ['title', 'place_name', 'start_date', 'end_date', 'description', 'max_capacity', 'cost_per_person',
+                  'photos']
+        file = self.csv_file(fields, [['Kayak tour', 'Lake District', '2026-06-01', '2026-06-03', 'A trip', '8',
+                                       '250', photo] for photo in photos])
+        run = imports.run_import(imports.TripImporter(self.organizer, self.photo_root), file, 'trips.csv')
+
+        self.assertEqual(run.imported, 1)
+        errors = {error['row']: error['errors']['photos'] for error in run.errors}
+        self.assertEqual(errors.keys(), {2, 3, 4, 5})
+        for row in (2, 3):
+            self.assertIn('not under the photo directory', errors[row][0])
+        self.assertIn('no such file', errors[4][0])
+        self.assertTrue(errors[5][0].startswith('notes.jpg: '))
+        [photo] = TripPhoto.objects.all()
+        self.assertTrue(storage.is_content_addressed(photo.photo.name))
+        self.assertEqual(StoredFile.objects.get(name=photo.photo.name).references, 1)
+
+
+class SQLiteBackendTests(TransactionTestCase):
+    def setUp(self):
+        # a read replica of the test database, configured the way settings.py configures them
+        self.add_database('replica', OPTIONS={'transaction_mode': 'DEFERRED'})
+
+    def add_database(self, alias, **settings_dict):
+        connections.settings[alias] = {**connections.settings['default'], **settings_dict}
+
+        def remove():
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        self.addCleanup(remove)
+
+    def pragma(self, name, alias='default'):
+        with connections[alias].cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_connections_are_tuned(self):
+        # the journal mode was set in the database file by migration 0011
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        for name, value in (('synchronous', 1), ('busy_timeout', 5000), ('cache_size', -32000), ('temp_store', 2),
+                            ('mmap_size', 128 * 1024 * 1024), ('foreign_keys', 1)):
+            self.assertEqual(self.pragma(name), value, name)
+            self.assertEqual(self.pragma(name, 'replica'), value, name)
+
+    def test_only_the_primary_takes_the_write_lock_when_a_transaction_begins(self):
+        for alias, begin in (('default', 'BEGIN IMMEDIATE'), ('replica', 'BEGIN DEFERRED')):
+            with CaptureQueriesContext(connections[alias]) as queries:
+                with transaction.atomic(using=alias):
+                    Place.objects.using(alias).count()
+            self.assertEqual(queries[0]['sql'], begin)
+
+    def test_connecting_leaves_the_journal_mode_alone(self):
+        handle, name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.addCleanup(os.unlink, name)
+        self.add_database('other', NAME=name)
+        self.assertEqual(self.pragma('journal_mode', 'other'), 'delete')
+
+
+@override_settings(IMAGE_PIPELINE_WORKERS=0)
+class ImagePipelineTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        organizer = User.objects.create_user('organizer')
+        place = Place.objects.create(name='Lake District', address='Cumbria')
+        self.trip = Trip.objects.create(uploader=organizer, title='Kayak tour', description='A trip', place=place,
+                                        start_date=date.today(), end_date=date.today())
+
+    def jpeg(self, size=(800, 400), color='red', exif=None):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, color).save(buffer, 'JPEG', exif=exif or Image.Exif())
+        return buffer.getvalue()
+
+    def upload(self, content, name='photo.jpg'):
+        with self.captureOnCommitCallbacks(execute=True):
+            photo = TripPhoto.objects.create(trip=self.trip, photo=ContentFile(content, name=name))
+        photo.refresh_from_db()
+        return photo
+
+    def render(self, template, **context):
+        return Template('{% load images %}' + template).render(Context(context))
+
+    def test_uploads_are_stored_without_their_metadata(self):
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = 6
+        exif[ExifTags.Base.Make] = 'Camera'
+        exif.get_ifd(ExifTags.IFD.GPSInfo)[ExifTags.GPS.GPSLatitude] = (51.0, 30.0, 0.0)
+        photo = self.upload(self.jpeg(exif=exif))
+
+        with default_storage.open(photo.photo.name) as stored, Image.open(stored) as image:
+            self.assertEqual(dict(image.getexif()), {ExifTags.Base.Orientation: 6})
+            self.assertEqual(image.getexif().get_ifd(ExifTags.IFD.GPSInfo), {})
+            self.assertEqual(image.size, (800, 400))
+        # turned upright by its orientation
+        self.assertEqual((photo.image_width, photo.image_height), (400, 800))
+
+    def test_renditions_are_stored_and_recorded(self):
+        photo = self.upload(self.jpeg())
+
+        self.assertEqual((photo.image_width, photo.image_height), (800, 400))
+        self.assertEqual(photo.image_renditions['source'], photo.photo.name)
+        for name, (width, height) in images.RENDITIONS.items():
+            rendition = photo.image_renditions[name]
+            self.assertLessEqual(rendition['width'], min(width, 800))
+            self.assertLessEqual(rendition['height'], min(height, 400))
+            self.assertEqual(rendition['files']['jpeg'], images.rendition_name(photo.photo.name, name, 'jpg'))
+            for path in rendition['files'].values():
+                with default_storage.open(path) as stored, Image.open(stored) as image:
+                    self.assertEqual(image.size, (rendition['width'], rendition['height']))
+
+        # the same upload again is stored once and not rendered a second time
+        with mock.patch.object(images.imaging, 'render') as render:
+            copy = self.upload(self.jpeg(), name='copy.jpg')
+        render.assert_not_called()
+        self.assertEqual(copy.photo.name, photo.photo.name)
+        self.assertEqual(copy.image_renditions, photo.image_renditions)
+
+    def test_failures_are_logged(self):
+        # closing connections is left to the pipeline thread, not this test's
+        with mock.patch.object(images, 'process', side_effect=OSError('disk full')), \
+                mock.patch.object(images, 'close_old_connections'), self.assertLogs('mainapp.images', 'ERROR') as logs:
+            images._process_in_thread('mainapp.TripPhoto', 1)
+        self.assertIn('Could not process the image of mainapp.TripPhoto 1', logs.output[0])
+        self.assertIn('disk full', logs.output[0])
+
+    def test_picture_and_rendition_url_tags(self):
+        with mock.patch.object(images, 'process_later'):
+            photo = TripPhoto.objects.create(trip=self.trip, photo=ContentFile(self.jpeg(), name='photo.jpg'))
+        # the original until the pipeline has processed it
+        html = self.render("{% picture photo 'card' 'w-100' 'Lake' %}", photo=photo)
+        self.assertNotIn('<picture>', html)
+        self.assertIn(f'src="{photo.photo.url}"', html)
+        self.assertEqual(self.render("{% rendition_url photo 'card' %}", photo=photo), photo.photo.url)
+
+        images.process('mainapp.TripPhoto', photo.pk)
+        photo.refresh_from_db()
+        card = photo.image_renditions['card']
+        html = self.render("{% picture photo 'card' 'w-100' 'Lake' %}", photo=photo)
+        self.assertIn(f'src="{default_storage.url(card["files"]["jpeg"])}"', html)
+        self.assertIn(f'width="{card["width"]}" height="{card["height"]}"', html)
+        self.assertIn('class="w-100" alt="Lake"', html)
+        if 'webp' in card['files']:
+            self.assertIn(f'<source srcset="{default_storage.url(card["files"]["webp"])}" type="image/webp">', html)
+        self.assertEqual(self.render("{% rendition_url photo 'card' %}", photo=photo),
+                         default_storage.url(card['files']['jpeg']))
+        self.assertEqual(self.render("{% picture photo 'card' %}", photo=TripPhoto(trip=self.trip)), '')
+
+
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.users = {name: User.objects.create_user(name) for name in ('alice', 'bob', 'carol', 'dave')}
+        profiles = {name: UserProfile.objects.create(user=user) for name, user in self.users.items()}
+        group = ChatGroup.objects.create(name='Hikers')
+        group.members.add(profiles['alice'], profiles['bob'], profiles['carol'])
+        self.group_chat = UserChat.objects.create(first_person=profiles['alice'], group=group)
+        self.direct_chat = UserChat.objects.create(first_person=profiles['alice'], second_person=profiles['bob'])
+        async_to_sync(get_channel_layer().flush)()
+
+    async def connect(self, *names):
+        communicators = []
+        for name in names:
+            communicator = WebsocketCommunicator(consumers.ChatConsumer.as_asgi(), '/messages/')
+            communicator.scope['user'] = self.users[name]
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected, name)
+            communicators.append(communicator)
+        return communicators
+
+    async def send(self, communicator, userchat, sender, message='Hello'):
+        await communicator.send_json_to({'message': message, 'userchat_id': userchat.id,
+                                         'sender_id': self.users[sender].id, 'receiver_id': self.users['bob'].id})
+
+    def stored(self):
+        return list(ChatMessage.objects.values_list('message', flat=True))
+
+    def test_anonymous_users_are_turned_away(self):
+        @async_to_sync
+        async def connect():
+            communicator = WebsocketCommunicator(consumers.ChatConsumer.as_asgi(), '/messages/')
+            communicator.scope['user'] = AnonymousUser()
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+            await communicator.disconnect()
+        connect()
+
+    def test_group_message_reaches_every_member(self):
+        @async_to_sync
+        async def chat():
+            alice, bob, carol, dave = communicators = await self.connect('alice', 'bob', 'carol', 'dave')
+            try:
+                await self.send(alice, self.group_chat, 'alice')
+                for communicator in (alice, bob, carol):
+                    received = await communicator.receive_json_from()
+                    self.assertEqual((received['message'], received['sent_by'], received['username']),
+                                     ('Hello', str(self.users['alice'].id), 'alice'))
+                    self.assertTrue(await communicator.receive_nothing())
+                self.assertTrue(await dave.receive_nothing())
+            finally:
+                for communicator in communicators:
+                    await communicator.disconnect()
+        chat()
+        self.assertEqual(self.stored(), ['Hello'])
+
+    def test_direct_message_reaches_both_people(self):
+        @async_to_sync
+        async def chat():
+            alice, bob, carol = communicators = await self.connect('alice', 'bob', 'carol')
+            try:
+                await self.send(alice, self.direct_chat, 'alice')
+                for communicator in (alice, bob):
+                    self.assertEqual((await communicator.receive_json_from())['message'], 'Hello')
+                self.assertTrue(await carol.receive_nothing())
+            finally:
+                for communicator in communicators:
+                    await communicator.disconnect()
+        chat()
+
+    def test_messages_are_rejected(self):
+        cases = [
+            ('dave', self.group_chat, 'dave', 'sender is not a member of this group'),
+            ('carol', self.direct_chat, 'carol', 'sender is not part of this conversation'),
+            ('alice', self.group_chat, 'bob', 'sent by user is incorrect'),
+        ]
+        for name, userchat, sender, error in cases:
+            with self.subTest(name=name, sender=sender):
+                @async_to_sync
+                async def chat():
+                    communicators = await self.connect('alice', 'bob', 'carol', 'dave')
+                    try:
+                        await self.send(communicators[list(self.users).index(name)], userchat, sender)
+                        for communicator in communicators:
+                            self.assertTrue(await communicator.receive_nothing())
+                    finally:
+                        for communicator in communicators:
+                            await communicator.disconnect()
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    chat()
+                self.assertIn(error, output.getvalue())
+                self.assertEqual(self.stored(), [])
+
+
+@mock.patch.object(consumers, 'USERCHAT_CACHE_SIZE', 2)
+class ChatConsumerUserChatCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = consumers.ChatConsumer()
+        self.consumer.userchats = OrderedDict()
+        fetch = mock.AsyncMock(side_effect=lambda userchat_id: {'id': userchat_id} if userchat_id < 100 else None)
+        patcher = mock.patch.object(self.consumer, 'fetch_userchat', fetch)
+        self.fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, userchat_id):
+        return async_to_sync(self.consumer.get_userchat)(userchat_id)
+
+    def fetched(self):
+        return [call.args[0] for call in self.fetch.call_args_list]
+
+    def test_repeated_lookups_are_not_fetched_again(self):
+        self.assertEqual(self.get('1'), {'id': 1})
+        self.assertEqual(self.get(1), {'id': 1})
+        self.assertEqual(self.fetched(), [1])
+        self.assertIsNone(self.get('not a number'))
+        self.assertEqual(self.fetched(), [1])
+
+    def test_least_recently_used_chat_is_evicted(self):
+        for userchat_id in (1, 2, 1, 3):
+            self.get(userchat_id)
+        # 2 was used longest ago when 3 came in
+        self.assertEqual(list(self.consumer.userchats), [1, 3])
+        self.get(2)
+        self.assertEqual(list(self.consumer.userchats), [3, 2])
+        self.assertEqual(self.fetched(), [1, 2, 3, 2])
+
+    def test_missing_chats_are_not_cached(self):
+        self.assertIsNone(self.get(100))
+        self.assertIsNone(self.get(100))
+        self.assertEqual(self.fetched(), [100, 100])
+        self.assertEqual(self.consumer.userchats, OrderedDict())
+
+
+class TripDetailTests(TestCase):
+    def test_latest_reviews_of_the_trip_are_shown(self):
+        organizer = User.objects.create_user('organizer')
+        place = Place.objects.create(name='Lake District', address='Cumbria')
+        trip, other = (Trip.objects.create(uploader=organizer, title=title, description='A trip', place=place,
+                                           start_date=date.today(), end_date=date.today())
+                       for title in ('Kayak tour', 'Walk'))
+        now = timezone.now()
+        for i in range(views.TRIP_REVIEWS_SHOWN + 2):
+            review = Review.objects.create(trip=trip, user=organizer, review=f'Review {i}')
+            Review.objects.filter(pk=review.pk).update(created_at=now - timedelta(minutes=i))
+        Review.objects.create(trip=other, user=organizer, review='About the walk')
+
+        response = self.client.get(reverse('mainapp:trip_detail', args=[trip.pk]))
+        self.assertEqual([review.review for review in response.context['trip_reviews']],
+                         [f'Review {i}' for i in range(views.TRIP_REVIEWS_SHOWN)])
+        self.assertContains(response, 'organizer - Review 0')
+
+        response = self.client.get(reverse('mainapp:trip_detail', args=[other.pk]))
+        self.assertContains(response, 'organizer - About the walk')
+
+
+class ModelSignalTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(f'user{i}') for i in range(3)]
+        self.lake, self.hill = (Place.objects.create(name=name, address='Cumbria') for name in ('Lake', 'Hill'))
+        self.trip = Trip.objects.create(uploader=self.users[0], title='Kayak tour', description='A trip',
+                                        place=self.lake, start_date=date.today(), end_date=date.today(),
+                                        max_capacity=2)
+
+    def statistics(self, place):
+        place.refresh_from_db()
+        return place.rating_count, place.rating_total, place.rating_histogram
+
+    def selects_from(self, queries, table):
+        return [query['sql'] for query in queries if query['sql'].startswith('SELECT') and table in query['sql']]
+
+    def test_rating_counters_and_histogram(self):
+        for user, stars in zip(self.users, (5, 4, 4)):
+            Rating.objects.create(user=user, place=self.lake, rating=stars)
+        self.assertEqual(self.statistics(self.lake), (3, 13, [(5, 1), (4, 2), (3, 0), (2, 0), (1, 0)]))
+        self.assertEqual(self.lake.average_rating, 4.3)
+
+        rating = Rating.objects.get(user=self.users[0])
+        rating.rating = 2
+        with CaptureQueriesContext(connection) as queries:
+            rating.save()
+        self.assertEqual(self.selects_from(queries, 'mainapp_rating'), [])
+        self.assertEqual(self.statistics(self.lake), (3, 10, [(5, 0), (4, 2), (3, 0), (2, 1), (1, 0)]))
+
+        # saved again unchanged, then moved to another place
+        rating.save()
+        self.assertEqual(self.statistics(self.lake)[:2], (3, 10))
+        rating.place = self.hill
+        rating.save()
+        self.assertEqual(self.statistics(self.lake), (2, 8, [(5, 0), (4, 2), (3, 0), (2, 0), (1, 0)]))
+        self.assertEqual(self.statistics(self.hill), (1, 2, [(5, 0), (4, 0), (3, 0), (2, 1), (1, 0)]))
+
+        # an instance built by hand has nothing loaded, so the old row is read back
+        Rating(pk=rating.pk, user=self.users[0], place=self.lake, rating=1).save()
+        self.assertEqual(self.statistics(self.hill)[:2], (0, 0))
+        self.assertEqual(self.statistics(self.lake), (3, 9, [(5, 0), (4, 2), (3, 0), (2, 0), (1, 1)]))
+
+        Rating.objects.get(user=self.users[1]).delete()
+        self.assertEqual(self.statistics(self.lake)[:2], (2, 5))
+
+    def test_saving_a_trip_does_not_read_it_back(self):
+        trip = Trip.objects.get(pk=self.trip.pk)
+        trip.title = 'Canoe tour'
+        with CaptureQueriesContext(connection) as queries:
+            trip.save()
+        self.assertEqual(self.selects_from(queries, 'mainapp_trip'), [])
+
+    def test_waitlist_is_only_filled_when_capacity_is_raised(self):
+        trip = Trip.objects.get(pk=self.trip.pk)
+        with mock.patch.object(joins, 'promote_waitlist') as promote_waitlist:
+            for change, promoted in [({'title': 'Canoe tour'}, False), ({'max_capacity': 3}, True),
+                                     ({'max_capacity': 3}, False), ({'max_capacity': 1}, False)]:
+                with self.subTest(change=change):
+                    promote_waitlist.reset_mock()
+                    for name, value in change.items():
+                        setattr(trip, name, value)
+                    with self.captureOnCommitCallbacks(execute=True):
+                        trip.save()
+                    self.assertEqual(promote_waitlist.call_args_list, [mock.call(trip.pk)] if promoted else [])
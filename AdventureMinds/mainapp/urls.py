@@ -1,7 +1,5 @@
-from django.conf.urls.static import static
 from django.urls import path, include
 from . import views
-from django.conf import settings
 
 app_name = 'mainapp'
 
@@ -24,8 +22,13 @@ urlpatterns = [
     path('add_or_remove_wishlist/', views.add_or_remove_wishlist, name='add_or_remove_wishlist'),
     path('profile/<str:username>/', views.view_profile, name='view_profile'),
     path('trip_list/', views.trip_list, name='trip_list'),
+    path('trips/feed/', views.trip_feed, name='trip_feed'),
+    path('trips/feed/cards/', views.trip_feed_cards, name='trip_feed_cards'),
     path('trip/<int:trip_id>/', views.trip_detail, name='trip_detail'),
     path('join_trip/<int:trip_id>', views.join_trip, name='join_trip'),
+    path('trip/<int:trip_id>/leave/', views.leave_trip, name='leave_trip'),
+    path('trip/<int:trip_id>/roster/export/', views.export_roster, name='export_roster'),
+    path('trips/export/', views.export_trips, name='export_trips'),
     path('trip/<int:trip_id>/join-request/<int:request_id>/accept/', views.accept_join_request,
        name='accept_join_request'),
     path('trip/<int:trip_id>/join-request/<int:request_id>/decline/', views.decline_join_request,
@@ -33,13 +36,17 @@ urlpatterns = [
     path('add_rating/<int:place_id>/', views.add_rating_and_review, name='add_rating_and_review'),
     path('place/<int:pk>/', views.PlaceDetailView.as_view(), name='place_detail'),
     path('add_trip/', views.add_trip, name='add_trip'),
+    path('imports/', views.import_data, name='import_data'),
     path('t/', views.terms_conditions, name='terms_conditions'),
     path('myprofile/', views.user_profile, name='profile'),
     path('preferences/', views.user_preferences, name='user_preferences'),
     path('messages/', views.messages, name='messages'),
+    path('messages/<int:userchat_id>/history/', views.message_history, name='message_history'),
+    path('messages/unread/', views.unread_counts, name='unread_counts'),
+    path('messages/<int:userchat_id>/export/', views.export_chat, name='export_chat'),
     path('message_button/', views.message_button, name='message_button'),
     path('create_group/', views.create_group, name='create_group'),
     path('add_blog/', views.add_blog_post, name='add_blogpost'),
     path('blog_list/', views.blog_list, name='blog_list'),
     path('blogpost/<int:blog_post_id>/', views.blog_post_detail, name='blog_post_detail'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+]
\ No newline at end of file
@@ -1,8 +1,35 @@
 import calendar
-from datetime import datetime, timedelta
+from datetime import date, timedelta
 from calendar import HTMLCalendar
+from django.core.cache import cache
+from django.utils.html import escape
+from . import caching
 from .models import Trip
 
+CALENDAR_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def calendar_section(year, month):
+    """Each month is a cache section of its own (see caching.py)."""
+    return f'calendar:{year}:{month}'
+
+
+def month_range(year, month):
+    """First and last day of a month."""
+    return date(year, month, 1), date(year, month, calendar.monthrange(year, month)[1])
+
+
+def months_between(start_date, end_date):
+    """(year, month) pairs for every month a date range touches."""
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def invalidate_calendar(start_date, end_date):
+    caching.invalidate(*[calendar_section(year, month) for year, month in months_between(start_date, end_date)])
+
 
 class Calendar(HTMLCalendar):
     def __init__(self, year=None, month=None):
@@ -10,44 +37,67 @@ class Calendar(HTMLCalendar):
         self.month = month
         super(Calendar, self).__init__()
 
+    # trips running on each day of the month, fetched with a single query
+    def trips_by_day(self):
+        first_day, last_day = month_range(self.year, self.month)
+        trips = Trip.objects.filter(start_date__lte=last_day, end_date__gte=first_day).order_by('start_date', 'id')
+
+        days = {}
+        for trip in trips.only('title', 'start_date', 'end_date'):
+            day = max(trip.start_date, first_day)
+            last = min(trip.end_date, last_day)
+            while day <= last:
+                days.setdefault(day.day, []).append(trip)
+                day += timedelta(days=1)
+        return days
+
     # formats a day as a td
-    # filter events by day
-    def formatday(self, day, trips):
-        trips_per_day = trips.filter(start_date__day=day)
-        d = ''
-        for trip in trips_per_day:
-            d += f'<li> {trip.title}, Ends on: {trip.end_date.strftime('%d-%m-%Y')} </li>'
-
-        if day != 0:
-            return f"<td><span class='date'>{day}</span><ul> {d} </ul></td>"
-
-        return '<td></td>'
-
-    def formatweek(self, theweek, trips):
-        week = ''
-        for d, weekday in theweek:
-            week += self.formatday(d, trips)
+    def formatday(self, day, trips_by_day):
+        if day == 0:
+            return '<td></td>'
+
+        items = ''.join(
+            f"<li> {escape(trip.title)}, Ends on: {trip.end_date.strftime('%d-%m-%Y')} </li>"
+            for trip in trips_by_day.get(day, ())
+        )
+        return f"<td><span class='date'>{day}</span><ul> {items} </ul></td>"
+
+    def formatweek(self, theweek, trips_by_day):
+        week = ''.join(self.formatday(d, trips_by_day) for d, weekday in theweek)
         return f'<tr> {week} </tr>'
 
     def formatmonthname(self, theyear, themonth, withyear=True):
         """Return a month's name."""
-        s = f'<div class="calendar-navigation"><a href="?month={themonth - 1}&year={theyear}" class="btn btn-secondary float-left">&lt; Previous Month</a>'
-        if withyear:
-            s += f"{calendar.month_name[themonth]} {theyear}"
-        else:
-            s += calendar.month_name[themonth]
-        # Add navigation buttons here
-        s += f'<a href="?month={themonth + 1}&year={theyear}" class="btn btn-secondary float-right">Next Month &gt;</a></div>'
-        return s
+        prev_year, prev_month = (theyear - 1, 12) if themonth == 1 else (theyear, themonth - 1)
+        next_year, next_month = (theyear + 1, 1) if themonth == 12 else (theyear, themonth + 1)
+        name = f"{calendar.month_name[themonth]} {theyear}" if withyear else calendar.month_name[themonth]
+        return ''.join([
+            f'<div class="calendar-navigation"><a href="?month={prev_month}&year={prev_year}" class="btn btn-secondary float-left">&lt; Previous Month</a>',
+            name,
+            f'<a href="?month={next_month}&year={next_year}" class="btn btn-secondary float-right">Next Month &gt;</a></div>',
+        ])
 
     # formats a month as a table
-    # filter events by year and month
+    # the rendered month is cached under the month's version, which a change
+    # to a trip in it bumps; the version is read before the trips are, so a
+    # month rendered while a trip was being saved is stored under the old one
     def formatmonth(self, withyear=True):
-        trips = Trip.objects.filter(start_date__year=self.year, start_date__month=self.month)
-
-        cal = f'<table border="0" cellpadding="0" cellspacing="0" class="calendar">\n'
-        cal += f'{self.formatmonthname(self.year, self.month, withyear=withyear)}\n'
-        cal += f'{self.formatweekheader()}\n'
-        for week in self.monthdays2calendar(self.year, self.month):
-            cal += f'{self.formatweek(week, trips)}\n'
-        return cal
\ No newline at end of file
+        version = caching.versions(calendar_section(self.year, self.month))
+        key = f'mainapp:calendar:{self.year}:{self.month}:{version}'
+        html = cache.get(key) if withyear else None
+        if html is not None:
+            return html
+
+        trips_by_day = self.trips_by_day()
+        parts = [
+            '<table border="0" cellpadding="0" cellspacing="0" class="calendar">',
+            self.formatmonthname(self.year, self.month, withyear=withyear),
+            self.formatweekheader(),
+        ]
+        parts.extend(self.formatweek(week, trips_by_day) for week in self.monthdays2calendar(self.year, self.month))
+        parts.append('</table>')
+        html = '\n'.join(parts) + '\n'
+
+        if withyear:
+            cache.set(key, html, CALENDAR_CACHE_TIMEOUT)
+        return html
@@ -1,24 +1,37 @@
-import os
-from audioop import reverse
 from datetime import date, datetime, timedelta
-from random import shuffle
-from uuid import uuid4
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils.safestring import mark_safe
 from django.views import generic
+from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.views.generic import DetailView
+from .asyncviews import aget_object_or_404, alist, alogin_required, auser, gather, profile_or_404
+from .caching import cache_public_page
+from .routers import read_from_replica
 from .utils import Calendar
+from .pagination import DEFAULT_PAGE_SIZE, InvalidCursor, akeyset_page, keyset_page, page_number_from, page_size_from
+from .ratings import rating_average
+from .storage import acquire
+from .recommendations import recommend_trips, recommended_trip_ids, recommendation_scores
+from . import exports, images, imports, joins, search
 from .models import *
 from .forms import *
 import django
-from django.db.models import Avg, Q
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.template.loader import render_to_string
+from django.urls import reverse
 
 
 @login_required
@@ -29,9 +42,6 @@ def user_profile(request):
         form = UserProfileForm(request.POST, request.FILES, instance=user_profile_instance)
         if form.is_valid():
             print(form.cleaned_data)
-            if 'profile_photo' in request.FILES:
-                file_name = str(uuid4()) + os.path.splitext(request.FILES['profile_photo'].name)[1]
-                form.instance.profile_photo.name = 'profile/' + file_name
             form.save()
             django.contrib.messages.success(request, 'Profile updated successfully.')
             return redirect('mainapp:profile')
@@ -176,6 +186,8 @@ def forgot_password(request):
         return render(request, 'registration/forgot_password.html', {'form': form})
 
 
+@read_from_replica
+@cache_public_page()
 def homepage(request):
     template = "mainapp/homepage1.html"
     context = {}
@@ -204,9 +216,12 @@ def add_trip(request):
             trip.preferences = trip_preference
             trip.save()
 
-            for photo in request.FILES.getlist('photos'):
-                trip_photo = TripPhoto(trip=trip, photo=photo)
-                trip_photo.save()
+            # the uploads are stored as they are; renditions are made after the response
+            photos = TripPhoto.objects.bulk_create(
+                [TripPhoto(trip=trip, photo=photo) for photo in request.FILES.getlist('photos')])
+            # bulk_create sends no signals
+            acquire(StoredFile, *[photo.photo.name for photo in photos])
+            images.process_later(photos)
 
             return redirect('mainapp:homepage')  # Redirect to some success URL
         else:
@@ -219,117 +234,297 @@ def add_trip(request):
     return render(request, 'mainapp/add_trip.html', {'trip_form': trip_form, 'preference_form': preference_form})
 
 
-@login_required
-def trip_list(request):
-    if request.user.is_authenticated:
-        user_profile = get_object_or_404(UserProfile, user=request.user)
-        if not user_profile.preferences:
-            return redirect('mainapp:user_preferences')
-        user_preferences = user_profile.preferences.preferences.prefetch_related('preferences')
-        trips = Trip.objects.all()
-        query = request.GET.get('query')
-        if query:
+@staff_member_required
+def import_data(request):
+    """Bulk import of places or trips for onboarding partners, see imports.py."""
+    context = {'kinds': ImportRun.KIND_CHOICES}
+    if request.method == 'POST':
+        upload = request.FILES.get('file')
+        kind = request.POST.get('kind')
+        if upload is None or kind not in dict(ImportRun.KIND_CHOICES):
+            context['error'] = 'Choose what to import and a file to import it from.'
+        else:
+            importer = imports.PlaceImporter() if kind == 'places' else imports.TripImporter(request.user)
+            try:
+                run = imports.run_import(importer, upload.file, upload.name, user=request.user,
+                                         restart='restart' in request.POST)
+            except imports.BulkImportError as error:
+                context['error'] = str(error)
+            else:
+                context['run'] = run
+                context['errors'] = [imports.describe(error) for error in run.errors]
+    context['runs'] = ImportRun.objects.select_related('started_by').order_by('-created_at')[:10]
+    return render(request, 'mainapp/import_data.html', context)
+
+
+@alogin_required
+@read_from_replica
+async def trip_list(request):
+    user_profile = profile_or_404(request.user)
+    if not user_profile.preferences_id:
+        return redirect('mainapp:user_preferences')
+    trips = trip_cards(Trip.objects.all())
+    query = request.GET.get('query')
+    sort_by = request.GET.get('sort_by')
+    page = page_number_from(request)
+    search_results = None
+    has_next_page = False
+    if query:
+        if search.is_available():
+            # matches are shown a page at a time, best first
+            search_results = await sync_to_async(search.search_trips)(
+                query, search.PAGE_SIZE + 1, (page - 1) * search.PAGE_SIZE)
+            has_next_page = len(search_results) > search.PAGE_SIZE
+            search_results = search_results[:search.PAGE_SIZE]
+            trips = trips.filter(id__in=[result.trip_id for result in search_results])
+        else:
             trips = trips.filter(Q(place__name__icontains=query) | Q(place__address__icontains=query) | Q(
                 place__description__icontains=query))
 
-        if 'my_trips' in request.GET:
-            trips = trips.filter(uploader=request.user)
+    if 'my_trips' in request.GET:
+        trips = trips.filter(uploader=request.user)
 
-        sort_by = request.GET.get('sort_by')
+    next_cursor = None
+    offset = (page - 1) * DEFAULT_PAGE_SIZE
+    if search_results is not None:
+        # the search has already picked the page: only its order changes
         if sort_by == 'recommendation':
-            similarity_scores = {}
-            for trip in trips:
-                trip_preference = trip.preferences
-                if trip_preference:
-                    similarity_score = calculate_similarity(user_preferences,
-                                                            trip_preference.preferences.prefetch_related('preferences'))
-                    similarity_scores[trip.id] = similarity_score
-
-            trips = sorted(trips, key=lambda x: similarity_scores.get(x.id, 0), reverse=True)
+            trips = await alist(trips)
+            scores = await sync_to_async(recommendation_scores)(user_profile, [trip.id for trip in trips])
+            trips = recommend_trips(user_profile, trips, scores)
         elif sort_by == 'alphabetical':
-            trips = trips.order_by('place__name')
+            trips = await alist(trips.order_by('place__name', 'id'))
+        else:
+            trips = await alist(trips)
+    elif sort_by == 'recommendation':
+        # only the best matches up to the end of this page are ranked, never the whole table
+        candidates = None
+        if query or 'my_trips' in request.GET:
+            candidates = await alist(trips.values_list('id', flat=True))
+        ranked = await sync_to_async(recommended_trip_ids)(user_profile, offset + DEFAULT_PAGE_SIZE + 1, candidates)
+        ranked = ranked[offset:]
+        has_next_page = len(ranked) > DEFAULT_PAGE_SIZE
+        ranked = ranked[:DEFAULT_PAGE_SIZE]
+        by_id = {trip.id: trip for trip in await alist(trips.filter(id__in=ranked))}
+        trips = [by_id[trip_id] for trip_id in ranked if trip_id in by_id]
+    elif sort_by == 'alphabetical' or query:
+        ordering = ('place__name', 'id') if sort_by == 'alphabetical' else ('-created_at', '-id')
+        trips = await alist(trips.order_by(*ordering)[offset:offset + DEFAULT_PAGE_SIZE + 1])
+        has_next_page = len(trips) > DEFAULT_PAGE_SIZE
+        trips = trips[:DEFAULT_PAGE_SIZE]
+    else:
+        # the plain listing is served a page at a time, the rest is loaded by infinite scroll
+        trips, next_cursor = await akeyset_page(trips)
 
-        saved_searches = request.COOKIES.get('saved_searches', '').split('|')
+    if search_results is not None:
+        trips = search.with_snippets(trips, search_results, ranked=not sort_by)
 
-        if query:
-            saved_searches.append(query)
-            saved_searches = list(set(saved_searches))[-5:]  # Limit to last 5 unique queries
-            response = render(request, 'mainapp/homepage2.html',
-                              {'trips': trips, 'saved_searches': saved_searches, 'query': query})
-            response.set_cookie('saved_searches', '|'.join(saved_searches), max_age=3600 * 24 * 7)  # Save for 1 week
-            return response
+    next_page_url = None
+    if has_next_page:
+        params = request.GET.copy()
+        params['page'] = page + 1
+        next_page_url = f'?{params.urlencode()}'
 
-        return render(request, 'mainapp/homepage2.html', {'trips': trips, 'saved_searches': saved_searches})
-    else:
-        trips = Trip.objects.all()
-        return render(request, 'mainapp/guest_trip_list.html', {'trips': trips})
+    saved_searches = request.COOKIES.get('saved_searches', '').split('|')
 
+    if query:
+        saved_searches.append(query)
+        saved_searches = list(set(saved_searches))[-5:]  # Limit to last 5 unique queries
+        response = render(request, 'mainapp/homepage2.html', {'trips': trips, 'saved_searches': saved_searches,
+                                                              'query': query, 'next_page_url': next_page_url})
+        response.set_cookie('saved_searches', '|'.join(saved_searches), max_age=3600 * 24 * 7)  # Save for 1 week
+        return response
 
-def calculate_similarity(user_preferences, trip_preferences):
-    user_pref_set = set(user_preferences.values_list('id', flat=True))
-    trip_pref_set = set(trip_preferences.values_list('id', flat=True))
-    # jaccard similarity
-    intersection = len(user_pref_set.intersection(trip_pref_set))
-    union = len(user_pref_set.union(trip_pref_set))
+    return render(request, 'mainapp/homepage2.html', {'trips': trips, 'saved_searches': saved_searches,
+                                                      'next_cursor': next_cursor, 'next_page_url': next_page_url,
+                                                      'my_trips': 'my_trips' in request.GET})
 
-    if union == 0:
-        return 0.0
 
-    jaccard_similarity = intersection / union
+def trip_cards(trips):
+    """Preload what a trip card shows so a page of cards costs a fixed number of queries."""
+    return trips.select_related('place', 'uploader').prefetch_related('trip_photos').annotate(
+        average_rating=rating_average('place__'))
 
-    return jaccard_similarity
 
+def trip_feed_page(request):
+    trips = trip_cards(Trip.objects.all())
+    if 'my_trips' in request.GET and request.user.is_authenticated:
+        trips = trips.filter(uploader=request.user)
+    return keyset_page(trips, request.GET.get('cursor'), page_size_from(request))
 
-def trip_detail(request, trip_id):
-    trip = get_object_or_404(Trip, pk=trip_id)
-    photo = TripPhoto.objects.all()
-    join_request = None
 
-    average_rating = Rating.objects.filter(place=trip.place).aggregate(Avg('rating'))['rating__avg']
-    trip.average_rating = round(average_rating, 1) if average_rating else None
-    reviews = list(Review.objects.filter(place=trip.place))
-    shuffle(reviews)
-    trip.reviews = reviews
-    if request.user.is_authenticated:
-        join_request = JoinRequest.objects.filter(trip=trip, user=request.user).first()
-    return render(request, 'mainapp/trip_detail.html', {'trip': trip, 'join_request': join_request, 'photo': photo})
+@read_from_replica
+def trip_feed(request):
+    try:
+        trips, next_cursor = trip_feed_page(request)
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    data = [{
+        'id': trip.id,
+        'title': trip.title,
+        'url': reverse('mainapp:trip_detail', args=[trip.id]),
+        'place': {'id': trip.place.id, 'name': trip.place.name},
+        'uploader': trip.uploader.username,
+        'start_date': trip.start_date,
+        'end_date': trip.end_date,
+        'cost_per_person': trip.cost_per_person,
+        'max_capacity': trip.max_capacity,
+        'participant_count': trip.participant_count,
+        'photos': [photo.photo.url for photo in trip.trip_photos.all()],
+    } for trip in trips]
+    return JsonResponse({'trips': data, 'next_cursor': next_cursor})
+
+
+@read_from_replica
+def trip_feed_cards(request):
+    try:
+        trips, next_cursor = trip_feed_page(request)
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor')
+    return render(request, 'mainapp/trip_cards.html', {'trips': trips, 'next_cursor': next_cursor})
+
+
+# reviews shown on a trip page: a random few of the place's most recent ones,
+# and the latest of the trip's own
+REVIEW_SAMPLE_SIZE = 3
+REVIEW_SAMPLE_POOL = 50
+TRIP_REVIEWS_SHOWN = 10
+
+
+async def load_trip_detail(trip_id, user=None):
+    """
+    Everything the trip page shows, in a fixed number of queries: the trip
+    with its place, uploader, photos, participants and preferences (4), a
+    sample of reviews of its place (1), the latest reviews of the trip
+    itself (1), and for a logged-in user the join requests they may see
+    (1): all pending ones if they organize the trip, otherwise their own.
+    They are awaited together, but gather still runs them one after
+    another.
+    """
+    trip = aget_object_or_404(
+        Trip.objects.select_related('place', 'uploader__userprofile', 'preferences').prefetch_related(
+            'trip_photos',
+            Prefetch('participants', queryset=User.objects.select_related('userprofile')),
+            'preferences__preferences'),
+        pk=trip_id)
+
+    place_id = Subquery(Trip.objects.filter(pk=trip_id).values('place_id'))
+    recent_reviews = Review.objects.filter(trip__place_id=place_id).order_by('-created_at')
+    reviews = alist(Review.objects.filter(
+        pk__in=Subquery(recent_reviews.values('pk')[:REVIEW_SAMPLE_POOL])).select_related('user').order_by('?')[
+        :REVIEW_SAMPLE_SIZE])
+
+    trip_reviews = alist(Review.objects.filter(trip_id=trip_id).select_related('user').order_by('-created_at')[
+        :TRIP_REVIEWS_SHOWN])
+
+    queries = [trip, reviews, trip_reviews]
+    if user is not None and user.is_authenticated:
+        queries.append(alist(JoinRequest.objects.filter(trip_id=trip_id).filter(
+            Q(user=user) | Q(trip__uploader=user, status__in=['pending', 'waitlisted'])).select_related(
+            'user__userprofile').order_by('timestamp')))
+    trip, reviews, trip_reviews, *join_requests = await gather(*queries)
+
+    participants = list(trip.participants.all())
+    context = {
+        'trip': trip,
+        'photos': trip.trip_photos.all(),
+        'participants': participants,
+        'reviews': reviews,
+        'trip_reviews': trip_reviews,
+        'average_rating': trip.place.average_rating,
+        'is_participant': False,
+        'join_request': None,
+        'pending_requests': [],
+    }
+    if join_requests:
+        context['is_participant'] = any(participant.pk == user.pk for participant in participants)
+        if user.pk == trip.uploader_id:
+            context['pending_requests'] = join_requests[0]
+        else:
+            context['join_request'] = next(iter(join_requests[0]), None)
+    return context
 
 
+@cache_public_page('trip', 'place', 'review', 'rating', timeout=settings.TRIP_DETAIL_CACHE_TIMEOUT)
+async def trip_detail(request, trip_id):
+    return render(request, 'mainapp/trip_detail.html', await load_trip_detail(trip_id, await auser(request)))
+
+
+@read_from_replica
 def view_profile(request, username):
     profile_user = get_object_or_404(User, username=username)
     return render(request, 'mainapp/view_profile.html', {'profile_user': profile_user})
 
 
 @login_required
+@require_POST
 def join_trip(request, trip_id):
     trip = get_object_or_404(Trip, pk=trip_id)
-    user = request.user
-
-    existing_request = JoinRequest.objects.filter(trip=trip, user=user).exists()
-    if existing_request:
-        django.contrib.messages.warning(request, "You have already requested to join this trip.")
-        return redirect('mainapp:trip_detail', trip_id=trip_id)
-
-    join_request = JoinRequest.objects.create(trip=trip, user=user, status='pending')
-    django.contrib.messages.success(request, "Your join request has been submitted successfully.")
+    try:
+        joins.request_to_join(trip, request.user)
+    except joins.JoinError as error:
+        django.contrib.messages.warning(request, str(error))
+    else:
+        django.contrib.messages.success(request, "Your join request has been submitted successfully.")
     return redirect('mainapp:trip_detail', trip_id=trip_id)
 
 
+@login_required
+@require_POST
 def accept_join_request(request, trip_id, request_id):
-    trip = get_object_or_404(Trip, id=trip_id)
-    join_request = get_object_or_404(JoinRequest, id=request_id)
-    trip.participants.add(join_request.user)
-    join_request.delete()
-
+    # only the organizer answers join requests
+    get_object_or_404(Trip, id=trip_id, uploader=request.user)
+    try:
+        status = joins.accept(trip_id, request_id)
+    except joins.JoinError as error:
+        django.contrib.messages.warning(request, str(error))
+    else:
+        if status == 'waitlisted':
+            django.contrib.messages.info(request, "The trip is full, the request was put on the waitlist.")
     return redirect('mainapp:trip_detail', trip_id=trip_id)
 
 
+@login_required
+@require_POST
 def decline_join_request(request, trip_id, request_id):
-    join_request = get_object_or_404(JoinRequest, id=request_id)
-    join_request.delete()
+    get_object_or_404(Trip, id=trip_id, uploader=request.user)
+    try:
+        joins.decline(trip_id, request_id)
+    except joins.JoinError as error:
+        django.contrib.messages.warning(request, str(error))
+    return redirect('mainapp:trip_detail', trip_id=trip_id)
+
+
+@login_required
+@require_POST
+def leave_trip(request, trip_id):
+    get_object_or_404(Trip, pk=trip_id)
+    try:
+        joins.leave(trip_id, request.user)
+    except joins.JoinError as error:
+        django.contrib.messages.warning(request, str(error))
+    else:
+        django.contrib.messages.success(request, "You have left the trip.")
     return redirect('mainapp:trip_detail', trip_id=trip_id)
 
 
+@alogin_required
+@read_from_replica
+async def export_trips(request):
+    """The trips the user organizes, as CSV or JSON Lines."""
+    return exports.export_response(request, exports.trips_export(Trip.objects.filter(uploader=request.user)))
+
+
+@alogin_required
+@read_from_replica
+async def export_roster(request, trip_id):
+    # only the organizer sees who is on the trip and who asked to join it
+    await aget_object_or_404(Trip, id=trip_id, uploader=request.user)
+    return exports.export_response(request, exports.roster_export(trip_id))
+
+
+@method_decorator(cache_public_page('place', 'review', 'rating'), name='dispatch')
 class PlaceDetailView(DetailView):
     model = Place
     template_name = 'mainapp/place_detail.html'
@@ -342,7 +537,9 @@ def add_rating_and_review(request, place_id):
     user = request.user
 
     user_rating = Rating.objects.filter(place=place, user=user).first()
-    user_review = Review.objects.filter(place=place, user=user).first()
+    # reviews belong to a trip, the one the user went on to this place
+    user_review = Review.objects.filter(trip__place=place, user=user).first()
+    trip = Trip.objects.filter(place=place, participants=user).order_by('-end_date').first()
 
     rating_form = RatingForm(instance=user_rating)
     review_form = ReviewForm(instance=user_review)
@@ -351,16 +548,22 @@ def add_rating_and_review(request, place_id):
         rating_form = RatingForm(request.POST, instance=user_rating)
         review_form = ReviewForm(request.POST, instance=user_review)
 
-        if rating_form.is_valid() and review_form.is_valid():
-            rating = rating_form.save(commit=False)
-            rating.user = user
-            rating.place = place
-            rating.save()
+        if user_review is None and trip is None:
+            review_form.add_error(None, 'You can only review places you have visited on a trip.')
 
-            review = review_form.save(commit=False)
-            review.user = user
-            review.place = place
-            review.save()
+        if rating_form.is_valid() and review_form.is_valid():
+            # the place's rating statistics are updated in the same transaction
+            with transaction.atomic():
+                rating = rating_form.save(commit=False)
+                rating.user = user
+                rating.place = place
+                rating.save()
+
+                review = review_form.save(commit=False)
+                review.user = user
+                if user_review is None:
+                    review.trip = trip
+                review.save()
 
             return redirect('mainapp:user_trip_history')
 
@@ -374,11 +577,13 @@ def add_rating_and_review(request, place_id):
 
 
 @login_required
+@read_from_replica
 def user_trip_list(request):
     current_user = request.user
     current_date = timezone.now().date()
-    upcoming_trips = Trip.objects.filter(participants=current_user, start_date__gt=current_date)
-    past_trips = Trip.objects.filter(participants=current_user, end_date__lt=current_date)
+    trips = Trip.objects.select_related('place')
+    upcoming_trips = trips.filter(participants=current_user, start_date__gt=current_date)
+    past_trips = trips.filter(participants=current_user, end_date__lt=current_date)
     context = {
         'upcoming_trips': upcoming_trips,
         'past_trips': past_trips,
@@ -426,7 +631,7 @@ def view_wishlist(request):
             # return redirect('wishlist')
 
     user_id = get_object_or_404(UserProfile, user__id=request.user.id)
-    wishlist_items = Wishlist.objects.filter(user_id=user_id)
+    wishlist_items = Wishlist.objects.filter(user_id=user_id).select_related('trip_id').order_by('-date_added')
     return render(request, 'mainapp/wishlist.html', {'wishlist_items': wishlist_items})
 
 
@@ -453,6 +658,7 @@ def view_calendar(request):
         return render(request, 'mainapp/calendar.html', {'trips': x})
 
 
+@method_decorator(read_from_replica, name='dispatch')
 class CalendarView(generic.ListView):
     model = Trip
     template_name = 'mainapp/calendar.html'
@@ -491,6 +697,7 @@ def get_date(req_day):
     return datetime.today()
 
 
+@cache_public_page()
 def terms_conditions(request):
     template = "mainapp/terms_conditions.html"
     context = {}
@@ -526,22 +733,70 @@ def message_button(request):
         return redirect('mainapp:messages')
 
 
-def getusers(request):
-    users = UserProfile.objects.all().values('username', 'id')
-    return JsonResponse(list(users), safe=False)
+async def getusers(request):
+    users = await alist(User.objects.order_by('username').values('id', 'username'))
+    return JsonResponse(users, safe=False)
 
 
 class Thread:
     pass
 
 
+CHAT_HISTORY_PAGE_SIZE = 30
+
+
+def user_chats(user_profile):
+    # group membership goes through a subquery so the join does not multiply rows
+    return UserChat.objects.filter(
+        Q(first_person=user_profile) | Q(second_person=user_profile) |
+        Q(group__in=ChatGroup.objects.filter(members=user_profile)))
+
+
+def chat_history_page(userchat, cursor=None):
+    messages = ChatMessage.objects.filter(userchat=userchat).select_related('user__user')
+    page, next_cursor = keyset_page(messages, cursor, CHAT_HISTORY_PAGE_SIZE, field='timestamp')
+    page.reverse()  # oldest first, the way the chat is read
+    return page, next_cursor
+
+
+async def achat_history_page(userchat, cursor=None):
+    messages = ChatMessage.objects.filter(userchat=userchat).select_related('user__user')
+    page, next_cursor = await akeyset_page(messages, cursor, CHAT_HISTORY_PAGE_SIZE, field='timestamp')
+    page.reverse()
+    return page, next_cursor
+
+
+def chat_summaries(user_profile):
+    """
+    The user's chats annotated with message and unread counts and the last
+    message, all in one query. Messages after the user's read cursor that
+    someone else sent are unread.
+    """
+    latest_message = ChatMessage.objects.filter(userchat=OuterRef('pk')).order_by('-id')
+    read_cursor = ChatReadCursor.objects.filter(userchat=OuterRef('pk'), user=user_profile)
+    return user_chats(user_profile).annotate(
+        last_read_message_id=Coalesce(Subquery(read_cursor.values('last_read_message_id')[:1]), 0),
+    ).annotate(
+        message_count=Count('chatmessage_userchat'),
+        unread_count=Count('chatmessage_userchat', filter=Q(
+            chatmessage_userchat__id__gt=F('last_read_message_id')) & ~Q(chatmessage_userchat__user=user_profile)),
+        last_message_id=Subquery(latest_message.values('id')[:1]),
+        last_message=Subquery(latest_message.values('message')[:1]),
+        last_message_at=Subquery(latest_message.values('timestamp')[:1]),
+    )
+
+
 @login_required
 def messages(request):
     user_profile = UserProfile.objects.get(user=request.user)
     last_active_userchat_id = request.session.get('last_active_userchat_id')
-    userchats = UserChat.objects.filter(
-        Q(first_person=user_profile) | Q(second_person=user_profile) | Q(group__members=user_profile)).prefetch_related(
-        'chatmessage_userchat').order_by('timestamp').distinct()
+    userchats = list(chat_summaries(user_profile).select_related(
+        'first_person__user', 'second_person__user', 'group').order_by('timestamp'))
+
+    # only the chat shown first is rendered with its messages, the others are
+    # fetched from message_history when they are opened
+    if userchats:
+        userchats[0].recent_messages, userchats[0].history_cursor = chat_history_page(userchats[0])
 
     context = {
         'userchats': userchats,
@@ -551,6 +806,29 @@ def messages(request):
     return render(request, 'mainapp/messages.html', context)
 
 
+@alogin_required
+async def message_history(request, userchat_id):
+    user_profile = profile_or_404(request.user)
+    # the page is loaded with the membership check, and only sent if it passes
+    try:
+        _, (page, next_cursor) = await gather(
+            aget_object_or_404(user_chats(user_profile), pk=userchat_id),
+            achat_history_page(userchat_id, request.GET.get('cursor')))
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    data = [{
+        'id': chat.id,
+        'message': chat.message,
+        'sent_by': str(chat.user.user_id),
+        'username': chat.user.user.username,
+        'user_photo': chat.user.profile_photo.url if chat.user.profile_photo else None,
+        'timestamp': chat.timestamp,
+    } for chat in page]
+    html = render_to_string('mainapp/chat_messages.html', {'chat_messages': page}, request=request)
+    return JsonResponse({'messages': data, 'html': html, 'next_cursor': next_cursor})
+
+
 @login_required
 def set_last_active_userchat_id(request):
     userchat_id = request.POST.get('userchat_id')
@@ -563,50 +841,96 @@ def create_group(request):
         group_name = request.POST.get('group_name')
         selected_users = request.POST.getlist('selected_users')
 
-        group = ChatGroup.objects.create(name=group_name)
-        first_person = request.user
-        user_profile = UserProfile.objects.get(user=first_person)
-        group.members.add(user_profile)
-
         if len(selected_users) < 1:
             return HttpResponse("<h1>Please select At least one user.</h1>")
 
-        for selected_user in selected_users:
-            profile = UserProfile.objects.get(user=selected_user)
-            group.members.add(profile)
+        group = ChatGroup.objects.create(name=group_name)
+        first_person = request.user
+        user_profile = UserProfile.objects.get(user=first_person)
+        # all members in one insert
+        group.members.add(user_profile, *UserProfile.objects.filter(user__in=selected_users))
 
         chat, created = UserChat.objects.get_or_create(
             first_person=user_profile,
             group_id=group.id,
         )
 
+        # let members who are already connected subscribe to the new group's channel
+        channel_layer = get_channel_layer()
+        for member_id in group.members.values_list('user_id', flat=True):
+            async_to_sync(channel_layer.group_send)(f'user_chatroom_{member_id}', {
+                'type': 'chat.join_group',
+                'group_id': group.id,
+            })
+
         django.contrib.messages.success(request, 'Group created successfully.')
 
         return redirect('mainapp:messages')
     else:
         user_profile = UserProfile.objects.get(user=request.user)
-        userchats = UserChat.objects.filter(Q(first_person=user_profile) | Q(second_person=user_profile) | Q(
-            group__members=user_profile)).prefetch_related('chatmessage_userchat').order_by('timestamp')
+        userchats = user_chats(user_profile).select_related(
+            'first_person__user', 'second_person__user', 'group').order_by('timestamp')
         context = {
             'userchats': userchats
         }
         return render(request, 'mainapp/create_group.html', context)
 
 
+@alogin_required
+async def unread_counts(request):
+    """Unread counts and last-message previews of the user's chats, for polling clients."""
+    user_profile = profile_or_404(request.user)
+    chats = [{
+        'userchat_id': chat['id'],
+        'unread_count': chat['unread_count'],
+        'message_count': chat['message_count'],
+        'last_message_id': chat['last_message_id'],
+        'last_message': chat['last_message'],
+        'last_message_at': chat['last_message_at'],
+    } async for chat in chat_summaries(user_profile).order_by('timestamp').values(
+        'id', 'unread_count', 'message_count', 'last_message_id', 'last_message', 'last_message_at')]
+    return JsonResponse({'chats': chats, 'total_unread': sum(chat['unread_count'] for chat in chats)})
+
+
+@alogin_required
+@read_from_replica
+async def export_chat(request, userchat_id):
+    """The transcript of one of the user's chats, as CSV or JSON Lines."""
+    await aget_object_or_404(user_chats(profile_or_404(request.user)), pk=userchat_id)
+    return exports.export_response(request, exports.transcript_export(userchat_id))
+
+
+@login_required
 @require_POST
 @csrf_exempt
 def mark_messages_as_read(request):
     userchat_id = request.POST.get('userchat_id')
-    user_id = request.POST.get('user_id')
     if not userchat_id:
         return JsonResponse({'error': 'UserChat ID is required'}, status=400)
+    user_profile = get_object_or_404(UserProfile, user=request.user)
     try:
-        userchat = UserChat.objects.get(id=userchat_id)
-        ChatMessage.objects.filter(userchat=userchat).exclude(user__id=user_id).update(read=True)
-        return JsonResponse({'success': True})
-    except UserChat.DoesNotExist:
+        userchat = user_chats(user_profile).get(id=userchat_id)
+    except (UserChat.DoesNotExist, ValueError):
         return JsonResponse({'error': 'UserChat not found'}, status=404)
 
+    # read up to the given message, or to the latest one in the chat
+    message_id = request.POST.get('message_id')
+    if message_id:
+        try:
+            message_id = int(message_id)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid message ID'}, status=400)
+    else:
+        message_id = ChatMessage.objects.filter(userchat=userchat).aggregate(last=Max('id'))['last'] or 0
+
+    # the cursor only moves forward, so a late request cannot mark messages unread again
+    cursor, created = ChatReadCursor.objects.get_or_create(
+        userchat=userchat, user=user_profile, defaults={'last_read_message_id': message_id})
+    if not created and cursor.last_read_message_id < message_id:
+        ChatReadCursor.objects.filter(pk=cursor.pk, last_read_message_id__lt=message_id).update(
+            last_read_message_id=message_id)
+    return JsonResponse({'success': True, 'last_read_message_id': max(cursor.last_read_message_id, message_id)})
+
 
 def add_blog_post(request):
     if request.method == 'POST':
@@ -621,13 +945,18 @@ def add_blog_post(request):
     return render(request, 'mainapp/add_blogpost.html', {'blog_form': blog_form})
 
 
+@read_from_replica
+@cache_public_page('blogpost', 'place')
 def blog_post_detail(request, blog_post_id):
     blog_post = get_object_or_404(BlogPost, pk=blog_post_id)
     return render(request, 'mainapp/blog_post_detail.html', {'blog_post': blog_post})
 
 
-def blog_list(request):
-    blogs = BlogPost.objects.all()
+@read_from_replica
+@cache_public_page('blogpost')
+async def blog_list(request):
+    # loaded up front: the template cannot query from the event loop
+    blogs = await alist(BlogPost.objects.select_related('author').order_by('-created_at'))
     return render(request, 'mainapp/blog_list.html', {'blogs': blogs})
 
 